@@ -119,3 +119,89 @@ class BleToUdpPayload:
             packetHeader = self.packetHeader
             return (self.GetNextUdpMessage(), packetHeader)
         return None
+
+
+# Reassembles Hqv linked-layer frames from BLE notifications in a preallocated buffer. Notifications are written
+# once into the buffer and complete frames are handed out as memoryview slices of it, so no payload is copied until
+# the receiver needs to keep it. The buffer wraps to its start when the end is reached; only the unread bytes (at
+# most one partial frame) are moved then.
+class RingBufferReassembler:
+    def __init__(self, capacity=2 * ConverterUtils.HQV_LINKED_LAYER_MESSAGE_MAX_SIZE):
+        self._capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._head = 0  # First unread byte
+        self._tail = 0  # First free byte
+        self._frameEnd = 0  # Tail needed before the next frame can be complete, 0 when not known
+
+    def Pending(self):
+        return self._tail - self._head
+
+    def Reset(self):
+        self._head = 0
+        self._tail = 0
+        self._frameEnd = 0
+
+    def Write(self, blemessage):
+        length = len(blemessage)
+        if self._tail + length > self._capacity:
+            pending = self._tail - self._head
+            if pending + length > self._capacity:
+                logging.warning(f"Reassembly buffer overflow, dropping {pending} buffered bytes")
+                pending = 0
+                self._frameEnd = 0
+                if length > self._capacity:
+                    self.Reset()
+                    return False
+            elif pending:
+                self._view[:pending] = self._view[self._head:self._tail]
+            if self._frameEnd:
+                self._frameEnd -= self._head
+            self._head = 0
+            self._tail = pending
+
+        self._view[self._tail:self._tail + length] = blemessage
+        self._tail += length
+        return True
+
+    def IterFrames(self):
+        # Length driven walk over every complete frame in the buffer, yields (payload, packetHeader)
+        buffer = self._buffer
+        while True:
+            start = self._head
+            if self._tail - start < ConverterUtils.HQV_LINKED_LAYER_MESSAGE_MIN_SIZE:
+                self._frameEnd = start + ConverterUtils.HQV_LINKED_LAYER_MESSAGE_MIN_SIZE
+                break
+            packetType = buffer[start]
+            packetSize = struct.unpack_from("!H", buffer, start + 1)[0]
+            packetHeader = buffer[start + 3]
+
+            if not (
+                    packetType == ConverterUtils.HQV_LINKED_LAYER_MESSAGE_TYPE
+                    and ConverterUtils.IsPacketHeaderValid(packetHeader)
+                    and 0 < packetSize
+                    and (packetSize + 3) <= ConverterUtils.HQV_LINKED_LAYER_MESSAGE_MAX_SIZE
+            ):
+                logging.debug(f"Invalid frame header, dropping {self._tail - start} buffered bytes")
+                self.Reset()
+                return
+
+            end = start + packetSize + 3
+            if end > self._tail:
+                self._frameEnd = end
+                return  # Wait for the rest of the frame
+
+            self._head = end
+            yield self._view[start + 4:end], packetHeader
+
+        if self._head == self._tail:
+            self.Reset()  # Keep writing from the start of the buffer while frames end on notification boundaries
+
+    def Convert(self, blemessage):
+        # Returns every complete frame as (payload, packetHeader), the payload views are only valid until the next
+        # call, so receivers that keep the data must copy it (bytes(payload))
+        if not self.Write(blemessage):
+            return ()
+        if self._tail < self._frameEnd:
+            return ()  # The pending frame is not complete yet, its header was parsed when it arrived
+        return list(self.IterFrames())
@@ -8,19 +8,29 @@
 # developers yet. Notify sends only one message if nothing is left in the buffer. Otherwise also sends multiple
 # buffer messages. A better way would be to not use hard coded fixed sizes. But only encrypted messages have been
 # analyzed during this fix, so another way is needed to analyze and fix this.
+#
+# The hard coded split has been replaced by a length driven walk over the frames in the reassembly buffer
+# (BleToUdpPayload.RingBufferReassembler), so any number of frames in one notification is sent as separate messages.
 # -----------------------------------------------------------------
 import configparser
 import sys
-from bleak import BleakClient, BleakScanner
+from ble_backend import BleakClient, BleakScanner
 from bleak.backends.characteristic import BleakGATTCharacteristic
 from bleak.exc import BleakError
 import logging, asyncio
 from typing import Optional
 import BleToUdpPayload
+import ConverterUtils
+from bounded_queue import BoundedQueue
+from latency_trace import UPLINK, DOWNLINK
+from gatt_cache import gattCache
 import time
+import random
 import eel
 from webserver import clearDeviceData
 from SessionData import sessionData
+from LogRelay import logRelay
+from tools.happObserver import happObserver
 
 # Create a ConfigParser object
 config = configparser.ConfigParser()
@@ -31,7 +41,26 @@ config.read('config.ini')
 # Timeout value for BleakClient
 bleTimeout = int(config.get("BLE", "Timeout", fallback="40"))
 
+# Cap for the ATT MTU used to fragment UDP -> BLE messages (23 is the minimum every BLE device supports)
+ATT_MTU_MIN = 23
+bleMaxMtu = max(ATT_MTU_MIN, int(config.get("BLE", "Max MTU", fallback="247")))
+
+# Number of write-without-response operations allowed in flight at the same time
+bleWriteWindow = max(1, int(config.get("BLE", "Write window", fallback="4")))
+
+# Auto reconnect (not Windows), the delay doubles per attempt up to the max delay and is randomized by +-50 %
+reconnectAttempts = int(config.get("BLE", "Reconnect attempts", fallback="10"))
+reconnectDelay = float(config.get("BLE", "Reconnect delay", fallback="0.5"))
+reconnectMaxDelay = float(config.get("BLE", "Reconnect max delay", fallback="30"))
+RECONNECT_SCAN_TIMEOUT = 10  # Scan used when connecting to the known BLEDevice fails
+
+REMOTE_DTLS_HEADER = ConverterUtils.ToPacketHeader(ConverterUtils.REMOTE, ConverterUtils.DTLS)
+
+
 class BLE_interface:
+    _trace = None  # latency_trace.LatencyTrace when latency tracing is on
+    _receivers = None  # Packet header -> receiver of the frames with that header
+
     async def start(
             self,
             addr_str,
@@ -46,7 +75,10 @@ class BLE_interface:
             excpWinrtEvent,
     ):
         self._ITS_cb = callback
-        self._send_queue = asyncio.Queue()
+        self._send_queue = BoundedQueue.from_config("downlink")
+        self.reset_write_stats()
+        self.reconnectStats = {"disconnects": 0, "attempts": 0, "reconnects": 0, "failures": 0,
+                               "lastReconnectMs": 0.0, "maxReconnectMs": 0.0}
         self._connected = False
         self._addr_str = addr_str
         self._callstop = callstop
@@ -75,20 +107,12 @@ class BLE_interface:
         else:
             timeout = timeout_
 
-        logging.info(f"Searching for {addr_str}")
-        
-        MAX_SCAN_RETRIES = 3
-        SCAN_TIMEOUT = 15  # Shorter search time per scan, e.g., 15 seconds
-
-        device = None
-        for attempt in range(1, MAX_SCAN_RETRIES + 1):
-            logging.info(f"Scan attempt {attempt} for {addr_str}")
-            device = await BleakScanner.find_device_by_address(addr_str, SCAN_TIMEOUT)
-    
-            if device is not None:
-                break  # Found the device, no need to retry
-            else:
-                logging.warning(f"Attempt {attempt}: Device not found.")
+        # A device seen by a recent scan or the HAPP observer is connected to without scanning for it again
+        device = happObserver.cached_device(addr_str)
+        fromCache = device is not None
+        if device is None:
+            device = await self.scan_for_device(addr_str)
+        self._bleDevice = device  # Reused by auto reconnect
 
         #device = await BleakScanner.find_device_by_address(addr_str, 90)
         # logging.debug(f"Device found: {device}")
@@ -97,17 +121,19 @@ class BLE_interface:
 
         if device is None:
             logging.info("Device not found, try again later")
-            eel.putRLog(f"ble_interface.py: Device not found, try again later")
-            eel.changeConnectStatus("Device not found, try again later")
-            sessionData.connectStatusCode = 4  # 4 indicates error
+            logRelay.put(f"ble_interface.py: Device not found, try again later")
+            if sessionData.is_current_device(addr_str):
+                eel.changeConnectStatus("Device not found, try again later")
+                sessionData.connectStatusCode = 4  # 4 indicates error
             self._ITS_cb("Connected: NO", addr_str)
             raise Exception("No devices found, try again later")
         else:
             try:
                 logging.info(f"Device found, trying to connect with {addr_str}")
-                eel.putRLog(f"ble_interface.py: Device found, trying to connect with {addr_str}")
+                logRelay.put(f"ble_interface.py: Device found, trying to connect with {addr_str}")
+                # The BLEDevice from the scan is used, an address would make BleakClient scan for the device again
                 self.dev = BleakClient(
-                    addr_str, timeout=bleTimeout ,adapter=adapter, address_type=addr_type, disconnected_callback=self.handle_disconnect
+                    device, timeout=bleTimeout ,adapter=adapter, address_type=addr_type, disconnected_callback=self.handle_disconnect
                 )
                 # self.dev = BleakClient(addr_str, disconnected_callback=self.handle_disconnect)
                 #await self.dev.connect()
@@ -119,28 +145,60 @@ class BLE_interface:
                         break  # Exit loop if connection is successful
                     except Exception as e:
                         logging.warning(f"Attempt {attempt} to connect failed: {e}")
-                        eel.putRLog(f"ble_interface.py: Attempt {attempt} to connect failed: {e}")
+                        logRelay.put(f"ble_interface.py: Attempt {attempt} to connect failed: {e}")
                         if attempt == max_retries:
                             raise  # Re-raise exception if all attempts fail
+                        if fromCache:
+                            # The cached device may be unknown to the adapter by now, scan for it once
+                            fromCache = False
+                            happObserver.forget(addr_str)
+                            scanned = await self.scan_for_device(addr_str)
+                            if scanned is not None:
+                                self._bleDevice = scanned
+                                self.dev = BleakClient(
+                                    scanned, timeout=bleTimeout, adapter=adapter, address_type=addr_type,
+                                    disconnected_callback=self.handle_disconnect
+                                )
                         await asyncio.sleep(1)  # Wait before retrying
-                sessionData.connectedDeviceMac = str(self.dev.address)
-                sessionData.connectStatusCode = 1 # Indicates that a device is connected successfully
                 logging.info(f"Device {self.dev.address} connected")
-                eel.putRLog(f"ble_interface.py: Device {self.dev.address} connected")
-                eel.changeConnectStatus(self.dev.address, True)
+                logRelay.put(f"ble_interface.py: Device {self.dev.address} connected")
+                # The GUI keeps showing the device it shows until that one disconnects, 0x19 reports every session
+                if sessionData.is_current_device(addr_str):
+                    sessionData.connectedDeviceMac = str(self.dev.address)
+                    sessionData.connectStatusCode = 1 # Indicates that a device is connected successfully
+                    eel.changeConnectStatus(self.dev.address, True)
                 self._ITS_cb("Connected: YES", addr_str)
-                self.write_char = self.find_char(write_uuid, "write-without-response")
-                self.read_char = self.find_char(read_uuid, "notify")
-                self._bletoudp = BleToUdpPayload.BleToUdpPayload()
+                self.resolve_chars()
+                await self.update_mtu()
+                self.reset_reassembly()
                 await self.dev.start_notify(self.read_char, self.handle_notify)
                 self._connected = True
 
             except Exception as e:
+                gattCache.invalidate(addr_str)
                 logging.warning(e)
-                eel.changeConnectStatus(e)
-                sessionData.connectStatusCode = 4
+                if sessionData.is_current_device(addr_str):
+                    eel.changeConnectStatus(e)
+                    sessionData.connectStatusCode = 4
                 pass
 
+    async def scan_for_device(self, addr_str):
+        logging.info(f"Searching for {addr_str}")
+
+        MAX_SCAN_RETRIES = 3
+        SCAN_TIMEOUT = 15  # Shorter search time per scan, e.g., 15 seconds
+
+        device = None
+        for attempt in range(1, MAX_SCAN_RETRIES + 1):
+            logging.info(f"Scan attempt {attempt} for {addr_str}")
+            device = await BleakScanner.find_device_by_address(addr_str, SCAN_TIMEOUT)
+
+            if device is not None:
+                break  # Found the device, no need to retry
+            else:
+                logging.warning(f"Attempt {attempt}: Device not found.")
+        return device
+
     def find_char(self, uuid: Optional[str], req_prop: str) -> BleakGATTCharacteristic:
         found_char = None
 
@@ -161,29 +219,119 @@ class BLE_interface:
 
         return found_char
 
-    def set_receiver(self, callback):
-        self._cb = callback
-        logging.info("BLE Receiver set up")
+    # Receiver of the frames with the packet header, frames with a header without receiver are dropped
+    def set_receiver(self, callback, header=REMOTE_DTLS_HEADER):
+        if self._receivers is None:
+            self._receivers = {}
+        self._receivers[header] = callback
+        logging.info(f"BLE Receiver set up for packet header {header}")
 
+    def set_trace(self, trace):
+        self._trace = trace
+
+    def reset_reassembly(self):
+        self._bletoudp = BleToUdpPayload.RingBufferReassembler()
+
+    # Callback that gets the ATT MTU every time a connection is (re)established
+    def set_mtu_receiver(self, callback):
+        self._mtu_cb = callback
+
+    async def update_mtu(self):
+        # BlueZ only reports the negotiated MTU after it has been acquired, otherwise mtu_size is the default 23
+        if sys.platform == "linux" and hasattr(self.dev._backend, "_acquire_mtu"):
+            try:
+                await self.dev._backend._acquire_mtu()
+            except Exception as e:
+                logging.debug(f"Could not acquire MTU: {e}")
+
+        self.mtu = max(ATT_MTU_MIN, min(self.dev.mtu_size, bleMaxMtu))
+        logging.info(f"Using ATT MTU {self.mtu} (negotiated {self.dev.mtu_size}, max {bleMaxMtu})")
+        if getattr(self, "_mtu_cb", None):
+            self._mtu_cb(self.mtu)
+
+    # Each queue item holds all BLE fragments of one UDP datagram. Fragments already waiting in the queue are written
+    # as one batch, with up to bleWriteWindow writes in flight. Writes are issued in queue order, so the fragments
+    # reach the device in order.
     async def send_loop(self):
-        assert hasattr(self, "_cb"), "Callback must be set before receive loop!"
-        while True:
-            data = await self._send_queue.get()
-            if data == None:
-                logging.debug(f"Break BLE Send Loop")
-                break  # Let the future end on shutdown
-            logging.debug(f"Write BLE: ({len(data)}) {data}")
-            eel.putRLog(f"ble_interface.py: Write BLE: ({len(data)})")
-            await self.dev.write_gatt_char(self.write_char, data)
+        assert self._receivers, "Callback must be set before receive loop!"
+        window = asyncio.Semaphore(bleWriteWindow)
+        inFlight = set()
+        stop = False
+        while not stop:
+            fragments = await self._send_queue.get()
+            if fragments == None:
+                break
+            batch = [fragments]
+            while not self._send_queue.empty():
+                fragments = self._send_queue.get_nowait()
+                if fragments == None:
+                    stop = True
+                    break
+                batch.append(fragments)
+
+            length = sum(len(fragment) for fragments in batch for fragment in fragments)
+            count = sum(len(fragments) for fragments in batch)
+            logging.debug(f"Write BLE: ({length}) {len(batch)} datagram(s) in {count} fragment(s)")
+            logRelay.put(f"ble_interface.py: Write BLE: ({length})")
+            for fragments in batch:
+                for fragment in fragments:
+                    await window.acquire()
+                    task = asyncio.ensure_future(self.write_fragment(fragment, window))
+                    inFlight.add(task)
+                    task.add_done_callback(inFlight.discard)
+                if self._trace is not None:
+                    self._trace.end(DOWNLINK, fragments)
+
+        logging.debug(f"Break BLE Send Loop")
+        if inFlight:
+            await asyncio.gather(*inFlight, return_exceptions=True)  # Let the future end on shutdown
+
+    async def write_fragment(self, fragment, window):
+        stats = self.writeStats
+        if self.autoReconnectInProgress:  # The old link is gone, the DTLS side retransmits what is lost here
+            stats["dropped"] += 1
+            window.release()
+            return
+        stats["inFlight"] += 1
+        stats["maxInFlight"] = max(stats["maxInFlight"], stats["inFlight"])
+        start = time.perf_counter()
+        try:
+            await self.dev.write_gatt_char(self.write_char, fragment, response=False)
+            latency = (time.perf_counter() - start) * 1000
+            stats["writes"] += 1
+            stats["bytes"] += len(fragment)
+            stats["lastLatencyMs"] = latency
+            stats["maxLatencyMs"] = max(stats["maxLatencyMs"], latency)
+            stats["totalLatencyMs"] += latency
+        except Exception as e:
+            stats["errors"] += 1
+            logging.warning(f"BLE write failed: {e}")
+        finally:
+            stats["inFlight"] -= 1
+            window.release()
+
+    def reset_write_stats(self):
+        self.writeStats = {"writes": 0, "bytes": 0, "errors": 0, "dropped": 0, "inFlight": 0, "maxInFlight": 0,
+                           "lastLatencyMs": 0.0, "maxLatencyMs": 0.0, "totalLatencyMs": 0.0}
+
+    def get_reconnect_stats(self):
+        stats = dict(self.reconnectStats)
+        stats["inProgress"] = self.autoReconnectInProgress
+        return stats
+
+    def get_write_stats(self):
+        stats = dict(self.writeStats)
+        stats["queueDepth"] = self._send_queue.qsize()
+        stats["window"] = bleWriteWindow
+        stats["avgLatencyMs"] = stats["totalLatencyMs"] / stats["writes"] if stats["writes"] else 0.0
+        return stats
 
     def stop_loop(self):
         logging.info("Stopping Bluetooth event loop")
         self.requestedDisconnect = True
-        self._send_queue.put_nowait(None)
+        self._send_queue.put_stop()
 
     async def disconnect(self):
-        # Wait for the disconnect event
-        await asyncio.sleep(5)
         if hasattr(self, "dev"):
 
             if self.dev.is_connected and self._connected:
@@ -205,18 +353,22 @@ class BLE_interface:
                         await task
                     except asyncio.CancelledError:
                         logging.debug("A pending task in disconnect was cancelled")
+                current = sessionData.is_current_device(self._addr_str)
                 for task in done:
                     if task == disconnectTask:
                         logging.debug("BLE device disconnected correctly")
-                        sessionData.connectStatusCode = 2
+                        if current:
+                            sessionData.connectStatusCode = 2
                     elif task == triggerContinueTask:
                         logging.debug("BLE device disconnected unsafely")
-                        sessionData.connectStatusCode = 4
+                        if current:
+                            sessionData.connectStatusCode = 4
                 self._connected = False
                 logging.info("Bluetooth disconnected")
-                eel.putRLog(f"ble_interface.py: Bluetooth disconnected")
-                eel.changeConnectStatus("Disconnected")
-                clearDeviceData()
+                logRelay.put(f"ble_interface.py: Bluetooth disconnected")
+                if current:
+                    eel.changeConnectStatus("Disconnected")
+                    clearDeviceData()
 
     # Continue with the disconnection process
     async def triggerContinue(self):
@@ -225,42 +377,34 @@ class BLE_interface:
                 return
             await asyncio.sleep(1)
 
-    def queue_send(self, data: bytes):
+    def queue_send(self, data: list):
         # logging.debug('queue_send')
-        self._send_queue.put_nowait(data)
+        if self._trace is not None:
+            self._trace.stamp(DOWNLINK, data)
+        if not self._send_queue.offer(data):
+            logging.debug(f"Downlink queue full, dropped UDP message")
 
     def handle_notify(self, handle: int, data: bytes):
         logging.debug(f"Received BLE: ({len(data)})  {data}")
-        eel.putRLog(f"ble_interface.py: Received BLE: ({len(data)})")
-
-        udpmessage = self._bletoudp.Convert(data)  # {Payload , Type}
-        logging.debug(f"Buffer Size: {len(self._bletoudp.messageBuffer)}")
-
-        # Handle the first (or only) UDP message
-        if not (udpmessage is None) and (udpmessage[1] == 3):  # Remote Server
-            self._cb(udpmessage[0])
-            logging.debug(f"To Remote Server")
-        elif not (udpmessage is None) and (udpmessage[1] == 2):  # Local Server
-            logging.debug(f"To Local Server, FG")
-
-        # If message in buffer - Used for handling a combined message
-        run = True # Used for debug
-        if len(self._bletoudp.messageBuffer) != 0 and run and self._bletoudp.HasCompleteMessageInBuffer():
-            # Old HAPP devices with smaller data packages only need this:
-            # self._cb(bytearray(self._bletoudp.messageBuffer))
-
-            # Newer HAPP devices and advertisement structure needs split UDP messages during registration (might also
-            # be other packages), but this will also work for the rest of all messages for all devices (But unsure if
-            # the client is concatenating these)
-            logging.debug(f"Sending split buffer msg: {self._bletoudp.messageBuffer}")
-            msg1 = bytearray(self._bletoudp.messageBuffer[4: 18])
-            #logging.debug(f"First message in buffer: {msg1}")
-            self._cb(msg1)
-
-            # Send next message in buffer
-            msg2 = bytearray(self._bletoudp.messageBuffer[22:])
-            #logging.debug(f"Second message in buffer: {msg2}")
-            self._cb(msg2)
+        logRelay.put(f"ble_interface.py: Received BLE: ({len(data)})")
+
+        trace = self._trace
+        if trace is not None:
+            notified = time.monotonic_ns()
+
+        # Every complete frame in the notification, {Payload , Type}. The payload is a view of the reassembly buffer
+        # so it is copied once when handed over to the UDP queue
+        for payload, packetHeader in self._bletoudp.Convert(data):
+            receiver = self._receivers.get(packetHeader)
+            if receiver is None:
+                logging.debug(f"No receiver for packet header {packetHeader}, frame dropped")
+                continue
+            message = bytes(payload)
+            if trace is not None:
+                trace.begin(UPLINK, message, notified, time.monotonic_ns())
+            receiver(message)
+            logging.debug(f"To packet header {packetHeader} receiver")
+        logging.debug(f"Buffer Size: {self._bletoudp.Pending()}")
 
     # Alexander Ström 2024-07-19
     # problem with reconnecting on windows because of winrt. Might fix in future bleak and
@@ -269,28 +413,129 @@ class BLE_interface:
     def handle_disconnect(self, client: BleakClient):
         if self._connected and not self.autoReconnectInProgress:
             logging.warning(f"Device {client.address} disconnected")
-            eel.putRLog(f"ble_interface.py: Device {client.address} disconnected")
-            if sessionData.deviceConnectedToLeshan == "False":
-                sessionData.connectStatusCode = 6
-                eel.changeConnectStatus("Connection lost, failed to register to Leshan!")
-            else:
-                sessionData.connectStatusCode = 5
-                eel.changeConnectStatus("Connection lost")
+            logRelay.put(f"ble_interface.py: Device {client.address} disconnected")
+            if sessionData.is_current_device(self._addr_str):
+                if sessionData.deviceConnectedToLeshan == "False":
+                    sessionData.connectStatusCode = 6
+                    eel.changeConnectStatus("Connection lost, failed to register to Leshan!")
+                else:
+                    sessionData.connectStatusCode = 5
+                    eel.changeConnectStatus("Connection lost")
 
-            clearDeviceData()
+                clearDeviceData()
+            self.reconnectStats["disconnects"] += 1
             logging.debug(f"Auto reconnect is {self._autoreconnect}")
-            if sys.platform == "win32" and self._autoreconnect:
+            if sys.platform != "win32" and self._autoreconnect and not self.requestedDisconnect:
+                # The gateway, its UDP socket and source port stay, so the server keeps seeing the same peer
+                logging.debug(f"Auto reconnect starting")
+                logRelay.put("ble_interface.py: Auto reconnect starting")
+                self.autoReconnectInProgress = True
+                self._connected = False
+                asyncio.ensure_future(self.reconnect(self._addr_str))
+            elif sys.platform == "win32" and self._autoreconnect:
                 logging.debug(f"Auto reconnect workaround on Windows starting")
-                eel.putRLog("ble_interface.py: Auto reconnect workaround on Windows starting")
+                logRelay.put("ble_interface.py: Auto reconnect workaround on Windows starting")
                 self.autoReconnectInProgress = True
                 asyncio.ensure_future(self.do_reconnect(self._addr_str))
             else:
                 logging.debug("Auto reconnect inactive or unsupported")
-                eel.putRLog("ble_interface.py: Auto reconnect inactive or unsupported")
+                logRelay.put("ble_interface.py: Auto reconnect inactive or unsupported")
                 self._connected = False
                 self._ITS_cb("BT Disconnected", client.address)
                 raise BleakError(f"{client.address} disconnected!")
 
+    # Reconnects to the known BLEDevice with exponential backoff, the device is only scanned for if that fails
+    async def reconnect(self, address: str):
+        started = time.perf_counter()
+        device = self._bleDevice
+        delay = reconnectDelay
+        attempt = 0
+        while reconnectAttempts <= 0 or attempt < reconnectAttempts:
+            attempt += 1
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, reconnectMaxDelay)
+            if self.requestedDisconnect:
+                self.autoReconnectInProgress = False
+                return
+
+            self.reconnectStats["attempts"] += 1
+            logging.info(f"Reconnect attempt {attempt} for {address}")
+            logRelay.put(f"ble_interface.py: Reconnect attempt {attempt} for {address}")
+            try:
+                if device is None:
+                    device = happObserver.cached_device(address)
+                if device is None:
+                    device = await BleakScanner.find_device_by_address(address, timeout=RECONNECT_SCAN_TIMEOUT)
+                if device is None:
+                    logging.warning("Device not found during reconnect scan")
+                    continue
+
+                client = BleakClient(
+                    device,
+                    timeout=bleTimeout,
+                    adapter=self._adapter,
+                    address_type=self._addr_type,
+                    disconnected_callback=self.handle_disconnect
+                )
+                await client.connect()
+                if self.requestedDisconnect:
+                    await client.disconnect()
+                    self.autoReconnectInProgress = False
+                    return
+
+                self.dev = client
+                self._bleDevice = device
+                self.reset_reassembly()  # Drop a frame cut off by the disconnect
+                self.resolve_chars()
+                await self.update_mtu()
+                await self.dev.start_notify(self.read_char, self.handle_notify)
+
+                elapsed = (time.perf_counter() - started) * 1000
+                stats = self.reconnectStats
+                stats["reconnects"] += 1
+                stats["lastReconnectMs"] = elapsed
+                stats["maxReconnectMs"] = max(stats["maxReconnectMs"], elapsed)
+                self._connected = True
+                self.autoReconnectInProgress = False
+                if sessionData.is_current_device(address):
+                    sessionData.connectedDeviceMac = address
+                    sessionData.connectStatusCode = 1
+                    eel.changeConnectStatus(address, True)
+                logging.info(f"Auto reconnect succeeded after {elapsed:.0f} ms")
+                logRelay.put(f"ble_interface.py: Auto reconnect succeeded after {elapsed:.0f} ms")
+                return
+
+            except Exception as e:
+                gattCache.invalidate(address)
+                logging.warning(f"Reconnect attempt {attempt} failed: {e}")
+                logRelay.put(f"ble_interface.py: Reconnect attempt {attempt} failed: {e}")
+                device = None  # The adapter may have forgotten the device, look it up again
+
+        logging.warning("Auto reconnect failed after all attempts")
+        logRelay.put("ble_interface.py: Auto reconnect failed after all attempts")
+        self.reconnectStats["failures"] += 1
+        self._connected = False
+        self.autoReconnectInProgress = False
+        self._ITS_cb("BT Disconnected", address)
+        raise BleakError(f"{address} disconnected!")
+
+    # Characteristics of the connection, looked up by the handles of the previous connection or the GATT cache
+    # before all services are searched by UUID
+    def resolve_chars(self):
+        cached = gattCache.get(self._addr_str)
+        chars = {}
+        for name, uuid, req_prop in (("write", self._write_uuid, "write-without-response"),
+                                     ("read", self._read_uuid, "notify")):
+            known = getattr(self, f"{name}_char", None)
+            handle = known.handle if known is not None else cached.get(name, {}).get("handle")
+            char = self.dev.services.get_characteristic(handle) if handle is not None else None
+            if char is None or char.uuid not in uuid or req_prop not in char.properties:
+                char = self.find_char(uuid, req_prop)
+            chars[name] = char
+        self.write_char = chars["write"]
+        self.read_char = chars["read"]
+        gattCache.put(self._addr_str, chars)
+
     async def do_reconnect(self, address: str):
         MAX_RETRIES = 5
         DELAY = 10
@@ -299,9 +544,11 @@ class BLE_interface:
                 return
 
             logging.info(f"Reconnect attempt {attempt} for {address}")
-            eel.putRLog(f"ble_interface.py: Reconnect attempt {attempt} for {address}")
+            logRelay.put(f"ble_interface.py: Reconnect attempt {attempt} for {address}")
             try:
-                device = await BleakScanner.find_device_by_address(address, timeout=30.0)
+                device = happObserver.cached_device(address)
+                if device is None:
+                    device = await BleakScanner.find_device_by_address(address, timeout=30.0)
                 if not device:
                     logging.warning("Device not found during reconnect scan")
                     await asyncio.sleep(DELAY)
@@ -316,26 +563,29 @@ class BLE_interface:
                 await new_client.connect(timeout=20)
 
                 self.dev = new_client
-                self.write_char = self.find_char(self._write_uuid, "write-without-response")
-                self.read_char = self.find_char(self._read_uuid, "notify")
+                self.reset_reassembly()  # Drop a frame cut off by the disconnect
+                self.resolve_chars()
+                await self.update_mtu()
 
                 await self.dev.start_notify(self.read_char, self.handle_notify)
 
                 self._connected = True
                 self.autoReconnectInProgress = False
-                sessionData.connectedDeviceMac = address
-                eel.changeConnectStatus(address, True)
+                if sessionData.is_current_device(address):
+                    sessionData.connectedDeviceMac = address
+                    eel.changeConnectStatus(address, True)
                 logging.info(f"Auto reconnect succeeded")
-                eel.putRLog("ble_interface.py: Auto reconnect succeeded")
+                logRelay.put("ble_interface.py: Auto reconnect succeeded")
                 return
 
             except Exception as e:
+                gattCache.invalidate(address)
                 logging.warning(f"Reconnect attempt {attempt} failed: {e}")
-                eel.putRLog(f"ble_interface.py: Reconnect attempt {attempt} failed: {e}")
+                logRelay.put(f"ble_interface.py: Reconnect attempt {attempt} failed: {e}")
                 await asyncio.sleep(DELAY)
 
         logging.warning("Auto reconnect failed after all attempts")
-        eel.putRLog("ble_interface.py: Auto reconnect failed after all attempts")
+        logRelay.put("ble_interface.py: Auto reconnect failed after all attempts")
         self._connected = False
         self.autoReconnectInProgress = False
         self._ITS_cb("BT Disconnected", address)
@@ -0,0 +1,99 @@
+# Description: Bounded queue with drop policy
+# Author: Syncore Technologies AB
+#
+# asyncio.Queue with a size limit for the gateway data path. Producers are BLE and UDP callbacks that can not wait,
+# so offer() applies a policy when the queue is full instead of raising QueueFull. With the block policy the items
+# that do not fit are parked in order and moved into the queue as the consumer makes room. At most maxsize items are
+# parked, the ones after that are dropped, so a stalled consumer can not make the queue grow without bound.
+# -----------------------------------------------------------------
+import asyncio
+import collections
+import configparser
+import logging
+
+# Policies
+BLOCK = "block"  # Park the item until the consumer makes room (nothing is lost unless the parking is full too)
+DROP_OLDEST = "drop-oldest"  # Drop the item that has waited longest, e.g. a stale DTLS retransmit
+DROP_NEWEST = "drop-newest"  # Drop the incoming item
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+queuePolicy = config.get("GATEWAY", "Queue policy", fallback=DROP_OLDEST)
+if queuePolicy not in POLICIES:
+    logging.warning(f"Unknown queue policy {queuePolicy}, using {DROP_OLDEST}")
+    queuePolicy = DROP_OLDEST
+
+# Size 0 means unbounded
+queueSizes = {
+    "uplink": int(config.get("GATEWAY", "Uplink queue size", fallback="64")),  # BLE -> UDP
+    "downlink": int(config.get("GATEWAY", "Downlink queue size", fallback="64")),  # UDP -> BLE
+}
+
+
+class BoundedQueue(asyncio.Queue):
+    def __init__(self, maxsize=0, policy=DROP_OLDEST):
+        super().__init__(maxsize)
+        self.policy = policy
+        self.enqueued = 0
+        self.dropped = 0
+        self.highWater = 0
+        self._parked = collections.deque()  # Items waiting for room with the block policy
+        self._stopped = False  # Set by put_stop(), the stop marker may not be evicted by later items
+
+    @classmethod
+    def from_config(cls, direction):
+        return cls(queueSizes[direction], queuePolicy)
+
+    def _put(self, item):
+        super()._put(item)
+        if item is not None:
+            self.enqueued += 1
+            self.highWater = max(self.highWater, self.qsize())
+
+    # Non blocking put for callbacks, returns False if the item was dropped
+    def offer(self, item):
+        if self._stopped:
+            # The consumer stops at the marker, so everything after it is dropped
+            self.dropped += 1
+            return False
+        if self.policy == BLOCK and (self.full() or self._parked):
+            # Parked items are put in order, so a new item may not pass them
+            if len(self._parked) >= max(self.maxsize, 1):
+                self.dropped += 1
+                return False
+            self._parked.append(item)
+            return True
+        if self.full():
+            if self.policy == DROP_NEWEST:
+                self.dropped += 1
+                return False
+            self.get_nowait()
+            self.dropped += 1
+        self.put_nowait(item)
+        return True
+
+    # Every get makes room for the oldest parked item
+    def get_nowait(self):
+        item = super().get_nowait()
+        if self._parked:
+            self.put_nowait(self._parked.popleft())
+        return item
+
+    # The stop marker (None) must always get in, so make room for it on a full queue. Parked items are dropped, the
+    # consumer stops at the marker.
+    def put_stop(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        self.dropped += len(self._parked)
+        self._parked.clear()
+        if self.full():
+            self.get_nowait()
+            self.dropped += 1
+        self.put_nowait(None)
+
+    def stats(self):
+        return {"size": self.qsize(), "maxsize": self.maxsize, "policy": self.policy, "enqueued": self.enqueued,
+                "dropped": self.dropped, "highWater": self.highWater, "parked": len(self._parked)}
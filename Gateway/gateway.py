@@ -9,6 +9,7 @@
 
 import argparse
 import asyncio
+import configparser
 import logging
 import sys
 import time
@@ -19,6 +20,7 @@ import os
 import functools
 from webserver import clearDeviceData, getDeviceAlias
 from SessionData import sessionData
+from LogRelay import logRelay
 
 sys.path.append(os.path.dirname(__file__))
 
@@ -26,9 +28,45 @@ from bleak.exc import BleakError
 from ble_interface import BLE_interface
 from log.console_log import setup_logger
 from log.fs_log import FS_log, Direction
-from ports.udp_interface import UDP
+from log.pcap_log import PCAP_log
+from latency_trace import LatencyTrace, latencyTracing
+from ports.udp_interface import UDP, REMOTE_DTLS_HEADER
+from ports.udp_datagram_interface import UDPDatagram
+import ConverterUtils
 import eel
 
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+# UDP port implementation, "datagram" (asyncio datagram endpoint) or "selector" (add_reader on a plain socket)
+UDP_INTERFACES = {"datagram": UDPDatagram, "selector": UDP}
+udpInterface = config.get("GATEWAY", "UDP interface", fallback="datagram")
+
+# Capture of the gateway traffic, "off", "text" (FS_log) or "pcap" (PCAP_log)
+trafficCapture = config.get("GATEWAY", "Traffic capture", fallback="off")
+captureFolder = config.get("GATEWAY", "Capture folder", fallback="capture")
+captureFileSize = int(config.get("GATEWAY", "Capture file size", fallback="50")) * 1024 * 1024
+
+
+# "host:port" of a route, None for False or empty
+def route_destination(value):
+    if value.strip() in ("", "False"):
+        return None
+    host, _, port = value.strip().rpartition(":")
+    return host, int(port)
+
+
+# UDP destination of the frames with each packet header, a header without destination is dropped. Remote and DTLS
+# frames go to the server the gateway is started with unless a destination is configured
+HEADER_ROUTES = {
+    ConverterUtils.ToPacketHeader(ConverterUtils.REMOTE, ConverterUtils.DTLS): "Remote DTLS server",
+    ConverterUtils.ToPacketHeader(ConverterUtils.REMOTE, ConverterUtils.UNENCRYPTED): "Remote server",
+    ConverterUtils.ToPacketHeader(ConverterUtils.LOCAL, ConverterUtils.DTLS): "Local DTLS server",
+    ConverterUtils.ToPacketHeader(ConverterUtils.LOCAL, ConverterUtils.UNENCRYPTED): "Local server",
+}
+headerRoutes = {header: route_destination(config.get("GATEWAY", key, fallback=""))
+                for header, key in HEADER_ROUTES.items()}
+
 
 # Debug Callback
 def the_callback(text, mac):
@@ -50,6 +88,7 @@ class Main:
             timeout,
             autoreconnect,
             running,
+            managed=False,
     ):
 
         self._autoreconnect = autoreconnect
@@ -64,6 +103,9 @@ class Main:
         self._callbackfunc = callbackfunc
         self._timeout = timeout
         self._callstop = running
+        # A managed gateway shares its event loop with other gateways (see gateway_manager.py), so the loop wide
+        # exception handler is owned by the manager instead
+        self._managed = managed
 
     def start(
             self,
@@ -76,8 +118,13 @@ class Main:
 
     async def _run(self):
         self.excpWinrtEvent = asyncio.Event()
+        self._stopRequested = asyncio.Event()
         loop = asyncio.get_event_loop()
-        loop.set_exception_handler(self.excp_handler)
+        self._loop = loop
+        if self._callstop.is_set():  # Stop requested before the loop was known
+            self._stopRequested.set()
+        if not self._managed:
+            loop.set_exception_handler(self.excp_handler)
 
         # Thread is now used instead of multiprocessing:
         # if sys.platform != 'win32':
@@ -90,6 +137,8 @@ class Main:
         mtu = 20
         dest_ip = self._server_address
         dest_port = self._server_port
+        if headerRoutes[REMOTE_DTLS_HEADER] is not None:
+            dest_ip, dest_port = headerRoutes[REMOTE_DTLS_HEADER]
 
         if dest_ip == "127.0.0.1":
             source_ip = "127.0.0.1"
@@ -104,15 +153,30 @@ class Main:
         adapter = "hci0"
         write_uuid = "98bd0002-0b0e-421a-84e5-ddbf75dc6de4"
         read_uuid = "98bd0003-0b0e-421a-84e5-ddbf75dc6de4"
-        filename = datetime.datetime.now().strftime("%Y%m%d-%H%M%S.log")
-        filename = None
-        binlog = True
+        filename = device.replace(":", "") + datetime.datetime.now().strftime("_%Y%m%d-%H%M%S")
+        binlog = False  # Hex, so a text capture can be replayed (replay.py)
 
         try:
-            self.udp = UDP(loop, mtu, dest_ip, dest_port, source_ip, source_port)
+            self.udp = UDP_INTERFACES.get(udpInterface, UDPDatagram)(loop, mtu, dest_ip, dest_port, source_ip,
+                                                                     source_port)
+            # A UDP port of its own for every other routed packet header, so downlink frames get the header of the
+            # port they arrive on
+            self.routes = {REMOTE_DTLS_HEADER: self.udp}
+            for header, destination in headerRoutes.items():
+                if header != REMOTE_DTLS_HEADER and destination is not None:
+                    route_ip, route_port = destination
+                    self.routes[header] = UDP_INTERFACES.get(udpInterface, UDPDatagram)(
+                        loop, mtu, route_ip, route_port, "127.0.0.1" if route_ip == "127.0.0.1" else "0.0.0.0",
+                        source_port, header)
             self.bt = BLE_interface()
-            if filename:
-                self.log = FS_log(filename, binlog)
+            if trafficCapture in ("text", "pcap"):
+                os.makedirs(captureFolder, exist_ok=True)
+                if trafficCapture == "pcap":
+                    self.log = PCAP_log(os.path.join(captureFolder, filename), device,
+                                        self.udp._socket.getsockname()[1], self.udp._send_to_address,
+                                        captureFileSize)
+                else:
+                    self.log = FS_log(os.path.join(captureFolder, filename + ".log"), binlog)
                 self.bt.set_receiver(
                     self.log.middleware(Direction.BLE_IN, self.udp.queue_write)
                 )
@@ -122,9 +186,21 @@ class Main:
             else:
                 self.bt.set_receiver(self.udp.queue_write)
                 self.udp.set_receiver(self.bt.queue_send)
+            for header, udp in self.routes.items():  # Only the Remote and DTLS frames are captured
+                if udp is not self.udp:
+                    self.bt.set_receiver(udp.queue_write, header)
+                    udp.set_receiver(self.bt.queue_send)
+            self.bt.set_mtu_receiver(self.set_mtu)  # Fragment UDP -> BLE messages to the negotiated MTU
+            if latencyTracing:
+                self.trace = LatencyTrace()
+                self.bt.set_trace(self.trace)
+                for udp in self.routes.values():
+                    udp.set_trace(self.trace)
 
-            self.udp.start()
-            await self.bt.start(
+            for udp in self.routes.values():
+                udp.start()
+            # A stop request cancels the scan and connect instead of waiting for them
+            connecting = asyncio.ensure_future(self.bt.start(
                 device,
                 addr_type,
                 adapter,
@@ -135,23 +211,40 @@ class Main:
                 self._autoreconnect,
                 self._callstop,
                 self.excpWinrtEvent,
-            )
+            ))
+            stopping = asyncio.ensure_future(self._stopRequested.wait())
+            await asyncio.wait([connecting, stopping], return_when=asyncio.FIRST_COMPLETED)
+            stopping.cancel()
+            if not connecting.done():
+                connecting.cancel()
+                try:
+                    await connecting
+                except asyncio.CancelledError:
+                    pass
+            else:
+                connecting.result()  # Raise what made the connect fail
+
             logging.info("Running main loop!")
-            if not self.bt._connected:  # Fix else stuck if cant connect
+            if self._stopRequested.is_set():
+                logging.info("Gateway stopped before the device was connected")
+            elif not self.bt._connected:  # Fix else stuck if cant connect
                 logging.error(f"Bluetooth connection failed")
-                eel.putRLog(f"gateway.py: Bluetooth connection failed")
-                eel.changeConnectStatus("Bluetooth connection failed")  # This is only stored dynamic
-                sessionData.connectStatusCode = 4
-                clearDeviceData() # If a device was connected clear data
+                logRelay.put(f"gateway.py: Bluetooth connection failed")
+                if sessionData.is_current_device(self._device):
+                    eel.changeConnectStatus("Bluetooth connection failed")  # This is only stored dynamic
+                    sessionData.connectStatusCode = 4
+                    clearDeviceData() # If a device was connected clear data
             else:
-                self.main_loop = asyncio.gather(self.bt.send_loop(), self.udp.run_loop(), self.monitor_thread())
+                self.main_loop = asyncio.gather(self.bt.send_loop(), self.monitor_thread(),
+                                                *(udp.run_loop() for udp in self.routes.values()))
                 await self.main_loop
 
         except BleakError as e:
             logging.error(f"Bluetooth connection failed: {e}")
-            eel.changeConnectStatus("Bluetooth connection failed")
-            sessionData.connectStatusCode = 4
-            clearDeviceData()  # If a device was connected clear data
+            if sessionData.is_current_device(self._device):
+                eel.changeConnectStatus("Bluetooth connection failed")
+                sessionData.connectStatusCode = 4
+                clearDeviceData()  # If a device was connected clear data
         ### KeyboardInterrupts are now received on asyncio.run()
         # except KeyboardInterrupt:
         #     logging.info('Keyboard interrupt received')
@@ -160,10 +253,11 @@ class Main:
             # traceback.print_exc()
         finally:
             logging.warning("Shutdown initiated")
-            clearDeviceData()
+            if sessionData.is_current_device(self._device):
+                clearDeviceData()
             # eel.changeConnectStatus("Gateway closed")
-            if hasattr(self, "uart"):
-                self.udp.remove()
+            for udp in getattr(self, "routes", {}).values():
+                udp.remove()
             if hasattr(self, "bt"):
                 await self.bt.disconnect()
             if hasattr(self, "log"):
@@ -185,25 +279,59 @@ class Main:
         # If disconnect in ble_interface.py is not used but disconnected correclty, but the device still disconnected handle that
         elif "disconnected" in str(context["exception"] and sessionData.connectStatusCode not in importantCodes):
             logging.info("Bluetooth disconnected")
-            eel.putRLog(f"gateway.py: Bluetooth disconnected")
-            eel.changeConnectStatus("Disconnected")
-            clearDeviceData()
-            sessionData.connectStatusCode = 2
-        self.udp.stop_loop()
-        self.bt.stop_loop()
+            logRelay.put(f"gateway.py: Bluetooth disconnected")
+            if sessionData.is_current_device(self._device):
+                eel.changeConnectStatus("Disconnected")
+                clearDeviceData()
+                sessionData.connectStatusCode = 2
+        for udp in getattr(self, "routes", {}).values():
+            udp.stop_loop()
+        if hasattr(self, "bt"):
+            self.bt.stop_loop()
+
+    # Queue, BLE write and reconnect counters for this gateway
+    def stats(self):
+        stats = {}
+        if hasattr(self, "udp"):
+            stats["uplink"] = self.udp._send_queue.stats()
+        for header, udp in getattr(self, "routes", {}).items():
+            if udp is not self.udp:
+                stats.setdefault("routes", {})[HEADER_ROUTES[header]] = udp._send_queue.stats()
+        if hasattr(self, "bt") and hasattr(self.bt, "_send_queue"):
+            stats["downlink"] = self.bt._send_queue.stats()
+            stats["bleWrites"] = self.bt.get_write_stats()
+        if hasattr(self, "bt") and hasattr(self.bt, "reconnectStats"):
+            stats["reconnect"] = self.bt.get_reconnect_stats()
+        return stats
+
+    def set_mtu(self, mtu):
+        for udp in self.routes.values():
+            udp.set_mtu(mtu)
+
+    # Latency percentiles per direction, None when latency tracing is off
+    def latency(self):
+        if hasattr(self, "trace"):
+            return self.trace.stats()
+        return None
 
     def ask_exit(self, signame):
         logging.warning(f"{signame} Shutdown initiated")
         raise Exception("SIGTERM Shutdown initiated")
 
-    # Makes it possible for the main thread to terminate gateway
+    # Makes it possible for another thread to terminate the gateway, the loop is woken as soon as the stop is requested
+    def request_stop(self):
+        self._callstop.set()
+        loop = getattr(self, "_loop", None)
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._stopRequested.set)
+
     async def monitor_thread(self):
-        while not self._callstop.is_set():
-            await asyncio.sleep(0.5)
-        self.udp.stop_loop()
+        await self._stopRequested.wait()
+        for udp in self.routes.values():
+            udp.stop_loop()
         self.bt.stop_loop()
         logging.warning(f"SIGTERM or shutdown received, Shutdown initiated")
-        eel.putRLog("gateway.py: SIGTERM or shutdown received, Shutdown initiated")
+        logRelay.put("gateway.py: SIGTERM or shutdown received, Shutdown initiated")
         # raise Exception("SIGTERM received, Shutdown initiated")
 
 
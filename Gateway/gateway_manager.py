@@ -0,0 +1,217 @@
+# Description: Gateway Manager
+# Author: Syncore Technologies AB
+#
+# Hosts several BLE <-> UDP gateways (gateway.Main) in one shared asyncio event loop, one session per BLE device
+# MAC address. The loop runs in its own thread, so the TCP command thread in app.py only schedules work on it.
+# -----------------------------------------------------------------
+
+import asyncio
+import logging
+import threading
+import time
+
+import eel
+
+from Gateway.gateway import Main
+from log.console_log import setup_logger
+from LogRelay import logRelay
+from SessionData import sessionData
+from webserver import clearDeviceData
+
+# Session states (reported by command 0x19)
+STARTING = 0
+CONNECTED = 1
+STOPPING = 2
+STOPPED = 3
+
+
+class GatewaySession:
+    def __init__(self, mac, main, stop_event):
+        self.mac = mac
+        self.main = main
+        self.stop_event = stop_event
+        self.future = None
+        self.previous = None  # Session for the same device that is still stopping when this one was started
+        self.terminated = False  # Stopped by stop() (command 0x0F), not by a failure or a restart
+        self.startTime = time.time()
+
+    def is_alive(self):
+        return self.future is not None and not self.future.done()
+
+    def state(self):
+        if not self.is_alive():
+            return STOPPED
+        if self.stop_event.is_set():
+            return STOPPING
+        bt = getattr(self.main, "bt", None)
+        if bt is not None and getattr(bt, "_connected", False):
+            return CONNECTED
+        return STARTING
+
+    def status(self):
+        return {"mac": self.mac, "state": self.state(), "uptime": int(time.time() - self.startTime)}
+
+
+class GatewayManager:
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop.set_exception_handler(self.excp_handler)
+                self._thread = threading.Thread(target=self._run_loop, name="GatewayLoop", daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        logging.debug("Gateway manager event loop started")
+        self._loop.run_forever()
+
+    # The loop is shared, so route exceptions from bleak/winrt callbacks to the gateway they belong to
+    def excp_handler(self, loop: asyncio.AbstractEventLoop, context):
+        exception = context.get("exception")
+        sessions = [s for s in self._sessions.values() if s.is_alive()]
+        if exception is None or not sessions:
+            loop.default_exception_handler(context)
+            return
+
+        owner = [s for s in sessions if s.mac.lower() in str(exception).lower()]
+        if not owner and len(sessions) == 1:
+            owner = sessions
+        if not owner:
+            logging.warning(f"Gateway exception without owning session: {exception}")
+            return
+        session = owner[0]
+        if not hasattr(session.main, "bt") and session.previous is not None and session.previous.is_alive():
+            session = session.previous  # The new session is still waiting for the old one to stop
+        session.main.excp_handler(loop, context)
+
+    def start(self, mac, addr_type, server_port, server_address, verbose, callbackfunc, timeout, autoreconnect):
+        loop = self._ensure_loop()
+
+        # Only one gateway per BLE device, a running one is stopped and the new one starts when it has finished
+        with self._lock:
+            previous = self._sessions.get(mac)
+        if previous is not None and previous.is_alive():
+            previous.main.request_stop()
+        else:
+            previous = None
+
+        stop_event = threading.Event()
+        main = Main(
+            mac,
+            addr_type,
+            "adapter",  # FG, Dummy data
+            "0",  # FG, Dummy data
+            "0",  # FG, Dummy data
+            server_port,
+            server_address,
+            verbose,
+            callbackfunc,
+            timeout,
+            autoreconnect,
+            stop_event,
+            managed=True,
+        )
+        setup_logger(verbose, True)
+
+        session = GatewaySession(mac, main, stop_event)
+        session.previous = previous
+        with self._lock:
+            self._sessions[mac] = session
+        session.future = asyncio.run_coroutine_threadsafe(self._run_session(session), loop)
+        session.future.add_done_callback(lambda future: self._session_done(session))
+        sessionData.runningGateway = True
+        logging.info(f"Gateway session for {mac} started ({self.count()} running)")
+        return session
+
+    async def _run_session(self, session):
+        if session.previous is not None:
+            try:
+                await asyncio.wrap_future(session.previous.future)
+            except Exception as e:
+                logging.debug(f"Previous gateway session for {session.mac} ended with: {e}")
+            session.previous = None
+            if session.stop_event.is_set():
+                return  # Stopped while waiting
+        await session.main._run()
+
+    def _session_done(self, session):
+        with self._lock:
+            if self._sessions.get(session.mac) is session:
+                del self._sessions[session.mac]
+        sessionData.runningGateway = self.count() > 0
+        logging.info(f"Gateway session for {session.mac} finished")
+        # The final status once the device has disconnected, the disconnect itself reports 2
+        if session.terminated and sessionData.is_current_device(session.mac):
+            logging.debug("Gateway Terminated")
+            logRelay.put(f"gateway_manager.py: Gateway Terminated")
+            eel.changeConnectStatus("Gateway Terminated")
+            sessionData.connectStatusCode = 0
+            clearDeviceData()
+
+    # Signals the gateway to stop and returns at once, unless wait is set. The gateway disconnects in the background.
+    def stop(self, mac, wait=False, timeout=None):
+        with self._lock:
+            session = self._sessions.get(mac)
+        if session is None or not session.is_alive():
+            return False
+
+        session.terminated = True
+        session.main.request_stop()  # Wakes gateway.monitor_thread which ends the session
+        if wait:
+            try:
+                session.future.result(timeout)
+            except Exception as e:
+                logging.error(f"Error terminating gateway session for {mac}: {e}")
+            logging.debug(f"Gateway session for {mac} terminated")
+        return True
+
+    def stop_all(self, wait=False, timeout=None):
+        with self._lock:
+            macs = list(self._sessions)
+        stopped = False
+        for mac in macs:
+            stopped = self.stop(mac, wait, timeout) or stopped
+        return stopped
+
+    def is_running(self, mac=None):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        if mac is not None:
+            sessions = [s for s in sessions if s.mac == mac]
+        return any(s.is_alive() for s in sessions)
+
+    def count(self):
+        with self._lock:
+            return sum(1 for s in self._sessions.values() if s.is_alive())
+
+    def status(self, mac=None):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        if mac is not None:
+            sessions = [s for s in sessions if s.mac == mac]
+        return [s.status() for s in sessions]
+
+    def stats(self, mac=None):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        if mac is not None:
+            sessions = [s for s in sessions if s.mac == mac]
+        return {s.mac: s.main.stats() for s in sessions}
+
+    def latency(self, mac=None):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        if mac is not None:
+            sessions = [s for s in sessions if s.mac == mac]
+        return {s.mac: s.main.latency() for s in sessions}
+
+
+gatewayManager = GatewayManager()
@@ -0,0 +1,72 @@
+# Description: GATT cache
+# Author: Syncore Technologies AB
+#
+# Handle, UUID and properties of the write and notify characteristics per device, stored in a JSON file
+# (config.ini [BLE] GATT cache path, off by default) so a connect in a later session looks the characteristics up by
+# handle instead of walking all services for them. bleak still runs the full service discovery in connect(), so
+# only that in-memory walk is saved, which matters little for the two HAPP characteristics. An entry is dropped when
+# a connect using it fails, and replaced when the handle no longer has the cached UUID and properties.
+# -----------------------------------------------------------------
+import configparser
+import json
+import logging
+import os
+import threading
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+gattCachePath = config.get("BLE", "GATT cache path", fallback="False")
+
+
+class GattCache:
+    def __init__(self, path=gattCachePath):
+        self._path = None if path in ("", "False") else path
+        self._lock = threading.Lock()  # Gateways started with gateway.launch() run loops in threads of their own
+        self._entries = self._load()
+
+    def _load(self):
+        if self._path is None or not os.path.exists(self._path):
+            return {}
+        try:
+            with open(self._path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"GATT cache {self._path} could not be read: {e}")
+            return {}
+
+    def _save(self):
+        try:
+            tmpPath = f"{self._path}.tmp"
+            with open(tmpPath, "w") as f:
+                json.dump(self._entries, f, indent=4)
+            os.replace(tmpPath, self._path)
+        except OSError as e:
+            logging.warning(f"GATT cache {self._path} could not be written: {e}")
+
+    # {"write": {"handle": h, "uuid": u, "properties": [...]}, "read": {...}}, empty when unknown
+    def get(self, mac):
+        with self._lock:
+            return dict(self._entries.get(mac.upper(), {}))
+
+    def put(self, mac, chars):
+        if self._path is None:
+            return
+        entry = {name: {"handle": char.handle, "uuid": char.uuid, "properties": list(char.properties)}
+                 for name, char in chars.items()}
+        with self._lock:
+            if self._entries.get(mac.upper()) == entry:
+                return
+            self._entries[mac.upper()] = entry
+            self._save()
+
+    def invalidate(self, mac):
+        if self._path is None:
+            return
+        with self._lock:
+            if self._entries.pop(mac.upper(), None) is not None:
+                logging.debug(f"GATT cache entry of {mac} dropped")
+                self._save()
+
+
+gattCache = GattCache()
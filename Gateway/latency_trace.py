@@ -0,0 +1,86 @@
+# Description: Latency trace
+# Author: Syncore Technologies AB
+#
+# Optional per-frame timing of the gateway data path (config.ini [GATEWAY] Latency tracing). Every frame is stamped
+# with time.monotonic_ns() at each stage and the time between the stages is kept in a rolling window per direction,
+# reported as p50/p95/p99 (TCP command 0x1B and the GUI).
+#
+# Uplink: BLE notification received -> frame reassembled -> queued for UDP -> sent with sendto
+# Downlink: UDP datagram received -> split into BLE fragments -> queued for BLE -> fragments written
+#
+# A frame is followed by the object passed between the stages (the UDP payload or the BLE fragment list). When
+# tracing is off the ports hold no trace at all, so the data path only pays for an "is not None" check.
+# -----------------------------------------------------------------
+import collections
+import configparser
+import time
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+latencyTracing = config.get("GATEWAY", "Latency tracing", fallback="False") == "True"
+latencyWindow = int(config.get("GATEWAY", "Latency window", fallback="1000"))
+
+UPLINK = "uplink"
+DOWNLINK = "downlink"
+STAGES = {
+    UPLINK: ("notify", "frame", "enqueue", "send"),
+    DOWNLINK: ("receive", "convert", "enqueue", "write"),
+}
+
+# Frames that never reach the last stage (dropped by a full queue) are forgotten after this many newer ones
+MAX_PENDING = 256
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class LatencyTrace:
+    def __init__(self, window=latencyWindow):
+        self._pending = {direction: collections.OrderedDict() for direction in STAGES}
+        self._samples = {}
+        for direction, stages in STAGES.items():
+            intervals = [f"{a}-{b}" for a, b in zip(stages, stages[1:])] + ["total"]
+            self._samples[direction] = {interval: collections.deque(maxlen=window) for interval in intervals}
+        self.completed = {direction: 0 for direction in STAGES}
+
+    # First two stages, the frame object only exists from the second one
+    def begin(self, direction, frame, first, second):
+        pending = self._pending[direction]
+        pending[id(frame)] = [first, second]
+        if len(pending) > MAX_PENDING:
+            pending.popitem(last=False)
+
+    def stamp(self, direction, frame):
+        stamps = self._pending[direction].get(id(frame))
+        if stamps is not None:
+            stamps.append(time.monotonic_ns())
+
+    def end(self, direction, frame):
+        stamps = self._pending[direction].pop(id(frame), None)
+        if stamps is None or len(stamps) != len(STAGES[direction]) - 1:
+            return
+        stamps.append(time.monotonic_ns())
+
+        samples = self._samples[direction]
+        stages = STAGES[direction]
+        for i in range(len(stages) - 1):
+            samples[f"{stages[i]}-{stages[i + 1]}"].append(stamps[i + 1] - stamps[i])
+        samples["total"].append(stamps[-1] - stamps[0])
+        self.completed[direction] += 1
+
+    # {direction: {"frames": n, interval: {"p50": ms, "p95": ms, "p99": ms, "max": ms}}}
+    def stats(self):
+        stats = {}
+        for direction, samples in self._samples.items():
+            stats[direction] = {"frames": self.completed[direction]}
+            for interval, values in samples.items():
+                values = sorted(values)
+                stats[direction][interval] = {
+                    f"p{p}": round(percentile(values, p) / 1e6, 3) for p in (50, 95, 99)
+                }
+                stats[direction][interval]["max"] = round(values[-1] / 1e6, 3) if values else 0.0
+        return stats
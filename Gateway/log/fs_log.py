@@ -1,4 +1,5 @@
-import logging, datetime
+import logging, datetime, queue, threading, time
+from abc import ABC, abstractmethod
 from enum import Enum
 
 
@@ -7,21 +8,72 @@ class Direction:
     BLE_OUT = "<- BLE-OUT"
 
 
-class FS_log:
-    def __init__(self, filename, binlog):
-        self.file = open(filename, "a+", buffering=1)
-        logging.info(f"Logging transfered data to {filename}")
-        self.binlog = binlog
+# The middleware only queues the message with its time, a writer thread formats everything that is waiting and
+# writes it in one go, so a capture adds no file I/O to the gateway event loop
+class QueuedLog(ABC):
+    def _start_writer(self, name):
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
 
     def middleware(self, dir: Direction, passthrough_func):
         def ret_func(data):
             passthrough_func(data)
-            t = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-            out = data.decode(errors="replace") if self.binlog else data.hex()
-            self.file.write(f"{t} {dir}: {out} \n")
+            self._queue.put((time.time_ns(), dir, data))
 
         return ret_func
 
+    def _run(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            records = []
+            while True:
+                if item is None:
+                    running = False
+                    break
+                records.append(self._record(*item))
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if records:
+                self._write(records)
+
+    # The formatted message, called by the writer thread
+    @abstractmethod
+    def _record(self, timestamp, dir, data):
+        pass
+
+    @abstractmethod
+    def _write(self, records):
+        pass
+
     def finish(self):
+        self._queue.put(None)
+        self._thread.join()
         self.file.close()
+
+
+class FS_log(QueuedLog):
+    def __init__(self, filename, binlog):
+        self.file = open(filename, "a+")
+        logging.info(f"Logging transfered data to {filename}")
+        self.binlog = binlog
+        self._start_writer(f"Capture {filename}")
+
+    def _record(self, timestamp, dir, data):
+        t = datetime.datetime.fromtimestamp(timestamp / 1e9).strftime("%Y-%m-%d %H:%M:%S.%f")
+        if isinstance(data, list):
+            data = b"".join(data)  # BLE fragments of one UDP datagram
+        out = data.decode(errors="replace") if self.binlog else data.hex()
+        return f"{t} {dir}: {out} \n"
+
+    def _write(self, records):
+        self.file.write("".join(records))
+        self.file.flush()
+
+    def finish(self):
+        super().finish()
         logging.info(f"Logfile closed")
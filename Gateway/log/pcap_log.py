@@ -0,0 +1,105 @@
+import logging, socket, struct
+from log.fs_log import Direction, QueuedLog
+
+# pcapng block types
+SECTION_HEADER_BLOCK = 0x0A0D0D0A
+INTERFACE_DESCRIPTION_BLOCK = 0x00000001
+ENHANCED_PACKET_BLOCK = 0x00000006
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+LINKTYPE_RAW = 101  # Raw IPv4, lets Wireshark decode the UDP/CoAP/DTLS inside
+OPT_IF_NAME = 2
+OPT_EPB_FLAGS = 2
+EPB_INBOUND = 1  # BLE-IN, received from the BLE device
+EPB_OUTBOUND = 2  # BLE-OUT, sent to the BLE device
+
+HQV_HEADER_SIZE = 4  # Stripped from BLE-OUT fragments, the capture holds the UDP payload
+
+
+def _block(blockType, body):
+    length = 12 + len(body)
+    return struct.pack("<II", blockType, length) + body + struct.pack("<I", length)
+
+
+def _pad(data):
+    return data + b"\x00" * (-len(data) % 4)
+
+
+def _ip_checksum(header):
+    total = sum(struct.unpack("!10H", header))
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+# Captures the messages passing the gateway as pcapng. Every message is stored as an IPv4/UDP packet between the
+# device (a 10.x.y.z address made from its MAC, on the gateway UDP source port) and the server, so Wireshark shows
+# the CoAP/DTLS sessions. The middleware only queues the message, blocks are built and written by a writer thread
+# (QueuedLog) that starts a new file when the current one reaches max_bytes.
+class PCAP_log(QueuedLog):
+    def __init__(self, basename, mac, device_port, server_address, max_bytes):
+        self.basename = basename
+        self.max_bytes = max_bytes
+        self._index = 0
+        self._mac = mac
+
+        macBytes = bytes.fromhex(mac.replace(":", ""))
+        self._device = (bytes([10]) + macBytes[-3:], int(device_port))
+        try:
+            self._server = (socket.inet_aton(server_address[0]), int(server_address[1]))
+        except OSError:
+            self._server = (bytes(4), int(server_address[1]))
+        self._ipId = 0
+
+        self._open()
+        self._start_writer(f"Capture {mac}")
+
+    def _open(self):
+        filename = f"{self.basename}_{self._index:03d}.pcapng"
+        self.file = open(filename, "wb")
+        logging.info(f"Capturing transfered data to {filename}")
+
+        shb = struct.pack("<IHHq", BYTE_ORDER_MAGIC, 1, 0, -1)
+        name = _pad(f"SBLETS {self._mac}".encode())
+        options = struct.pack("<HH", OPT_IF_NAME, len(f"SBLETS {self._mac}")) + name + struct.pack("<HH", 0, 0)
+        idb = struct.pack("<HHI", LINKTYPE_RAW, 0, 0) + options
+        self.file.write(_block(SECTION_HEADER_BLOCK, shb) + _block(INTERFACE_DESCRIPTION_BLOCK, idb))
+        self._written = self._headerSize = self.file.tell()
+
+    def _packet(self, dir, payload):
+        if dir == Direction.BLE_IN:
+            src, dst = self._device, self._server
+        else:
+            src, dst = self._server, self._device
+        self._ipId = (self._ipId + 1) & 0xFFFF
+
+        udp = struct.pack("!HHHH", src[1], dst[1], 8 + len(payload), 0)
+        ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 28 + len(payload), self._ipId, 0, 64, socket.IPPROTO_UDP, 0,
+                         src[0], dst[0])
+        ip = ip[:10] + struct.pack("!H", _ip_checksum(ip)) + ip[12:]
+        return ip + udp + payload
+
+    def _record(self, timestamp, dir, data):
+        if isinstance(data, list):
+            data = b"".join(data)[HQV_HEADER_SIZE:]  # BLE fragments of one UDP datagram
+        packet = self._packet(dir, bytes(data))
+        timestamp = timestamp // 1000  # Default resolution is microseconds
+        body = struct.pack("<IIIII", 0, timestamp >> 32, timestamp & 0xFFFFFFFF, len(packet), len(packet))
+        # The direction is also stored as a flag, so a replay does not have to guess it from the addresses
+        flags = EPB_INBOUND if dir == Direction.BLE_IN else EPB_OUTBOUND
+        options = struct.pack("<HHIHH", OPT_EPB_FLAGS, 4, flags, 0, 0)
+        return _block(ENHANCED_PACKET_BLOCK, body + _pad(packet) + options)
+
+    # Enhanced packet blocks
+    def _write(self, records):
+        blocks = b"".join(records)
+        if self._written + len(blocks) > self.max_bytes and self._written > self._headerSize:
+            self.file.close()
+            self._index += 1
+            self._open()
+        self.file.write(blocks)
+        self.file.flush()
+        self._written += len(blocks)
+
+    def finish(self):
+        super().finish()
+        logging.info(f"Capture closed")
@@ -0,0 +1,80 @@
+# Description: UDP Interface on an asyncio datagram endpoint
+# Author: Syncore Technologies AB
+#
+# Same port as udp_interface.UDP, but the socket is served by loop.create_datagram_endpoint. Every datagram
+# waiting on the socket is read per wakeup and sending is handed to the transport, so the loop never blocks on
+# sendto. Selected with "UDP interface = datagram" in config.ini [GATEWAY].
+# -----------------------------------------------------------------
+from LogRelay import logRelay
+from ports.udp_interface import UDP, UDP_RECEIVE_SIZE
+from latency_trace import UPLINK
+import asyncio
+import logging
+
+# Max datagrams read from the socket per wakeup, so a flood can not starve the BLE side of the loop
+UDP_RECEIVE_BATCH = 64
+
+
+class UDPDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, port):
+        self._port = port
+
+    def datagram_received(self, data, addr):
+        self._port.datagram_received(data)
+
+    def error_received(self, exc):
+        logging.warning(f"UDP error received: {exc}")
+
+
+class UDPDatagram(UDP):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._endpoint = None  # Task creating the datagram endpoint, from start()
+
+    def start(self):
+        assert self._cb, "Receiver must be set before start!"
+
+        self._endpoint = self.loop.create_task(
+            self.loop.create_datagram_endpoint(lambda: UDPDatagramProtocol(self), sock=self._socket)
+        )
+
+    def remove(self):
+        if self._endpoint is None:
+            # The gateway failed before the port was started
+            self._socket.close()
+        elif self._endpoint.done() and not self._endpoint.cancelled() and self._endpoint.exception() is None:
+            transport, protocol = self._endpoint.result()
+            transport.close()
+        else:
+            self._endpoint.cancel()
+            self._socket.close()
+        logging.info(f"UDP endpoint removed")
+
+    def datagram_received(self, udpmessage):
+        self.handle_datagram(udpmessage)
+
+        # Drain what else is waiting on the socket before going back to the loop
+        for _ in range(UDP_RECEIVE_BATCH - 1):
+            try:
+                udpmessage = self._socket.recv(UDP_RECEIVE_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logging.warning(f"UDP receive failed: {e}")
+                break
+            self.handle_datagram(udpmessage)
+
+    async def run_loop(self):
+        transport, protocol = await self._endpoint
+        while True:
+            data = await self._send_queue.get()
+            if data == None:
+                logging.debug(f"UDP Loop Break")
+                break  # Let future end on shutdown
+            length = len(data)
+            logging.debug(f"Write UDP: ({length}) {data}")
+            logRelay.put(f"udp_datagram_interface.py: Write UDP: ({length})")
+            # Never blocks, the transport buffers the datagram if the socket is not writable
+            transport.sendto(data, self._send_to_address)
+            if self._trace is not None:
+                self._trace.end(UPLINK, data)
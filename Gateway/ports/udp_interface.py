@@ -2,12 +2,21 @@
 # Author: Syncore Technologies AB
 #
 # -----------------------------------------------------------------
-import eel
+from LogRelay import logRelay
 from ports.interface import ISerial
 import asyncio
 import logging
 import socket
 import UdpToBlePayload
+import ConverterUtils
+import time
+from bounded_queue import BoundedQueue
+from latency_trace import UPLINK, DOWNLINK
+
+# Receive buffer size, a datagram must fit in one Hqv linked-layer frame
+UDP_RECEIVE_SIZE = ConverterUtils.HQV_LINKED_LAYER_MESSAGE_MAX_SIZE
+
+REMOTE_DTLS_HEADER = ConverterUtils.ToPacketHeader(ConverterUtils.REMOTE, ConverterUtils.DTLS)
 
 
 class UDP(ISerial):
@@ -19,10 +28,14 @@ class UDP(ISerial):
         dest_port: int,
         source_ip: str,
         source_port: int,
+        header: int = REMOTE_DTLS_HEADER,
     ):
         self.loop = ev_loop
-        self.mtu = 23  # (mtu + 3) FG
-        self._send_queue = asyncio.Queue()
+        self._header = header  # Packet header of the frames to the device, a port per header type
+        # ATT MTU of the BLE link, starts at the minimum until the BLE interface reports the negotiated one
+        self.set_mtu(23)
+        self._send_queue = BoundedQueue.from_config("uplink")
+        self._trace = None  # latency_trace.LatencyTrace when latency tracing is on
 
         self._send_to_address = (dest_ip, int(dest_port))
         address = (source_ip, int(source_port))
@@ -35,11 +48,18 @@ class UDP(ISerial):
         self._socket = sock
 
         logging.info(f"UDP socket bind to {sock.getsockname()}")
-        logging.info(f"UDP socket sends data to {self._send_to_address}")
+        logging.info(f"UDP socket sends data to {self._send_to_address}, packet header {header}")
 
     def set_receiver(self, callback):
         self._cb = callback
 
+    def set_trace(self, trace):
+        self._trace = trace
+
+    def set_mtu(self, mtu: int):
+        self.mtu = mtu
+        self._udptoble = UdpToBlePayload.UdpToBlePayload(mtu)
+
     def start(self):
         assert self._cb, "Receiver must be set before start!"
 
@@ -48,35 +68,46 @@ class UDP(ISerial):
 
     def stop_loop(self):
         logging.info("Stopping UDP event loop")
-        self._send_queue.put_nowait(None)
+        self._send_queue.put_stop()
 
     def remove(self):
         # Unregister the fd
         self.loop.remove_reader(self._socket)
+        self._socket.close()
         logging.info(f"UDP reader removed")
 
     def read_handler(self):
+        self.handle_datagram(self.read_sync())
+
+    def handle_datagram(self, udpmessage):
+        trace = self._trace
+        if trace is not None:
+            received = time.monotonic_ns()
+
+        if len(udpmessage) > ConverterUtils.LWM2M_MESSAGE_MAX_SIZE:
+            logging.warning(f"Dropping UDP message larger than {ConverterUtils.LWM2M_MESSAGE_MAX_SIZE} bytes")
+            return
 
-        udpmessage = self.read_sync()
         logging.debug(f"Received UDP: ({len(udpmessage)}) {udpmessage}")
-        eel.putRLog(f"udp_interface.py: Received UDP: ({len(udpmessage)})")
+        logRelay.put(f"udp_interface.py: Received UDP: ({len(udpmessage)})")
 
-        udptoble = UdpToBlePayload.UdpToBlePayload(self.mtu)  # MTU Size 23
-        # header = ConverterUtils.ToPacketHeader(ConverterUtils.REMOTE, ConverterUtils.DTLS) # FG
-        header = 3  # Header Remote and DTLS
-        blemessages = udptoble.Convert(udpmessage, header)
+        blemessages = self._udptoble.Convert(udpmessage, self._header)
+        if trace is not None:
+            trace.begin(DOWNLINK, blemessages, received, time.monotonic_ns())
 
         logging.debug("Send split BLE messages")
-        for msg in blemessages:
-            self._cb(msg)
+        self._cb(blemessages)  # All fragments of the datagram are queued together
 
     def read_sync(self):
-        value, address = self._socket.recvfrom(1024)
+        value, address = self._socket.recvfrom(UDP_RECEIVE_SIZE)
         # logging.debug(f'Read: {value}')
         return value
 
     def queue_write(self, value: bytes):
-        self._send_queue.put_nowait(value)
+        if self._trace is not None:
+            self._trace.stamp(UPLINK, value)
+        if not self._send_queue.offer(value):
+            logging.debug(f"Uplink queue full, dropped BLE message")
 
     async def run_loop(self):
         while True:
@@ -86,7 +117,7 @@ class UDP(ISerial):
                 break  # Let future end on shutdown
             length = len(data)
             logging.debug(f"Write UDP: ({length}) {data}")
-            eel.putRLog(f"udp_interface.py: Write UDP: ({length})")
+            logRelay.put(f"udp_interface.py: Write UDP: ({length})")
             retries = 0
             while retries < 3:
                 sent = self._socket.sendto(data, self._send_to_address)
@@ -96,6 +127,9 @@ class UDP(ISerial):
                 else:
                     retries = retries + 1
 
+            if self._trace is not None:
+                self._trace.end(UPLINK, data)
+
             if retries == 3:
                 logging.warning(f"Could not send {data} over gateway UDP socket")
                 # TODO: How to handle this?
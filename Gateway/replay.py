@@ -0,0 +1,313 @@
+# Description: Offline traffic replay
+# Author: Syncore Technologies AB
+#
+# Replays a traffic capture of the gateway (config.ini [GATEWAY] Traffic capture, "pcap" or "text") without a HAPP
+# device. The BLE-IN messages are framed as Hqv linked-layer frames again, cut into notification sized chunks and
+# fed into BLE_interface.handle_notify, so they pass the same reassembly and UDP port as a live gateway. The UDP
+# side sends to a local sink socket. The BLE-OUT messages are sent from the sink to the gateway UDP socket and are
+# collected after the UDP -> BLE fragmentation. Timing follows the capture, divided by --speed (0 = no delays).
+#
+# Run from the application folder: python -m Gateway.replay capture/<file>.pcapng --speed 10
+# -----------------------------------------------------------------
+
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import time
+
+sys.path.append(os.path.dirname(__file__))
+
+from Gateway.gateway import UDP_INTERFACES, udpInterface
+from ble_interface import BLE_interface
+from log.console_log import setup_logger
+from log.fs_log import Direction
+from log.pcap_log import ENHANCED_PACKET_BLOCK, SECTION_HEADER_BLOCK, OPT_EPB_FLAGS, EPB_INBOUND
+from ports.udp_datagram_interface import UDPDatagram
+import UdpToBlePayload
+
+# Header of the replayed BLE-IN frames, Remote and DTLS
+REPLAY_HEADER = 3
+HQV_HEADER_SIZE = 4
+
+
+# Reads a pcapng capture written by PCAP_log, returns [(timestamp, direction, payload)]
+def read_pcap(filename):
+    events = []
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    offset = 0
+    while offset + 12 <= len(data):
+        blockType, length = struct.unpack_from("<II", data, offset)
+        if length < 12:
+            break
+        if blockType == ENHANCED_PACKET_BLOCK:
+            _, tsHigh, tsLow, captured, _ = struct.unpack_from("<IIIII", data, offset + 8)
+            packetStart = offset + 28
+            packet = data[packetStart:packetStart + captured]
+
+            # Options follow the padded packet data, only the direction flag is used
+            direction = None
+            optOffset = packetStart + captured + (-captured % 4)
+            while optOffset + 4 <= offset + length - 4:
+                code, optLength = struct.unpack_from("<HH", data, optOffset)
+                if code == 0:
+                    break
+                if code == OPT_EPB_FLAGS and optLength == 4:
+                    flags = struct.unpack_from("<I", data, optOffset + 4)[0]
+                    direction = Direction.BLE_IN if flags & 3 == EPB_INBOUND else Direction.BLE_OUT
+                optOffset += 4 + optLength + (-optLength % 4)
+
+            ipHeaderSize = (packet[0] & 0x0F) * 4
+            payload = packet[ipHeaderSize + 8:]
+            if direction is None:  # Capture without direction flags, the device has a 10.x.y.z address
+                direction = Direction.BLE_IN if packet[12] == 10 else Direction.BLE_OUT
+            events.append((((tsHigh << 32) | tsLow) / 1000000, direction, payload))
+        offset += length
+    return events
+
+
+# Reads a text capture written by FS_log, returns [(timestamp, direction, payload)]. The data must be logged as hex
+def read_text(filename):
+    events = []
+    skipped = 0
+    with open(filename, "r", errors="replace") as f:
+        for line in f:
+            try:
+                date, clock, rest = line.rstrip().split(" ", 2)
+                timestamp = datetime.datetime.strptime(f"{date} {clock}", "%Y-%m-%d %H:%M:%S.%f").timestamp()
+                dir, data = rest.split(": ", 1)
+                payload = bytes.fromhex(data.strip())
+            except ValueError:
+                skipped += 1
+                continue
+            if dir == Direction.BLE_IN:
+                events.append((timestamp, Direction.BLE_IN, payload))
+            elif dir == Direction.BLE_OUT:
+                events.append((timestamp, Direction.BLE_OUT, payload[HQV_HEADER_SIZE:]))
+    if skipped:
+        logging.warning(f"Skipped {skipped} lines of {filename} that are not hex logged messages")
+    return events
+
+
+def read_capture(filename):
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+    if magic == struct.pack("<I", SECTION_HEADER_BLOCK):
+        return read_pcap(filename)
+    return read_text(filename)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+# Timestamps of sent messages and the latency of the ones that arrived, matched on content
+class DirectionStats:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.bytes = 0
+        self.unmatched = 0
+        self.latencies = []
+        self._pending = collections.defaultdict(collections.deque)
+
+    def sent_message(self, payload):
+        self.sent += 1
+        self._pending[bytes(payload)].append(time.perf_counter())
+
+    def received_message(self, payload):
+        now = time.perf_counter()
+        self.received += 1
+        self.bytes += len(payload)
+        stamps = self._pending.get(bytes(payload))
+        if stamps:
+            self.latencies.append((now - stamps.popleft()) * 1000)
+        else:
+            self.unmatched += 1
+
+    def report(self, duration):
+        return {
+            "sent": self.sent,
+            "received": self.received,
+            "unmatched": self.unmatched,
+            "bytes": self.bytes,
+            "messagesPerSecond": round(self.received / duration, 1) if duration else 0,
+            "kBPerSecond": round(self.bytes / duration / 1024, 1) if duration else 0,
+            "latencyP50Ms": round(percentile(self.latencies, 50), 3),
+            "latencyP95Ms": round(percentile(self.latencies, 95), 3),
+            "latencyMaxMs": round(max(self.latencies, default=0.0), 3),
+        }
+
+
+class Replay:
+    def __init__(self, events, speed, chunk, mtu, idle_timeout):
+        self._events = events
+        self._speed = speed
+        self._chunk = chunk
+        self._mtu = mtu
+        self._idle_timeout = idle_timeout
+        self._framer = UdpToBlePayload.UdpToBlePayload(chunk + 3)
+        self.uplink = DirectionStats()
+        self.downlink = DirectionStats()
+        self.notifications = 0
+        self.framesReassembled = 0
+        self.lastActivity = time.perf_counter()
+
+    # BLE -> UDP frames that left the reassembler, before they are queued on the UDP port
+    def reassembled(self, data):
+        self.framesReassembled += 1
+        self._udp.queue_write(data)
+
+    # UDP -> BLE fragments of one datagram, in place of BLE_interface.queue_send
+    def ble_write(self, fragments):
+        self.lastActivity = time.perf_counter()
+        self.downlink.received_message(b"".join(fragments)[HQV_HEADER_SIZE:])
+
+    def sink_read(self):
+        data = self._sink.recv(65535)
+        self.lastActivity = time.perf_counter()
+        self.uplink.received_message(data)
+
+    async def feed(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        first = self._events[0][0] if self._events else 0
+        gateway = self._udp._socket.getsockname()
+
+        for timestamp, dir, payload in self._events:
+            if self._speed > 0:
+                delay = start + (timestamp - first) / self._speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            if dir == Direction.BLE_IN:
+                self.uplink.sent_message(payload)
+                for chunk in self._framer.Convert(payload, REPLAY_HEADER):
+                    self.notifications += 1
+                    self._bt.handle_notify(0, chunk)
+            else:
+                self.downlink.sent_message(payload)
+                self._sink.sendto(payload, gateway)
+            await asyncio.sleep(0)  # Let the UDP port send and receive
+
+    async def drain(self):
+        while self.uplink.received + self.uplink.unmatched < self.uplink.sent or \
+                self.downlink.received + self.downlink.unmatched < self.downlink.sent:
+            if time.perf_counter() - self.lastActivity > self._idle_timeout:
+                logging.warning("Replay ended with messages still missing")
+                break
+            await asyncio.sleep(0.01)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        self._sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sink.bind(("127.0.0.1", 0))
+        self._sink.setblocking(False)
+        sinkPort = self._sink.getsockname()[1]
+
+        self._udp = UDP_INTERFACES.get(udpInterface, UDPDatagram)(loop, self._mtu, "127.0.0.1", sinkPort, "127.0.0.1",
+                                                                   0)
+        self._udp.set_mtu(self._mtu)
+        self._udp.set_receiver(self.ble_write)
+        self._bt = BLE_interface()
+        self._bt.reset_reassembly()
+        self._bt.set_receiver(self.reassembled)
+
+        self._udp.start()
+        loop.add_reader(self._sink.fileno(), self.sink_read)
+        sender = asyncio.ensure_future(self._udp.run_loop())
+        try:
+            begin = time.perf_counter()
+            await self.feed()
+            self.lastActivity = time.perf_counter()
+            await self.drain()
+            duration = time.perf_counter() - begin
+        finally:
+            self._udp.stop_loop()
+            await sender
+            loop.remove_reader(self._sink.fileno())
+            self._udp.remove()
+            self._sink.close()
+
+        return {
+            "events": len(self._events),
+            "durationS": round(duration, 3),
+            "notifications": self.notifications,
+            "framesReassembled": self.framesReassembled,
+            "uplink": self.uplink.report(duration),
+            "downlink": self.downlink.report(duration),
+            "uplinkQueue": self._udp._send_queue.stats(),
+        }
+
+
+def replay(filename, speed=1.0, chunk=20, mtu=247, idle_timeout=2.0):
+    events = read_capture(filename)
+    logging.info(f"Replaying {len(events)} messages from {filename}")
+    return asyncio.run(Replay(events, speed, chunk, mtu, idle_timeout).run())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Replay a gateway traffic capture without a BLE device.",
+    )
+    parser.add_argument("capture", help="pcapng or hex text capture written by the gateway")
+    parser.add_argument(
+        "-s",
+        "--speed",
+        dest="speed",
+        default=1.0,
+        type=float,
+        help="Replay speed, 1 follows the capture timing and 0 replays as fast as possible",
+    )
+    parser.add_argument(
+        "-c",
+        "--chunk",
+        dest="chunk",
+        default=20,
+        type=int,
+        help="Size of the BLE notifications the BLE-IN frames are cut into",
+    )
+    parser.add_argument(
+        "-m",
+        "--mtu",
+        dest="mtu",
+        default=247,
+        type=int,
+        help="ATT MTU used to fragment the BLE-OUT messages",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        dest="idle_timeout",
+        default=2.0,
+        type=float,
+        help="Seconds to wait for missing messages after the last one",
+    )
+    parser.add_argument("-j", "--json", dest="json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Log all data going through")
+    args = parser.parse_args()
+
+    setup_logger(args.verbose, False)
+    if not args.verbose:
+        logging.getLogger("bleak").level = logging.INFO
+    report = replay(args.capture, args.speed, args.chunk, args.mtu, args.idle_timeout)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for name in ("events", "durationS", "notifications", "framesReassembled"):
+            print(f"{name}: {report[name]}")
+        for direction in ("uplink", "downlink"):
+            print(f"{direction}: " + ", ".join(f"{k}={v}" for k, v in report[direction].items()))
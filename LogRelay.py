@@ -0,0 +1,64 @@
+# Description: Real time log relay
+# Author: Syncore Technologies AB
+#
+# Lines for the real time log on the GUI are appended to a bounded ring and pushed to the frontend in batches
+# from one thread, so the BLE/UDP data path never waits on the websocket to the GUI. If the ring is full the oldest
+# line is dropped and counted.
+# -----------------------------------------------------------------
+import collections
+import configparser
+import logging
+import threading
+import time
+import eel
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+
+class LogRelay:
+    def __init__(self, size, rate):
+        self._lines = collections.deque(maxlen=size)
+        self._interval = 1 / rate
+        self._thread = None
+        self.dropped = 0
+        self._reportedDropped = 0
+
+    # Non blocking append, safe to call from any thread
+    def put(self, text):
+        if len(self._lines) == self._lines.maxlen:
+            self.dropped += 1
+        self._lines.append(text)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="LogRelay", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            self.flush()
+
+    def flush(self):
+        lines = []
+        while self._lines:
+            lines.append(self._lines.popleft())
+
+        dropped = self.dropped
+        if dropped != self._reportedDropped:
+            lines.append(f"LogRelay.py: {dropped - self._reportedDropped} log lines dropped")
+            self._reportedDropped = dropped
+
+        if lines:
+            try:
+                eel.putRLogBatch(lines)
+            except Exception as e:
+                # GUI not started yet or no frontend connected
+                logging.debug(f"Could not relay {len(lines)} log lines to GUI: {e}")
+
+
+logRelay = LogRelay(
+    int(config.get("SBLETS", "Real time log buffer", fallback="1000")),
+    float(config.get("SBLETS", "Real time log rate", fallback="10")),
+)
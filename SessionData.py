@@ -12,6 +12,12 @@ class SessionData:
         self.deviceConnectedToLeshan = "False"
         self.foundSbletsServers = None
 
+    # The device data and connect status belong to one device, the one the GUI shows. A gateway session only changes
+    # them for its own device, or takes them over while no device is connected, so it does not overwrite the state of
+    # another session. The state of every session is reported by command 0x19.
+    def is_current_device(self, mac):
+        return self.connectedDeviceMac is None or self.connectedDeviceMac.upper() == str(mac).upper()
+
 
 sessionData = SessionData()
 
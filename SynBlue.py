@@ -4,7 +4,7 @@
 # -----------------------------------------------------------------
 import asyncio
 
-from bleak import BleakClient, BleakScanner  # Bleak Lib
+from ble_backend import BleakClient, BleakScanner  # Bleak Lib or simulated, see ble_backend.py
 import bluetoothctl_wrapper  # Wrapper for Bluetoothctl
 
 import time
@@ -2,6 +2,7 @@
 # Author: Syncore Technologies AB
 #
 # -----------------------------------------------------------------
+import logging
 
 # Const
 ETX = 0x03
@@ -12,7 +13,57 @@ ESC_ETX = 0x83
 ESC_ESC = 0x9B
 
 
+# Escaped pair -> the byte it stands for. ESC is unescaped last, so an unescaped ESC never starts another pair
+ESCAPED_PAIRS = {
+    bytes([ESC, ESC_STX]): bytes([STX]),
+    bytes([ESC, ESC_ETX]): bytes([ETX]),
+    bytes([ESC, ESC_ESC]): bytes([ESC]),
+}
+UNESCAPED = {pair[1]: byte[0] for pair, byte in ESCAPED_PAIRS.items()}  # Byte after ESC -> the byte of the pair
+FRAMING_BYTES = bytes([STX, ETX])  # Dropped where they are not escaped
+
+
 def decode_data(data):
+    data = bytes(data)
+    if ESC not in data:
+        # Nothing escaped, only STX and ETX are dropped
+        return bytearray(data.translate(None, FRAMING_BYTES))
+    if data.count(ESC) == sum(data.count(pair) for pair in ESCAPED_PAIRS):
+        # Every ESC starts an escaped pair, always so for data from encode_data
+        data_out = data.translate(None, FRAMING_BYTES)
+        for pair, byte in ESCAPED_PAIRS.items():
+            data_out = data_out.replace(pair, byte)
+        return bytearray(data_out)
+    if data[-1] == ESC:
+        raise IndexError("ESC at the end of the data")  # As decode_data_legacy
+
+    # Every part after the first one follows an ESC. An ESC that does not start an escaped pair is dropped
+    parts = data.split(bytes([ESC]))
+    data_out = bytearray(parts[0].translate(None, FRAMING_BYTES))
+    for part in parts[1:]:
+        unescaped = UNESCAPED.get(part[0]) if part else None
+        if unescaped is None:
+            data_out += part.translate(None, FRAMING_BYTES)
+        else:
+            data_out.append(unescaped)
+            data_out += part[1:].translate(None, FRAMING_BYTES)
+    return data_out
+
+
+def encode_data(data):
+    # ESC is escaped first, so the ESC of the other escaped pairs is not escaped again
+    escaped = bytes(data)
+    for pair, byte in reversed(ESCAPED_PAIRS.items()):
+        escaped = escaped.replace(byte, pair)
+    data_out = bytearray(len(escaped) + 2)
+    data_out[0] = STX
+    data_out[1:-1] = escaped
+    data_out[-1] = ETX
+    return data_out
+
+
+# Byte by byte codec the one above replaces, kept as the reference for tools/benchmarkConversion.py --check
+def decode_data_legacy(data):
     data_out = bytearray()
     jump_next = False
 
@@ -38,7 +89,7 @@ def decode_data(data):
     return data_out
 
 
-def encode_data(data):
+def encode_data_legacy(data):
     data_out = bytearray()
 
     # Add Start Byte
@@ -65,3 +116,47 @@ def encode_data(data):
     data_out.append(ETX)
 
     return data_out
+
+
+# Collects the STX ... ETX framed commands from the TCP stream, a command can be split over several reads. The
+# frame boundaries are found with bytes.find, so the bytes of a command are only copied once into the command
+class StreamFramer:
+    def __init__(self):
+        self.cmd_data = bytearray()
+        self.start_cmd_found = False
+
+    # Returns the complete commands (still escaped, without STX and ETX) found in data
+    def feed(self, data):
+        commands = []
+        index = 0
+        end = len(data)
+        with memoryview(data) as view:
+            while index < end:
+                if not self.start_cmd_found:
+                    stx = data.find(STX, index)
+                    if stx < 0:
+                        break  # Nothing outside a command is kept
+                    logging.debug("STX Found")
+                    self.start_cmd_found = True
+                    index = stx + 1
+                    continue
+
+                etx = data.find(ETX, index)
+                stx = data.find(STX, index, end if etx < 0 else etx)
+                if stx >= 0:
+                    logging.warning("STX Found before ETX")
+                    # Found Start before the end, clear buffer
+                    self.cmd_data.clear()
+                    index = stx + 1
+                elif etx < 0:
+                    self.cmd_data += view[index:]  # The rest of the command comes with the next read
+                    break
+                else:
+                    logging.debug("ETX Found")
+                    self.cmd_data += view[index:etx]
+                    commands.append(self.cmd_data)
+                    self.cmd_data = bytearray()
+                    self.start_cmd_found = False
+                    index = etx + 1
+
+        return commands
@@ -87,23 +87,27 @@ import multiprocessing
 import datetime
 from logging.handlers import TimedRotatingFileHandler
 from tools.addDeviceData import addAlias
-from tools.findHappDevices import startSearch
+from tools.findHappDevices import startSearch, findHappDevice
+from tools.happObserver import happObserver, observerEnabled
 import SynBlue  # Developed by Syncore and hold legacy components
 import SynProtocol  # Knows how to encode and decode TCP data
-from Gateway.gateway import launch
+from LogRelay import logRelay  # Batches real time log lines to the GUI
+from Gateway.gateway_manager import gatewayManager
+from control_server import controlServer, FLAG_REQUEST_IDS  # Multi client TCP control server
+from command_dispatch import CommandDispatcher
 from webserver import *
 from SimpleWebSocketServer import SimpleWebSocketServer, WebSocket
 
 global currentThread_Time
-global currentThread_Gateway
-global connect_datas
-global gateway_stop
 
 # Commands
 ACK = 0xFE
 NACK = 0xFF
 ERROR = 0xEE
 
+# Seconds between the checks that the TCP socket thread is alive while no data arrives
+TCP_THREAD_CHECK_INTERVAL = 0.5
+
 # Change SBLETS version in webserver.py
 
 # Create a ConfigParser object
@@ -159,7 +163,7 @@ class SimpleEcho(WebSocket):
     def handleMessage(self):
         global tcpClient
         logging.info(f"(WebSocket) Received message from WebSocket: {self.data}")
-        eel.putRLog(f"app.py (WebSocket): Received message from WebSocket: {self.data}")
+        logRelay.put(f"app.py (WebSocket): Received message from WebSocket: {self.data}")
 
         try:
             tcpClient = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -168,17 +172,17 @@ class SimpleEcho(WebSocket):
             tcpClient.settimeout(190.0)
 
             logging.debug(f"(WebSocket) Package sent to TCP server: {self.data}")
-            eel.putRLog(f"app.py (websocket): Package sent to TCP server: {self.data}")
+            logRelay.put(f"app.py (websocket): Package sent to TCP server: {self.data}")
 
             response = tcpClient.recv(1024)
             logging.debug(f"(websocket) {response} Received from TCP Server, forwarding to websocket client")
-            eel.putRLog(f"app.py (websocket): {response} Received from TCP Server, forwarding to websocket client")
+            logRelay.put(f"app.py (websocket): {response} Received from TCP Server, forwarding to websocket client")
             # Send the message back to a client
             self.sendMessage(str(response))
 
         except Exception as e:
             logging.error(f"(websocket) Error communicating with TCP server: {e}")
-            eel.putRLog(f"app.py (websocket): Error communicating with TCP server: {e}")
+            logRelay.put(f"app.py (websocket): Error communicating with TCP server: {e}")
             eel.changeConnectStatus(f"(websocket) Error communicating with TCP server: {e}")
 
         finally:
@@ -186,11 +190,11 @@ class SimpleEcho(WebSocket):
             tcpClient.shutdown(socket.SHUT_WR)
 
             logging.debug(f"(websocket) Sending shutdown to TCP socket")
-            eel.putRLog(f"app.py (websocket): Sending shutdown to TCP socket")
+            logRelay.put(f"app.py (websocket): Sending shutdown to TCP socket")
 
             tcpClient.close()
             logging.error(f"(websocket) Websocket to TCP tunnel closed")
-            eel.putRLog(f"app.py (websocket): Websocket to TCP tunnel closed")
+            logRelay.put(f"app.py (websocket): Websocket to TCP tunnel closed")
             self.close()
 
     def handleConnected(self):
@@ -208,7 +212,7 @@ def start_websocket_server():
     try:
         server = SimpleWebSocketServer(config.get('SBLETS', 'LANIP'), config.get('WEBSOCKET', 'Port'), SimpleEcho)
         logging.info(f"WebSocket server started on port {config.get('WEBSOCKET', 'Port')}")
-        eel.putRLog(
+        logRelay.put(
             f"app.py: WebSocket server started on port {config.get('WEBSOCKET', 'Port')}")  # Real time log on graphical web interface
         setStatus("Ready", "websocket")
         server.serveforever()
@@ -216,103 +220,6 @@ def start_websocket_server():
         raise Exception("Not a valid or accepted IP or Port in config.ini!")
 
 
-def server_part(q):
-    global connect_data
-
-    HOST = '127.0.0.1'  # The server hostname or IP address (Bind to all)
-    PORT = config.getint('TCP', 'Port')  # The port used by the server (Pick a port number from 49152 through 65535)
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        # s.settimeout(10.0)
-        # Ensure that you can restart your server quickly when it terminates
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # Socket Keepalive on
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        # s.setsockopt(socket.SOL_TCP, socket.TCP_KEEPALIVE, 1)
-        s.setsockopt(socket.SOL_TCP, socket.TCP_KEEPINTVL, 11)
-        s.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, 3)
-        # Set user timeout for unacknowledged data
-        # s.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, 20000)  # 20-second timeout
-
-        try:
-            s.bind((HOST, PORT))
-
-            logging.info(f"TCP socket started and binded to {HOST} and port {PORT}")
-            eel.putRLog(f"app.py (TCP): TCP socket started and binded to {HOST} and port {PORT}")
-            setStatus("Ready", "tcp")
-            s.listen(1)  # One Client
-            # logging.debug("Socket is listening")
-
-        except socket.error:
-            logging.warning("Socket connect failed! Loop up and try socket again")
-            traceback.print_exc()
-            time.sleep(5.0)
-            pass
-
-        # loop waiting for connections
-        try:
-            while True:
-                try:
-                    conn, addr = s.accept()
-
-                    connect_data["conn"] = conn
-                    connect_data["addr"] = addr
-
-                    logging.debug("Connected by %s", addr)
-                    setStatus("Ready", "tcp")
-
-                    # conn.sendall(b"Hi from Server!") # Used During development only
-
-                    # loop serving the new client
-                    while True:
-                        setStatus("Busy", "tcp")
-                        try:
-                            logging.debug("Wait For New Data:")
-                            data = conn.recv(1024)
-
-                            logging.debug("New Data Received:")
-                            eel.putRLog("app.py (TCP): New Data Recived:")
-                            q.put(data)
-                            logging.debug(data)
-                            setStatus("Ready", "tcp")
-                            # eel.putRLog(data)
-
-                            if not data:
-                                logging.debug("Connection reset by peer")
-                                eel.putRLog("app.py (TCP): Connection reset by peer")
-                                break
-
-                        except socket.timeout:
-                            logging.debug("Socket timeout, loop and try recv() again")
-                            time.sleep(5.0)
-                            # traceback.print_exc()
-                            pass
-
-                        # except:
-                        # traceback.print_exc()
-                        # print 'Other Socket err, exit and try creating socket again'
-                        # break from loop
-                        # break
-
-                        except:
-                            logging.debug("Disconnected from %s", addr)
-                            conn.close()
-                            break
-
-                except socket.timeout:
-                    logging.debug("Socket timeout, loop and try accept() again")
-                    # time.sleep( 5.0)
-                    # traceback.print_exc()
-                    pass
-
-        finally:
-            logging.debug("Socket Closed")
-            setStatus("Dead", "tcp")
-            s.close()
-
-    logging.debug("With Socket Closed")
-
-
 # SBLETS protocol is a way of discovering another SBLETS servers on the same network. SBLETS broadcast itself every
 # 10 seconds and every 0.1 second search for these messages published by other SBLETS servers. Message must include
 # the message type.
@@ -329,7 +236,7 @@ def sblets_discover_protocol():
     nextPublish = time.time() + 10  # Publish every 10th second
 
     logging.info(f"SBLETS protocol listening to {port}")
-    eel.putRLog(
+    logRelay.put(
         f"app.py: SBLETS protocol listening to {port}")
 
     while True:
@@ -417,7 +324,7 @@ def cmd_unpack_mac_and_time(data):
         logging.debug("Size Data: %s", len(data))
         msg_mac = int.from_bytes(data[1:7], "big")  # 6 Bytes
         logging.debug("MAC: %s", hex(msg_mac))
-        eel.putRLog(f"app.py: MAC: {hex(msg_mac)}")
+        logRelay.put(f"app.py: MAC: {hex(msg_mac)}")
         msg_time = int.from_bytes(data[7:8], "big")  # 1 Byte
         logging.debug("Time: %s", msg_time)
 
@@ -436,7 +343,7 @@ def cmd_unpack_mac(data):
         logging.debug("Size Data: %s", len(data))
         msg_mac = int.from_bytes(data[1:7], "big")  # 6 Bytes
         logging.debug("MAC: %s", hex(msg_mac))
-        eel.putRLog(f"app.py: MAC: {hex(msg_mac)}")
+        logRelay.put(f"app.py: MAC: {hex(msg_mac)}")
 
         return msg_mac
 
@@ -504,9 +411,7 @@ def cmd_unpack_secretkey(data):
 
 
 def send_connect_status(data, mac, cmd):
-    # Handle callbacks from Connect
-    global connect_data
-    connect_data["conn"]
+    # Handle callbacks from Connect, sent to the control client that owns the device
     # print(data)
     # print(mac)
     if "Disconnected" in data:
@@ -514,17 +419,17 @@ def send_connect_status(data, mac, cmd):
         msg.append(0x09)
         mac_to_int(mac)
         msg.extend(mac_to_int(mac).to_bytes(6, "big"))
-        connect_data["conn"].sendall(SynProtocol.encode_data(msg))
+        controlServer.notify(mac, SynProtocol.encode_data(msg))
         logging.debug(f"Send Call Lost")
     elif "Connected:" in data:
         if "NO" in data:
             logging.debug("Send nack")
-            # eel.putRLog(f"Send nack")
-            connect_data["conn"].sendall(send_nack(cmd))
+            # logRelay.put(f"Send nack")
+            controlServer.notify(mac, send_nack(cmd))
         elif "YES" in data:
-            connect_data["conn"].sendall(send_ack(cmd))
+            controlServer.notify(mac, send_ack(cmd))
             # Check if registered in Leshan
-            checkIfRegistered = threading.Thread(target=check_if_registered)
+            checkIfRegistered = threading.Thread(target=check_if_registered, args=(mac,))
             checkIfRegistered.start()
 
 
@@ -551,7 +456,7 @@ def push_secrets_to_leshan(uuid):
     key = getDeviceKey(uuid)
     if key == "unknown":
         logging.warning(f"No key pushed to Leshan!")
-        eel.putRLog(f"app.py: No key pushed to Leshan!")
+        logRelay.put(f"app.py: No key pushed to Leshan!")
         return False
 
     data = {"endpoint": endpoint, "tls": {"mode": "psk", "details": {"identity": identity, "key": key}}}
@@ -562,7 +467,7 @@ def push_secrets_to_leshan(uuid):
     textResponse = response.text
     logging.debug(textResponse)
     logging.info(f"Success while pushing secrets to Leshan: {textResponse}")
-    eel.putRLog(f"app.py: Success while pushing secrets to Leshan: {textResponse}")
+    logRelay.put(f"app.py: Success while pushing secrets to Leshan: {textResponse}")
     return True
 
 
@@ -576,7 +481,7 @@ def get_device_hid(mac=None, uuid=None):
     if uuid is None:
         HAPPDevices = sessionData.lastHAPPScan
         logging.debug(f"HAPPDevices={HAPPDevices}")
-        # eel.putRLog(f"app.py: HAPPDevices={HAPPDevices}")
+        # logRelay.put(f"app.py: HAPPDevices={HAPPDevices}")
 
         for device in HAPPDevices:
             current_mac = device["mac"]
@@ -584,14 +489,14 @@ def get_device_hid(mac=None, uuid=None):
             # Format UUID with - as endpoint
             if current_mac == mac:
                 str(uuidTool.UUID(hex=device["uuid"]))
-                # eel.putRLog(f"app.py: {mac} might have endpoint: {uuid}")
+                # logRelay.put(f"app.py: {mac} might have endpoint: {uuid}")
                 logging.debug(f"{mac} might have endpoint: {uuid}")
                 sessionData.uniqueSessionUUID = uuid
                 eel.pingFrontend()
                 break
         else:
             sessionData.connectedDeviceHID = "No devices in list"
-            eel.putRLog(f"app.py: No matching mac in list")
+            logRelay.put(f"app.py: No matching mac in list")
             logging.debug(f"No matching mac in list")
             return None
 
@@ -601,7 +506,7 @@ def get_device_hid(mac=None, uuid=None):
     try:
         contents = urllib.request.urlopen(f"http://{LeshanIP}:{LeshanPort}/api/clients/{uuid}/27003/0/19").read()
         data = json.loads(contents)
-        # eel.putRLog(f"app.py: Received data from HTTP (HID): {data}")
+        # logRelay.put(f"app.py: Received data from HTTP (HID): {data}")
         logging.debug(f"app.py: Received data from HTTP (HID): {data}")
 
         if 'content' in data and 'value' in data['content']:
@@ -610,7 +515,7 @@ def get_device_hid(mac=None, uuid=None):
 
             hid = inner_data['Nodes'][0]['HID']
             logging.debug(f"{mac} has HID: {hid}")
-            # eel.putRLog(f"app.py: {mac} has HID: {hid}")
+            # logRelay.put(f"app.py: {mac} has HID: {hid}")
             sessionData.connectedDeviceHID = hid
             sessionData.connectedDeviceHID = hid
             eel.changeConnectStatus(mac, True)
@@ -618,21 +523,18 @@ def get_device_hid(mac=None, uuid=None):
 
             return hid
         else:
-            eel.putRLog(f"app.py: 'content' or 'value' not found in response.")
+            logRelay.put(f"app.py: 'content' or 'value' not found in response.")
             logging.debug(f"'content' or 'value' not found in response.")
             return None
 
     except Exception as e:
-        eel.putRLog(f"app.py: Failed to get HID for {mac} with uuid {uuid}. Error: {e}")
+        logRelay.put(f"app.py: Failed to get HID for {mac} with uuid {uuid}. Error: {e}")
         logging.warning(f"Failed to get HID for {mac} with uuid {uuid}. Error: {e}")
         return None
 
 
-# Checks if the BLE device is registered to Leshan
-def check_if_registered():
-    global connect_data
-    connect_data["conn"]
-
+# Checks if the BLE device is registered to Leshan, the 0x15 and 0x16 notifications go to the client owning mac
+def check_if_registered(mac):
     success = False
     maxRetries = 10
     waitTime = 3
@@ -646,14 +548,9 @@ def check_if_registered():
         try:
             uuid = ""
 
-            mac = sessionData.connectedDeviceMac
-            if mac is None:
-                # eel.putRLog(f"app.py: no MAC found")
-                # logging.info(f"app.py: no MAC found")
-                continue
             HAPPDevices = sessionData.lastHAPPScan
             logging.debug(f"HAPPDevices={HAPPDevices}")
-            # eel.putRLog(f"app.py: HAPPDevices={HAPPDevices}")
+            # logRelay.put(f"app.py: HAPPDevices={HAPPDevices}")
 
             for device in HAPPDevices:
                 current_mac = device["mac"]
@@ -671,7 +568,7 @@ def check_if_registered():
                 for device in data:
                     endpoint = device.get("endpoint", None)
                     if endpoint == uuid:
-                        eel.putRLog(f"app.py: {mac} with endpoint {endpoint} is online and connected to Leshan!")
+                        logRelay.put(f"app.py: {mac} with endpoint {endpoint} is online and connected to Leshan!")
                         logging.info(f"{mac} with endpoint {endpoint} is online and connected to Leshan!")
                         sessionData.deviceConnectedToLeshan = "True"
                         success = True
@@ -680,22 +577,17 @@ def check_if_registered():
                             get_device_hid()
                             firstAttemptSeries = False
                             # Send device connected to Leshan to TCP
-                            try:
-                                msg = bytearray()
-                                msg.append(0x15)
-                                mac_to_int(mac)
-                                msg.extend(mac_to_int(mac).to_bytes(6, "big"))
-                                connect_data["conn"].sendall(send_ack(msg))
-                            except ConnectionAbortedError:
-                                logging.info("TCP Socket closed cant send server notify")
-                                # If this takes a long time, TCP connection could have been closed
-                                pass
+                            msg = bytearray()
+                            msg.append(0x15)
+                            mac_to_int(mac)
+                            msg.extend(mac_to_int(mac).to_bytes(6, "big"))
+                            controlServer.notify(mac, send_ack(msg))
                         # If send status request, wait 5 minutes and increase attempts to always check if online
                         else:
                             time.sleep(300)
                         if config.get("SBLETS", "Send regularly status request") == "True":
                             # This makes it a non-infinite loop incase device is disconnected
-                            eel.putRLog(f"app.py: Sending status request to Leshan!")
+                            logRelay.put(f"app.py: Sending status request to Leshan!")
                             logging.info(f"Sending status request to Leshan!")
                             maxRetries = maxRetries + 1
                             continue
@@ -704,41 +596,36 @@ def check_if_registered():
                             return
 
             except Exception as e:
-                eel.putRLog(f"app.py: {mac} with endpoint {uuid} not online yet")
+                logRelay.put(f"app.py: {mac} with endpoint {uuid} not online yet")
                 logging.warning(f"{mac} with endpoint {uuid} not online yet")
 
         except Exception as e:
             logging.debug(f"Attempt {attempt + 1} to check device registration status error: {e}")
-            eel.putRLog(f"app.py: Attempt {attempt + 1} to check device registration status error: {e}")
+            logRelay.put(f"app.py: Attempt {attempt + 1} to check device registration status error: {e}")
             sessionData.deviceConnectedToLeshan = "False"
 
         finally:
             if attempt < maxRetries - 1 and success is False and sessionData.connectStatusCode != 4:
                 logging.debug(f"Attempt {attempt + 1} to check device registration status failed")
-                eel.putRLog(f"app.py: Attempt {attempt + 1} to check device registration status failed")
+                logRelay.put(f"app.py: Attempt {attempt + 1} to check device registration status failed")
                 sessionData.deviceConnectedToLeshan = "False"
                 time.sleep(waitTime)
             elif success is False:
                 logging.warning(f"{mac} with endpoint {uuid} offline to long!")
-                eel.putRLog(f"app.py: {mac} with endpoint {uuid} offline to long!")
+                logRelay.put(f"app.py: {mac} with endpoint {uuid} offline to long!")
                 if sessionData.connectStatusCode != 4:
                     eel.changeConnectStatus("Device failed to register in Leshan!")
 
     logging.warning(f"Exiting thread to check if device is registered without progress")
-    eel.putRLog(f"Exiting thread to check if device is registered without progress")
+    logRelay.put(f"Exiting thread to check if device is registered without progress")
     if success:
         sessionData.deviceConnectedToLeshan = "True"
     else:
         sessionData.deviceConnectedToLeshan = "False"
         # Send device disconnected to Leshan to TCP
-        try:
-            msg = bytearray()
-            msg.append(0x16)
-            connect_data["conn"].sendall(SynProtocol.encode_data(msg))
-        except ConnectionAbortedError:
-            logging.info("TCP Socket closed cant send server notify")
-            # If this takes a long time, TCP connection could have been closed
-            pass
+        msg = bytearray()
+        msg.append(0x16)
+        controlServer.notify(mac, SynProtocol.encode_data(msg))
 
 
 # def send_result_data_2(cmd, data):
@@ -776,573 +663,649 @@ def send_error(cmd, error_code):
     return SynProtocol.encode_data(return_val)
 
 
-def parse_msg(data):
-    print("Message detected!")
-    logging.debug("Message detected!")
-    global currentThread_Time
-    global connect_data
-    global currentThread_Gateway
-    global gateway_stop
-    global HAPPDevices
-    connection = connect_data["conn"]
+# Connect to SBLETS server
+def cmd_connect_server(msg_cmd, data, connection):
+    connection.user = True
+    logging.debug("User connected: %s", connection.user)
 
-    # Received Command
-    msg_cmd = data[0]
-    logging.debug("cmd: %s", msg_cmd)
-    eel.putRLog(f"app.py: cmd: {msg_cmd}")
+    # Init Bluetooth
+    # subprocess.run() # If needed
 
-    # -- Print warning for deprecated or unsupported commands --
-    if msg_cmd == 0x06 or msg_cmd == 0x0B or msg_cmd == 0x0C:
-        logging.warning(f"cmd: {msg_cmd} is a legacy and deprecated command consider using 0x10 (16) instead!")
-        eel.putRLog(f"app.py: cmd: {msg_cmd} is a legacy and deprecated command consider using 0x10 (16) instead!")
+    # Return SBLETS UUID when connecting.
+    # OBS!
+    # At the start, SBLETS has a short UUID (8 bytes), but when connected
+    # to a BLE device it gets the devices UUID
+    return_data = bytearray()
+    uuid_ascii = bytes(sessionData.uniqueSessionUUID, "ascii")
+    return_data.extend(uuid_ascii)
 
-    if msg_cmd == 0x08 and sys.platform == 'win32':
-        logging.warning(f"cmd: {msg_cmd} is not supported on Windows!")
-        eel.putRLog(f"app.py: cmd: {msg_cmd} is not supported on Windows!")
-    # ----------------------------------------------------------
+    # Optional flags byte, see control_server.py. The accepted flags follow the UUID.
+    requestIds = False
+    if len(data) > 1:
+        requestIds = bool(data[1] & FLAG_REQUEST_IDS)
+        return_data.append(FLAG_REQUEST_IDS if requestIds else 0x00)
 
-    # Connect to SBLETS server
-    if msg_cmd == 0x04:
-        connect_data["user"] = True
-        logging.debug("User connected: %s", connect_data["user"])
+    connection.sendall(send_result_data(msg_cmd, return_data))
+    # connection.sendall(send_ack(msg_cmd))
+    connection.requestIds = requestIds  # After the reply, it has the format of the 0x04 command
 
-        # Init Bluetooth
-        # subprocess.run() # If needed
 
-        # Return SBLETS UUID when connecting.
-        # OBS!
-        # At the start, SBLETS has a short UUID (8 bytes), but when connected
-        # to a BLE device it gets the devices UUID
-        return_data = bytearray()
-        uuid_ascii = bytes(sessionData.uniqueSessionUUID, "ascii")
-        return_data.extend(uuid_ascii)
+# Disconnect from SBLETS server
+def cmd_disconnect_server(msg_cmd, data, connection):
+    if connection.user == True:
+        connection.user = False
+        connection.sendall(send_ack(msg_cmd))
+    else:
+        connection.user = False
+        connection.sendall(send_nack(msg_cmd))
+    logging.debug("User connected: %s", connection.user)
+    connection.requestIds = False
 
-        connection.sendall(send_result_data(msg_cmd, return_data))
-        # connection.sendall(send_ack(msg_cmd))
-    # Disconnect from SBLETS server
-    elif msg_cmd == 0x05:
-        if connect_data["user"] == True:
-            connect_data["user"] = False
-            connection.sendall(send_ack(msg_cmd))
-        else:
-            connect_data["user"] = False
-            connection.sendall(send_nack(msg_cmd))
-        logging.debug("User connected: %s", connect_data["user"])
 
-    # Alexander Ström 2024-07-18 This is a legacy command and replaced by HAPP Device Finder cmd 16
-    # List Devices
-    elif msg_cmd == 0x06:
-        logging.debug("Execute Cmd 0x06")
+# Alexander Ström 2024-07-18 This is a legacy command and replaced by HAPP Device Finder cmd 16
+# List Devices
+def cmd_list_devices(msg_cmd, data, connection):
+    logging.debug("Execute Cmd 0x06")
 
-        timeout = cmd_unpack_time(data)
+    timeout = cmd_unpack_time(data)
 
-        if timeout:
+    if timeout:
 
-            Devices = SynBlue.List_Of_Devices_Test(timeout)
-            logging.debug("The Devices Found is: ")
-            if Devices:
+        Devices = SynBlue.List_Of_Devices_Test(timeout)
+        logging.debug("The Devices Found is: ")
+        if Devices:
 
-                return_data = bytearray()
+            return_data = bytearray()
 
-                return_data.extend(
-                    len(Devices).to_bytes(4, byteorder="big", signed=False)
-                )  # Nr of device 4 Byte
+            return_data.extend(
+                len(Devices).to_bytes(4, byteorder="big", signed=False)
+            )  # Nr of device 4 Byte
+
+            for dev in Devices:
+                logging.debug(dev)
+                # Device Mac adress 6 byte
+                mac = dev["mac_address"].replace(":", "")
+                return_data.extend(bytearray.fromhex(mac))
 
-                for dev in Devices:
-                    logging.debug(dev)
-                    # Device Mac adress 6 byte
-                    mac = dev["mac_address"].replace(":", "")
-                    return_data.extend(bytearray.fromhex(mac))
+                # Device Name null terminted ASCII String
+                name_ascii = bytes(dev["name"], "ascii") + b"\x00"
+                return_data.extend(name_ascii)
 
-                    # Device Name null terminted ASCII String
-                    name_ascii = bytes(dev["name"], "ascii") + b"\x00"
-                    return_data.extend(name_ascii)
+            # Send Data
+            connection.sendall(send_result_data(msg_cmd, return_data))
 
-                # Send Data
-                connection.sendall(send_result_data(msg_cmd, return_data))
+            # if False:
+            # # Decode Test Funktion som ska ligga i labview
+            # print(return_data)
+
+            # data = return_data[4:]
+            # no_of_device = int.from_bytes(return_data[0:4], "big")
+            # print(no_of_device)
+            # print(data)
+            # print(len(data))
+
+            # index = 0
+            # unpacked_device = 0
+            # while unpacked_device < no_of_device:
+            # # while len(data) - index > 6:
+            # print(index, " XXX ", len(data))
+            # mac_a = data[index : index + 6]
+
+            # mac_a = int.from_bytes(mac_a, "big")
+            # s_mac = hex(mac_a)[2:].upper().zfill(12)
+            # m = ":".join([s_mac[i : i + 2] for i in range(0, 12, 2)])
+
+            # print(m)
+            # y = data[index + 6 :].split(b"\x00")
+
+            # # print(len(y[0]))
+            # name = y[0].decode("ascii")
+            # index = index + (len(y[0]) + 7)
+            # print(name)
+            # # print(index)
+            # unpacked_device += 1
 
-                # if False:
-                # # Decode Test Funktion som ska ligga i labview
-                # print(return_data)
-
-                # data = return_data[4:]
-                # no_of_device = int.from_bytes(return_data[0:4], "big")
-                # print(no_of_device)
-                # print(data)
-                # print(len(data))
-
-                # index = 0
-                # unpacked_device = 0
-                # while unpacked_device < no_of_device:
-                # # while len(data) - index > 6:
-                # print(index, " XXX ", len(data))
-                # mac_a = data[index : index + 6]
-
-                # mac_a = int.from_bytes(mac_a, "big")
-                # s_mac = hex(mac_a)[2:].upper().zfill(12)
-                # m = ":".join([s_mac[i : i + 2] for i in range(0, 12, 2)])
-
-                # print(m)
-                # y = data[index + 6 :].split(b"\x00")
-
-                # # print(len(y[0]))
-                # name = y[0].decode("ascii")
-                # index = index + (len(y[0]) + 7)
-                # print(name)
-                # # print(index)
-                # unpacked_device += 1
-
-            # No devices found
-            else:
-                logging.debug("No devices found")
-                connection.sendall(send_nack(msg_cmd))
-        # Missing paramter
+        # No devices found
         else:
-            connection.sendall(send_error(msg_cmd, 1))
+            logging.debug("No devices found")
+            connection.sendall(send_nack(msg_cmd))
+    # Missing paramter
+    else:
+        connection.sendall(send_error(msg_cmd, 1))
 
-    # Connect Device
-    elif msg_cmd == 0x07:
 
-        mac_address, timeout = cmd_unpack_mac_and_time(data)
+# Connect Device
+def cmd_connect_device(msg_cmd, data, connection):
 
-        if mac_address and timeout:
-            logging.debug("Execute Cmd 0x07 %s", int_to_mac(mac_address))
+    mac_address, timeout = cmd_unpack_mac_and_time(data)
 
-            # For Test 
-            # result = SynBlue.Connect_Test(int_to_mac(mac_address)) # Was comment away
-            # logging.debug("Test 6 - Connect device result = %s", result) # Was comment away
+    if mac_address and timeout:
+        logging.debug("Execute Cmd 0x07 %s", int_to_mac(mac_address))
 
-            connect_thread = threading.Thread(
-                target=thread_connect_and_wait_for_disconnect,
-                args=(
-                    int_to_mac(mac_address),
-                    timeout,
-                ),
-            )
-            connect_thread.start()
+        # For Test 
+        # result = SynBlue.Connect_Test(int_to_mac(mac_address)) # Was comment away
+        # logging.debug("Test 6 - Connect device result = %s", result) # Was comment away
 
-        else:
-            # Missing paramter
-            connection.sendall(send_error(msg_cmd, 1))
+        controlServer.claim(int_to_mac(mac_address), connection)  # The connect result goes to this client
+        connect_thread = threading.Thread(
+            target=thread_connect_and_wait_for_disconnect,
+            args=(
+                int_to_mac(mac_address),
+                timeout,
+            ),
+        )
+        connect_thread.start()
 
-    # Alexander Ström 2024-07-18 Not supported on Windows
-    # Disconnect Device
-    elif msg_cmd == 0x08:
+    else:
+        # Missing paramter
+        connection.sendall(send_error(msg_cmd, 1))
 
-        mac_addr = cmd_unpack_mac(data)
-        if mac_addr:
-            logging.debug("Execute Cmd 0x08 %s", int_to_mac(mac_addr))
-            result = SynBlue.Disconnect_Test(int_to_mac(mac_addr))
-            logging.debug(result)
 
-            if result == SynBlue.Return_type.SUCCESS:
-                connection.sendall(send_ack(msg_cmd))
-            else:
-                connection.sendall(send_nack(msg_cmd))
+# Alexander Ström 2024-07-18 Not supported on Windows
+# Disconnect Device
+def cmd_disconnect_device(msg_cmd, data, connection):
 
-        else:
-            # Missing paramter
-            connection.sendall(send_error(msg_cmd, 1))
+    mac_addr = cmd_unpack_mac(data)
+    if mac_addr:
+        logging.debug("Execute Cmd 0x08 %s", int_to_mac(mac_addr))
+        result = SynBlue.Disconnect_Test(int_to_mac(mac_addr))
+        logging.debug(result)
 
-    elif msg_cmd == 0x0A:  # FOTA
+        if result == SynBlue.Return_type.SUCCESS:
+            connection.sendall(send_ack(msg_cmd))
+        else:
+            connection.sendall(send_nack(msg_cmd))
 
-        logging.debug("Execute FOTA Cmd 0x0A")
+    else:
+        # Missing paramter
+        connection.sendall(send_error(msg_cmd, 1))
 
-        # msg_data_lenght = int.from_bytes(data[1:5], "big")
-        # msg_data = data[5:]
-        # logging.debug("Data lenght: %s", msg_data_lenght)
-        # logging.debug("Data: %s", msg_data)
-        # logging.debug((len(msg_data) == msg_data_lenght))
 
-        # binary_file = open("test_2.png", "wb")
-        # binary_file.write(msg_data)
-        # binary_file.close()
+# FOTA
+def cmd_fota(msg_cmd, data, connection):
 
-    # Alexander Ström 2024-07-18 This is a legacy command and replaced by HAPP Device Finder cmd 16
-    # Get Manufacturer data (Need to connect)
-    elif msg_cmd == 0x0B:
-        mac_addr, timeout = cmd_unpack_mac_and_time(data)
+    logging.debug("Execute FOTA Cmd 0x0A")
 
-        if mac_addr and timeout:
-            logging.debug("Execute Cmd 0x0B %s", int_to_mac(mac_addr))
+    # msg_data_lenght = int.from_bytes(data[1:5], "big")
+    # msg_data = data[5:]
+    # logging.debug("Data lenght: %s", msg_data_lenght)
+    # logging.debug("Data: %s", msg_data)
+    # logging.debug((len(msg_data) == msg_data_lenght))
 
-            try:
+    # binary_file = open("test_2.png", "wb")
+    # binary_file.write(msg_data)
+    # binary_file.close()
 
-                result = SynBlue.Get_Need_To_Connect_Test(int_to_mac(mac_addr), timeout)
 
-                if result == -1:
-                    logging.debug("No data found")
-                    connection.sendall(send_nack(msg_cmd))
+# Alexander Ström 2024-07-18 This is a legacy command and replaced by HAPP Device Finder cmd 16
+# Get Manufacturer data (Need to connect)
+def cmd_manufacturer_data(msg_cmd, data, connection):
+    mac_addr, timeout = cmd_unpack_mac_and_time(data)
 
-                else:
-                    logging.debug("Get_Manufacturer_Data: ")
-                    logging.debug(result)
-                    connection.sendall(send_result_data(msg_cmd, result))
+    if mac_addr and timeout:
+        logging.debug("Execute Cmd 0x0B %s", int_to_mac(mac_addr))
 
-            except Exception as e:
-                logging.error(f"Unexpected Error: {e}")
-                connection.sendall(send_error(msg_cmd, 2))
+        try:
 
-        else:
-            # Missing paramter
-            connection.sendall(send_error(msg_cmd, 1))
+            result = SynBlue.Get_Need_To_Connect_Test(int_to_mac(mac_addr), timeout)
 
-    # Alexander Ström 2024-07-18 This is a legacy command and might stop working after bleak update
-    # Get BLE device advertising data
-    elif msg_cmd == 0x0C:
-        mac_addr, timeout = cmd_unpack_mac_and_time(data)
+            if result == -1:
+                logging.debug("No data found")
+                connection.sendall(send_nack(msg_cmd))
 
-        if mac_addr and timeout:
-            logging.debug("Execute Cmd 0x0C %s", int_to_mac(mac_addr))
+            else:
+                logging.debug("Get_Manufacturer_Data: ")
+                logging.debug(result)
+                connection.sendall(send_result_data(msg_cmd, result))
 
-            try:
+        except Exception as e:
+            logging.error(f"Unexpected Error: {e}")
+            connection.sendall(send_error(msg_cmd, 2))
 
-                result = SynBlue.Get_Advertisement_Data_Test(
-                    int_to_mac(mac_addr), timeout
-                )
-                if result is None:
-                    logging.debug("No data found")
-                    connection.sendall(send_nack(msg_cmd))
-                else:
-                    logging.debug("Get_Advertising_Data Response Data: ")
-                    logging.debug(result)
-                    connection.sendall(send_result_data(msg_cmd, result))
+    else:
+        # Missing paramter
+        connection.sendall(send_error(msg_cmd, 1))
 
-            except Exception as e:
-                logging.error(f"Unexpected Error: {e}")
-                connection.sendall(send_error(msg_cmd, 2))
-        else:
-            # Missing paramter
-            connection.sendall(send_error(msg_cmd, 1))
 
-    # Advertisment Time Test
-    elif msg_cmd == 0x0D:
+# Alexander Ström 2024-07-18 This is a legacy command and might stop working after bleak update
+# Get BLE device advertising data
+def cmd_advertising_data(msg_cmd, data, connection):
+    mac_addr, timeout = cmd_unpack_mac_and_time(data)
 
-        mac_addr, timeout = cmd_unpack_mac_and_time(data)
+    if mac_addr and timeout:
+        logging.debug("Execute Cmd 0x0C %s", int_to_mac(mac_addr))
 
-        if mac_addr and timeout:
-            logging.debug("Execute Cmd 0x0D %s %s", int_to_mac(mac_addr), timeout)
+        try:
 
-            try:
+            result = SynBlue.Get_Advertisement_Data_Test(
+                int_to_mac(mac_addr), timeout
+            )
+            if result is None:
+                logging.debug("No data found")
+                connection.sendall(send_nack(msg_cmd))
+            else:
+                logging.debug("Get_Advertising_Data Response Data: ")
+                logging.debug(result)
+                connection.sendall(send_result_data(msg_cmd, result))
 
-                timestamps = SynBlue.Advertisement_Period_Test(timeout, int_to_mac(mac_addr))
-                logging.debug("Advertisement timestamp [ms]")
-                logging.debug(timestamps)
+        except Exception as e:
+            logging.error(f"Unexpected Error: {e}")
+            connection.sendall(send_error(msg_cmd, 2))
+    else:
+        # Missing paramter
+        connection.sendall(send_error(msg_cmd, 1))
 
-                if (len(timestamps)) > 0:
 
-                    return_data = bytearray()
+# Advertisment Time Test
+def cmd_advertisement_period(msg_cmd, data, connection):
 
-                    return_data.extend(
-                        len(timestamps).to_bytes(2, byteorder="big", signed=False)
-                    )  # Nr of timestamps 2 Bytes
+    mac_addr, timeout = cmd_unpack_mac_and_time(data)
 
-                    if len(timestamps) > 0:
-                        start_timestamp = timestamps[0]
+    if mac_addr and timeout:
+        logging.debug("Execute Cmd 0x0D %s %s", int_to_mac(mac_addr), timeout)
 
-                    for timestamp in timestamps:
-                        timestamp_ms = int(
-                            (timestamp - start_timestamp) / 1000000
-                        )  # ns to ms
-                        logging.debug(timestamp_ms)
+        try:
 
-                        return_data.extend(
-                            timestamp_ms.to_bytes(4, byteorder="big", signed=False)
-                        )  # 4 Bytes
+            timestamps = SynBlue.Advertisement_Period_Test(timeout, int_to_mac(mac_addr))
+            logging.debug("Advertisement timestamp [ms]")
+            logging.debug(timestamps)
 
-                    # Send Data
-                    connection.sendall(send_result_data(msg_cmd, return_data))
-                # No Timestamps found
-                else:
-                    logging.debug("No timestamps found")
-                    connection.sendall(send_nack(msg_cmd))
+            if (len(timestamps)) > 0:
 
-            except Exception as e:
-                logging.error(f"Unexpected Error: {e}")
-                connection.sendall(send_error(msg_cmd, 2))
+                return_data = bytearray()
 
-        else:
-            # Missing paramter
-            connection.sendall(send_error(msg_cmd, 1))
+                return_data.extend(
+                    len(timestamps).to_bytes(2, byteorder="big", signed=False)
+                )  # Nr of timestamps 2 Bytes
 
-    elif msg_cmd == 0x0E:  # Start Gateway
-        # saveSessionData("macToGWdata", bytearray_to_base64_str(data))
-        deviceUUID = ""
+                if len(timestamps) > 0:
+                    start_timestamp = timestamps[0]
 
-        logging.debug("Execute Start Gateway Cmd 0x0E")
+                for timestamp in timestamps:
+                    timestamp_ms = int(
+                        (timestamp - start_timestamp) / 1000000
+                    )  # ns to ms
+                    logging.debug(timestamp_ms)
 
-        mac_addr, timeout = cmd_unpack_mac_and_time(data)
-        mac = int_to_mac(mac_addr)
-        autoreconnect = cmd_unpack_autoreconnect_value(data)  # Check if auto reconnect should be active or not
-        ip, port = cmd_unpack_ip_and_port(data)
+                    return_data.extend(
+                        timestamp_ms.to_bytes(4, byteorder="big", signed=False)
+                    )  # 4 Bytes
 
-        for x in range(4):
-            breakOuterLoop = False
-            HAPPDevices = sessionData.lastHAPPScan
-            if HAPPDevices is None:
-                HAPPDevices = startSearch()
-            for device in HAPPDevices:
-                currentMac = device["mac"]
-                deviceUUID = device["uuid"]  # Used later to get alias for the BLE device
-                sessionData.connectedDeviceIPRID = deviceUUID
-
-                if currentMac == mac:
-                    logging.debug(f"{mac_addr} is in HAPP device list, starting gateway")
-                    eel.putRLog(f"app.py: {mac_addr} is in HAPP device list, starting gateway")
-                    # Add device secrets to Leshan
-                    push_secrets_to_leshan(deviceUUID)
-                    breakOuterLoop = True
-                    break
-
-            if breakOuterLoop:
-                break
+                # Send Data
+                connection.sendall(send_result_data(msg_cmd, return_data))
+            # No Timestamps found
             else:
-                HAPPDevices = startSearch()
+                logging.debug("No timestamps found")
+                connection.sendall(send_nack(msg_cmd))
 
-            if x == 3:
-                connection.sendall(send_error(msg_cmd, 3))
-                return None
+        except Exception as e:
+            logging.error(f"Unexpected Error: {e}")
+            connection.sendall(send_error(msg_cmd, 2))
 
-        if mac_addr and timeout:
+    else:
+        # Missing paramter
+        connection.sendall(send_error(msg_cmd, 1))
 
-            try:
 
-                # The gateway is callstop, kill it! # TODO Fix the close
-                try:
-                    if not currentThread_Gateway is None:
-                        logging.debug(currentThread_Gateway.is_alive())
-                        if currentThread_Gateway.is_alive():
-                            gateway_stop.set()  # Set triggers gateway.monitor_thread which terminates thread
-                            currentThread_Gateway.join()
-                            logging.debug("Gateway Terminated")
-                            # time.sleep(20)
-                except AttributeError as e:
-                    logging.error(f"Error terminating currentThread_Gateway: {e}")
-
-                except Exception as e:
-                    logging.error(f"Unexpected Error: {e}")
-                    connection.sendall(send_error(msg_cmd, 2))
-
-                # If Leshan on another machine get IP
-                if port is None:
-                    port = 5684
-                if ip is None:
-                    ip = config.get('LESHAN', 'IP')
-
-                gateway_stop = threading.Event()
-
-                # Start a new process with the gateway
-                currentThread_Gateway = threading.Thread(
-                    target=launch,
-                    args=(
-                        mac,  # From Client
-                        "random",  # FG, Hardcoded
-                        "adapter",  # FG, Dummy data
-                        "0",  # FG, Dummy data
-                        "0",  # FG, Dummy data
-                        port,  # From Client
-                        ip,  # From Client
-                        True,  # Debug On/Off
-                        callbackfunk_gateway,  # Server Callback to Client
-                        timeout,  # From Client
-                        autoreconnect,  # Auto reconnect
-                        gateway_stop,  # SIGTERM solution for threading compatible with Windows
-                    ),
-                )
-
-                currentThread_Gateway.start()
-                logging.debug(f"Gateway Started with auto reconnect: {autoreconnect}")
-                eel.putRLog(f"app.py: Gateway Started with auto reconnect: {autoreconnect}")
-
-                if currentThread_Gateway.is_alive():
-                    sessionData.runningGateway = True
+# Start Gateway
+def cmd_start_gateway(msg_cmd, data, connection):
+    # saveSessionData("macToGWdata", bytearray_to_base64_str(data))
 
-                getDeviceAlias(deviceUUID)  # Get alias for the connected BLE device
+    logging.debug("Execute Start Gateway Cmd 0x0E")
 
-            except Exception as e:
-                logging.error(f"Unexpected Error: {e}")
-                connection.sendall(send_error(msg_cmd, 2))
+    mac_addr, timeout = cmd_unpack_mac_and_time(data)
+    mac = int_to_mac(mac_addr)
+    autoreconnect = cmd_unpack_autoreconnect_value(data)  # Check if auto reconnect should be active or not
+    ip, port = cmd_unpack_ip_and_port(data)
 
-        else:
-            # Missing paramter
-            connection.sendall(send_error(msg_cmd, 1))
+    deviceUUID = None  # Used later to get alias for the BLE device
+    if gatewayManager.is_running(mac):
+        # A connected device does not advertise, it was found when its running gateway was started
+        deviceUUID = next((d["uuid"] for d in sessionData.lastHAPPScan or [] if d["mac"] == mac), None)
+    if deviceUUID is None:
+        # Stops scanning as soon as the device advertises, answered at once when it was seen recently
+        happDevice = findHappDevice(mac=mac)
+        if happDevice is None:
+            connection.sendall(send_error(msg_cmd, 3))
+            return None
+        deviceUUID = happDevice.iprid
 
-    elif msg_cmd == 0x0F:  # Stop Gateway
-        logging.debug("Execute Stop Gateway Cmd 0x0F")
+    if sessionData.is_current_device(mac):
+        sessionData.connectedDeviceIPRID = deviceUUID
+    logging.debug(f"{mac_addr} is a HAPP device, starting gateway")
+    logRelay.put(f"app.py: {mac_addr} is a HAPP device, starting gateway")
+    # Add device secrets to Leshan
+    push_secrets_to_leshan(deviceUUID)
+
+    if mac_addr and timeout:
 
         try:
 
-            # If the gateway is not closed already
-            if not currentThread_Gateway is None:
-                if currentThread_Gateway.is_alive():
-                    gateway_stop.set()
-                    currentThread_Gateway.join()
-                    logging.debug("Gateway Terminated")
-                    eel.putRLog(f"app.py: Gateway Terminated")
-                    eel.changeConnectStatus("Gateway Terminated")
-                    sessionData.connectStatusCode = 0
-                    sessionData.runningGateway = False
-                    clearDeviceData()
-
-                currentThread_Gateway = None
-                logging.debug("Gateway Closed")
-                eel.putRLog(f"app.py: Gateway Closed")
+            # If Leshan on another machine get IP
+            if port is None:
+                port = 5684
+            if ip is None:
+                ip = config.get('LESHAN', 'IP')
+
+            # Start a new gateway session for the device, a running session for the same device is replaced.
+            # The notifications for the device go to this client
+            controlServer.claim(mac, connection)
+            gatewayManager.start(
+                mac,  # From Client
+                "random",  # FG, Hardcoded
+                port,  # From Client
+                ip,  # From Client
+                True,  # Debug On/Off
+                callbackfunk_gateway,  # Server Callback to Client
+                timeout,  # From Client
+                autoreconnect,  # Auto reconnect
+            )
+            logging.debug(f"Gateway Started with auto reconnect: {autoreconnect}")
+            logRelay.put(f"app.py: Gateway Started with auto reconnect: {autoreconnect}")
 
-            connection.sendall(send_ack(msg_cmd))
+            if sessionData.is_current_device(mac):
+                getDeviceAlias(deviceUUID)  # Get alias for the connected BLE device
 
         except Exception as e:
             logging.error(f"Unexpected Error: {e}")
-            # Send Exception
             connection.sendall(send_error(msg_cmd, 2))
 
-    elif msg_cmd == 0x10:  # List HAPP devices with associated info
-        logging.debug("Execute Cmd 0x10")
+    else:
+        # Missing paramter
+        connection.sendall(send_error(msg_cmd, 1))
 
-        timeout = cmd_unpack_time(data)
 
-        HAPPDevices = startSearch(timeout)
-        logging.debug("The Devices Found is: ")
-        if HAPPDevices:
+# Stop Gateway, optionally followed by the MAC of the gateway to stop (otherwise all)
+def cmd_stop_gateway(msg_cmd, data, connection):
+    logging.debug("Execute Stop Gateway Cmd 0x0F")
 
-            return_data = bytearray()
+    try:
+        mac_addr = cmd_unpack_mac(data)
+        if mac_addr:
+            stopped = gatewayManager.stop(int_to_mac(mac_addr))
+        else:
+            stopped = gatewayManager.stop_all()
 
-            return_data.extend(
-                len(HAPPDevices).to_bytes(4, byteorder="big", signed=False)
-            )  # Nr of device 4 Byte
+        # If the gateway is not closed already. It disconnects in the background, the TCP thread does not wait. The
+        # status is set to 0 (Gateway Terminated) by the gateway manager when the session has finished
+        if stopped:
+            logging.debug("Gateway stop requested")
+            logRelay.put(f"app.py: Gateway stop requested")
 
-            for dev in HAPPDevices:
-                logging.debug(dev)
-                # Device Mac adress 6 byte
-                mac = dev["mac"].replace(":", "")
-                # eel.putRLog(f"Mac {mac}")
-                return_data.extend(bytearray.fromhex(mac))
-                # eel.putRLog(f"Mac bytearray {bytearray.fromhex(mac)}")
+        logging.debug("Gateway Closed")
+        logRelay.put(f"app.py: Gateway Closed")
 
-                # Device uuid ASCII String
-                name_ascii = bytes(dev["uuid"], "ascii")
-                return_data.extend(name_ascii)
+        connection.sendall(send_ack(msg_cmd))
 
-                # Device NTC (Need to Connect) ASCII String
-                NTC = bytes(dev["NTC"])
-                return_data.extend(NTC)
+    except Exception as e:
+        logging.error(f"Unexpected Error: {e}")
+        # Send Exception
+        connection.sendall(send_error(msg_cmd, 2))
 
-                # Device DNC (Do not Connect) ASCII String
-                DNC = bytes(dev["DNC"])
-                return_data.extend(DNC)
 
-                # Device rssi ASCII String
-                rssi_ascii = bytes(dev["rssi"], "ascii")
-                return_data.extend(rssi_ascii)
+# List HAPP devices with associated info
+def cmd_list_happ_devices(msg_cmd, data, connection):
+    global HAPPDevices
+    logging.debug("Execute Cmd 0x10")
 
-                # Device alias null terminted ASCII String
-                alias_ascii = bytes(dev["alias"], "ascii") + b"\x00"
-                return_data.extend(alias_ascii)
+    timeout = cmd_unpack_time(data)
 
-            # Send Data
-            connection.sendall(send_result_data(msg_cmd, return_data))
+    HAPPDevices = startSearch(timeout)
+    logging.debug("The Devices Found is: ")
+    if HAPPDevices:
 
-        # No devices found
-        else:
-            logging.debug("No devices found")
-            connection.sendall(send_nack(msg_cmd))
+        return_data = bytearray()
 
-    elif msg_cmd == 0x11:  # Return connected device HID
-        logging.debug("Execute Cmd 0x11")
+        return_data.extend(
+            len(HAPPDevices).to_bytes(4, byteorder="big", signed=False)
+        )  # Nr of device 4 Byte
 
-        if sessionData.connectedDeviceHID is not None:
-            logging.debug(sessionData.connectedDeviceHID)
-            return_data = bytearray()
+        for dev in HAPPDevices:
+            logging.debug(dev)
+            # Device Mac adress 6 byte
+            mac = dev["mac"].replace(":", "")
+            # logRelay.put(f"Mac {mac}")
+            return_data.extend(bytearray.fromhex(mac))
+            # logRelay.put(f"Mac bytearray {bytearray.fromhex(mac)}")
 
-            hid_ascii = bytes(sessionData.connectedDeviceHID, "ascii")
-            return_data.extend(hid_ascii)
+            # Device uuid ASCII String
+            name_ascii = bytes(dev["uuid"], "ascii")
+            return_data.extend(name_ascii)
 
-            # Send Data
-            connection.sendall(send_result_data(msg_cmd, return_data))
+            # Device NTC (Need to Connect) ASCII String
+            NTC = bytes(dev["NTC"])
+            return_data.extend(NTC)
 
-        # No devices found
-        else:
-            logging.debug("No HID present")
-            connection.sendall(send_nack(msg_cmd))
+            # Device DNC (Do not Connect) ASCII String
+            DNC = bytes(dev["DNC"])
+            return_data.extend(DNC)
 
-    elif msg_cmd == 0x12:  # Return connected device Alias
-        logging.debug("Execute Cmd 0x12")
+            # Device rssi ASCII String
+            rssi_ascii = bytes(dev["rssi"], "ascii")
+            return_data.extend(rssi_ascii)
 
-        if sessionData.connectedDeviceAlias is not None:
+            # Device alias null terminted ASCII String
+            alias_ascii = bytes(dev["alias"], "ascii") + b"\x00"
+            return_data.extend(alias_ascii)
 
-            return_data = bytearray()
+        # Send Data
+        connection.sendall(send_result_data(msg_cmd, return_data))
 
-            alias_ascii = bytes(sessionData.connectedDeviceAlias, "ascii")
-            return_data.extend(alias_ascii)
+    # No devices found
+    else:
+        logging.debug("No devices found")
+        connection.sendall(send_nack(msg_cmd))
 
-            # Send Data
-            connection.sendall(send_result_data(msg_cmd, return_data))
 
-        # No devices found
-        else:
-            logging.debug("No alias registered")
-            connection.sendall(send_nack(msg_cmd))
+# Return connected device HID
+def cmd_device_hid(msg_cmd, data, connection):
+    logging.debug("Execute Cmd 0x11")
 
-    elif msg_cmd == 0x13:  # Set new alias for the connected device
-        logging.debug("Execute Cmd 0x13")
+    if sessionData.connectedDeviceHID is not None:
+        logging.debug(sessionData.connectedDeviceHID)
+        return_data = bytearray()
 
-        if sessionData.connectStatusCode == 1 and sessionData.connectedDeviceIPRID is not None:
-            newAlias = cmd_unpack_alias(data)
-            if addAlias(sessionData.connectedDeviceIPRID, newAlias):
-                connection.sendall(send_ack(msg_cmd))
-                sessionData.connectedDeviceAlias = newAlias
-                connection.sendall(send_ack(msg_cmd))
-                eel.pingFrontend()
-            else:
-                logging.debug("Failed to register alias")
-                connection.sendall(send_nack(msg_cmd))
-        # No devices found
-        else:
-            logging.debug("Not allowed to set new alias")
-            connection.sendall(send_nack(msg_cmd))
+        hid_ascii = bytes(sessionData.connectedDeviceHID, "ascii")
+        return_data.extend(hid_ascii)
+
+        # Send Data
+        connection.sendall(send_result_data(msg_cmd, return_data))
+
+    # No devices found
+    else:
+        logging.debug("No HID present")
+        connection.sendall(send_nack(msg_cmd))
+
+
+# Return connected device Alias
+def cmd_device_alias(msg_cmd, data, connection):
+    logging.debug("Execute Cmd 0x12")
+
+    if sessionData.connectedDeviceAlias is not None:
+
+        return_data = bytearray()
 
-    elif msg_cmd == 0x14:  # Set new key for IPRID
-        logging.debug("Execute Cmd 0x14")
+        alias_ascii = bytes(sessionData.connectedDeviceAlias, "ascii")
+        return_data.extend(alias_ascii)
+
+        # Send Data
+        connection.sendall(send_result_data(msg_cmd, return_data))
+
+    # No devices found
+    else:
+        logging.debug("No alias registered")
+        connection.sendall(send_nack(msg_cmd))
 
-        iprid = cmd_unpack_iprid(data)
-        key = cmd_unpack_secretkey(data)
 
-        if addKey(iprid, key):
+# Set new alias for the connected device
+def cmd_set_alias(msg_cmd, data, connection):
+    logging.debug("Execute Cmd 0x13")
+
+    if sessionData.connectStatusCode == 1 and sessionData.connectedDeviceIPRID is not None:
+        newAlias = cmd_unpack_alias(data)
+        if addAlias(sessionData.connectedDeviceIPRID, newAlias):
+            connection.sendall(send_ack(msg_cmd))
+            sessionData.connectedDeviceAlias = newAlias
             connection.sendall(send_ack(msg_cmd))
+            eel.pingFrontend()
         else:
+            logging.debug("Failed to register alias")
             connection.sendall(send_nack(msg_cmd))
+    # No devices found
+    else:
+        logging.debug("Not allowed to set new alias")
+        connection.sendall(send_nack(msg_cmd))
 
-    elif msg_cmd == 0x17:  # Return SBLETS UUID (8 characters is from SBLETS, and 16 characters is from connected HAPP)
-        # device)
-        logging.debug("Execute Cmd 0x17")
 
-        if getSessionData("uniqueSessionUUID") is not None:
-            return_data = bytearray()
+# Set new key for IPRID
+def cmd_set_key(msg_cmd, data, connection):
+    logging.debug("Execute Cmd 0x14")
 
-            uuid = bytes(sessionData.uniqueSessionUUID, "ascii")
-            return_data.extend(uuid)
+    iprid = cmd_unpack_iprid(data)
+    key = cmd_unpack_secretkey(data)
 
-            # Send Data
-            connection.sendall(send_result_data(msg_cmd, return_data))
+    if addKey(iprid, key):
+        connection.sendall(send_ack(msg_cmd))
+    else:
+        connection.sendall(send_nack(msg_cmd))
 
-        # No devices found
-        else:
-            logging.debug("No UUID present!")
-            connection.sendall(send_nack(msg_cmd))
 
-    elif msg_cmd == 0x18:  # Return connect status code
-        logging.debug("Execute Cmd 0x18")
+# Return SBLETS UUID (8 characters is from SBLETS, and 16 characters is from connected HAPP device)
+def cmd_session_uuid(msg_cmd, data, connection):
+    logging.debug("Execute Cmd 0x17")
 
-        if sessionData.connectStatusCode is not None:
+    if getSessionData("uniqueSessionUUID") is not None:
+        return_data = bytearray()
 
-            # Send Data
-            connection.sendall(send_result_data(msg_cmd, sessionData.connectStatusCode))
+        uuid = bytes(sessionData.uniqueSessionUUID, "ascii")
+        return_data.extend(uuid)
 
-        # No devices found
-        else:
-            logging.debug("No status code present!")
-            connection.sendall(send_nack(msg_cmd))
+        # Send Data
+        connection.sendall(send_result_data(msg_cmd, return_data))
 
+    # No devices found
     else:
+        logging.debug("No UUID present!")
+        connection.sendall(send_nack(msg_cmd))
+
+
+# Return connect status code
+def cmd_status_code(msg_cmd, data, connection):
+    logging.debug("Execute Cmd 0x18")
+
+    if sessionData.connectStatusCode is not None:
+
+        # Send Data
+        connection.sendall(send_result_data(msg_cmd, sessionData.connectStatusCode))
+
+    # No devices found
+    else:
+        logging.debug("No status code present!")
+        connection.sendall(send_nack(msg_cmd))
+
+
+# Return status of all gateway sessions
+def cmd_gateway_status(msg_cmd, data, connection):
+    logging.debug("Execute Cmd 0x19")
+
+    sessions = gatewayManager.status()
+    return_data = bytearray()
+
+    return_data.extend(
+        len(sessions).to_bytes(4, byteorder="big", signed=False)
+    )  # Nr of sessions 4 Byte
+
+    for session in sessions:
+        # Device Mac adress 6 byte
+        return_data.extend(bytearray.fromhex(session["mac"].replace(":", "")))
+        # Session state 1 byte (0 = starting, 1 = connected, 2 = stopping, 3 = stopped)
+        return_data.append(session["state"])
+        # Session uptime in seconds 4 Byte
+        return_data.extend(session["uptime"].to_bytes(4, byteorder="big", signed=False))
+
+    # Send Data
+    connection.sendall(send_result_data(msg_cmd, return_data))
+
+
+# Return gateway statistics, optionally followed by the MAC of one gateway
+def cmd_gateway_stats(msg_cmd, data, connection):
+    logging.debug("Execute Cmd 0x1A")
+
+    mac_addr = cmd_unpack_mac(data)
+    stats = gatewayManager.stats(int_to_mac(mac_addr) if mac_addr else None)
+
+    # Statistics as a JSON ASCII string, {mac: {"uplink": {...}, "downlink": {...}, ...}}
+    return_data = bytearray()
+    return_data.extend(bytes(json.dumps(stats), "ascii"))
+
+    # Send Data
+    connection.sendall(send_result_data(msg_cmd, return_data))
+
+
+# Return gateway latency percentiles, optionally followed by the MAC of one gateway
+def cmd_gateway_latency(msg_cmd, data, connection):
+    logging.debug("Execute Cmd 0x1B")
+
+    mac_addr = cmd_unpack_mac(data)
+    latency = gatewayManager.latency(int_to_mac(mac_addr) if mac_addr else None)
+
+    # Latency as a JSON ASCII string, {mac: {"uplink": {"frames": n, "notify-frame": {"p50": ms, ...}, ...},
+    # "downlink": {...}}}, null for a gateway without latency tracing
+    return_data = bytearray()
+    return_data.extend(bytes(json.dumps(latency), "ascii"))
+
+    # Send Data
+    connection.sendall(send_result_data(msg_cmd, return_data))
+
+# Command byte -> (handler, long running). The long running commands run on the command worker pool
+# (command_dispatch.py), the others at once on the command thread
+COMMAND_HANDLERS = {
+    0x04: (cmd_connect_server, False),
+    0x05: (cmd_disconnect_server, False),
+    0x06: (cmd_list_devices, True),
+    0x07: (cmd_connect_device, False),  # Connects in a thread of its own
+    0x08: (cmd_disconnect_device, True),
+    0x0A: (cmd_fota, False),
+    0x0B: (cmd_manufacturer_data, True),
+    0x0C: (cmd_advertising_data, True),
+    0x0D: (cmd_advertisement_period, True),
+    0x0E: (cmd_start_gateway, True),
+    0x0F: (cmd_stop_gateway, False),
+    0x10: (cmd_list_happ_devices, True),
+    0x11: (cmd_device_hid, False),
+    0x12: (cmd_device_alias, False),
+    0x13: (cmd_set_alias, False),
+    0x14: (cmd_set_key, False),
+    0x17: (cmd_session_uuid, False),
+    0x18: (cmd_status_code, False),
+    0x19: (cmd_gateway_status, False),
+    0x1A: (cmd_gateway_stats, False),
+    0x1B: (cmd_gateway_latency, False),
+}
+commandDispatcher = CommandDispatcher(COMMAND_HANDLERS, send_error)
+
+
+# connection is the control_server.ControlSession the command came from, or its ControlRequest with request IDs
+def parse_msg(data, connection):
+    print("Message detected!")
+    logging.debug("Message detected!")
+
+    # Received Command
+    msg_cmd = data[0]
+    logging.debug("cmd: %s", msg_cmd)
+    logRelay.put(f"app.py: cmd: {msg_cmd}")
+
+    # -- Print warning for deprecated or unsupported commands --
+    if msg_cmd == 0x06 or msg_cmd == 0x0B or msg_cmd == 0x0C:
+        logging.warning(f"cmd: {msg_cmd} is a legacy and deprecated command consider using 0x10 (16) instead!")
+        logRelay.put(f"app.py: cmd: {msg_cmd} is a legacy and deprecated command consider using 0x10 (16) instead!")
+
+    if msg_cmd == 0x08 and sys.platform == 'win32':
+        logging.warning(f"cmd: {msg_cmd} is not supported on Windows!")
+        logRelay.put(f"app.py: cmd: {msg_cmd} is not supported on Windows!")
+    # ----------------------------------------------------------
+
+    if not commandDispatcher.dispatch(msg_cmd, data, connection):
         logging.warning("Not a valid cmd: %s", msg_cmd)
         # Not Valid Cmd
         connection.sendall(send_error(msg_cmd, 3))
@@ -1350,7 +1313,7 @@ def parse_msg(data):
     return None
 
 
-def process_cmd(data_in):
+def process_cmd(data_in, session):
     logging.debug("Process Data:")
     setStatus("Busy", "server")
     logging.debug(data_in)
@@ -1358,17 +1321,20 @@ def process_cmd(data_in):
 
     decoded_data = SynProtocol.decode_data(bytearray(data_in))
 
-    parse_msg(decoded_data)
+    try:
+        # With request IDs the replies go through a ControlRequest carrying the ID of the command
+        connection, decoded_data = session.open_request(decoded_data)
+    except ValueError as e:
+        logging.warning(e)
+        setStatus("Ready", "server")
+        return
+
+    parse_msg(decoded_data, connection)
     logging.debug("Process Data Done")
     setStatus("Ready", "server")
 
 
 def main():
-    global connect_data
-    global currentThread_Gateway
-    connect_data = {"user_connected": False, "conn": "", "addr": None}
-    currentThread_Gateway = None
-
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description="SBLETS Server Application",
@@ -1447,7 +1413,7 @@ def main():
         # add the handler to the root logger
         logging.getLogger("").addHandler(console)
 
-    # Incoming data seq
+    # Incoming commands, (ControlSession, command data)
     command_queue = queue.Queue()
 
     # Start webserver
@@ -1462,8 +1428,7 @@ def main():
 
     time.sleep(1)  # Let webserver start before anything else
 
-    x = threading.Thread(target=server_part, args=(command_queue,))
-    x.start()
+    controlServer.start(command_queue)
     # logging.info("TCP Server Started")
 
     # Start the WebSocket server in a separate thread
@@ -1473,6 +1438,11 @@ def main():
     sbletsProtocol = threading.Thread(target=sblets_discover_protocol)
     sbletsProtocol.start()
 
+    logRelay.start()
+
+    if observerEnabled:
+        happObserver.start()
+
     setStatus("Ready", "server")
 
     shortUUID = str(uuidTool.uuid4())[:8]
@@ -1481,54 +1451,30 @@ def main():
     sessionData.startupUniqueSessionUUID = shortUUID
     eel.pingFrontend()
 
-    cmd_data = []
-    start_cmd_found = False
-    end_cmd_found = False
-
     while True:
 
         try:
 
-            if not command_queue.empty():
-
-                item = command_queue.get()
-                if item is None:
-                    logging.debug("if item is None")
-                    break
-                logging.debug("New Item: ")
-                logging.debug(item)
-
-                for b in item:
-
-                    if start_cmd_found:
-                        end_cmd_found = False
-
-                        if b == 0x03:
-                            logging.debug("ETX Found")
-                            process_cmd(cmd_data)
-                            cmd_data.clear()
-                            start_cmd_found = False
-
-                        elif b == 0x02:
-                            logging.warning("STX Found before ETX")
-                            # Found Start before the end, clear buffer
-                            cmd_data.clear()
-                        else:
-                            cmd_data.append(b)
+            # A command is processed as soon as it arrives, the TCP thread is checked while no command arrives
+            try:
+                item = command_queue.get(timeout=TCP_THREAD_CHECK_INTERVAL)
+            except queue.Empty:
+                if not controlServer.is_running():
+                    logging.debug("TCP socket thread dead, restarting!")
+                    logRelay.put("app.py: TCP socket thread dead, restarting!")
+                    controlServer.start(command_queue)
+                continue
 
-                    else:
-                        if b == 0x02:
-                            logging.debug("STX Found")
-                            start_cmd_found = True
+            if item is None:
+                logging.debug("if item is None")
+                break
+            session, cmd_data = item
+            logging.debug(f"New Item from {session}: ")
+            logging.debug(cmd_data)
 
-                command_queue.task_done()
+            process_cmd(cmd_data, session)
 
-            else:
-                time.sleep(0.5)
-                if not x.is_alive():
-                    logging.debug("TCP socket thread dead, restarting!")
-                    eel.putRLog("app.py: TCP socket thread dead, restarting!")
-                    x.start()
+            command_queue.task_done()
 
         except Exception as e:
             logging.error(f"Unexpected Error: {e}")
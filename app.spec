@@ -49,6 +49,11 @@ a = Analysis(
         ('SynBlue.py', '.'),
         ('SynProtocol.py', '.'),
         ('SessionData.py', '.'),
+        ('LogRelay.py', '.'),
+        ('ble_backend.py', '.'),
+        ('ble_simulator.py', '.'),
+        ('control_server.py', '.'),
+        ('command_dispatch.py', '.'),
         ('webserver.py', '.'),
         ('bluetoothctl_wrapper.py', '.'),
         ('plot.py', '.'),
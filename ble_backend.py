@@ -0,0 +1,22 @@
+# Description: BLE backend
+# Author: Syncore Technologies AB
+#
+# BleakScanner and BleakClient used by the gateway, the HAPP device finder and SynBlue. Selected with
+# config.ini [BLE] Backend, "bleak" for the Bluetooth adapter or "simulated" for the in-process HAPP peripherals in
+# ble_simulator.py, so the whole stack can run on machines without Bluetooth.
+# -----------------------------------------------------------------
+
+import configparser
+import logging
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+bleBackend = config.get("BLE", "Backend", fallback="bleak")
+
+if bleBackend == "simulated":
+    from ble_simulator import BleakClient, BleakScanner
+
+    logging.warning("Using the simulated BLE backend, no Bluetooth adapter is used")
+else:
+    from bleak import BleakClient, BleakScanner
@@ -0,0 +1,327 @@
+# Description: Simulated BLE backend
+# Author: Syncore Technologies AB
+#
+# In-process stand-in for bleak's BleakScanner and BleakClient (selected with config.ini [BLE] Backend = simulated,
+# see ble_backend.py). The simulated HAPP peripherals advertise a service UUID (the IPRID), RSSI and manufacturer
+# data (company 0x0426) and have the Hqv BLE service with the write (98bd0002) and notify (98bd0003)
+# characteristics. Every complete Hqv linked-layer frame written to a peripheral is echoed back as notifications,
+# after the configured link latency. Writes and notifications are lost with the configured probability.
+# -----------------------------------------------------------------
+
+import asyncio
+import configparser
+import inspect
+import random
+import struct
+import uuid
+
+from bleak.exc import BleakError
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+SERVICE_UUID = "98bd0001-0b0e-421a-84e5-ddbf75dc6de4"
+WRITE_UUID = "98bd0002-0b0e-421a-84e5-ddbf75dc6de4"
+NOTIFY_UUID = "98bd0003-0b0e-421a-84e5-ddbf75dc6de4"
+COMPANY_CODE = 0x0426
+HQV_LINKED_LAYER_MESSAGE_TYPE = 0x01
+
+# Comma separated MAC addresses, or a number of devices with generated addresses
+simDevices = config.get("BLE SIMULATOR", "Devices", fallback="1")
+simLatency = float(config.get("BLE SIMULATOR", "Latency ms", fallback="5")) / 1000
+simLoss = float(config.get("BLE SIMULATOR", "Loss", fallback="0"))
+simRssi = int(config.get("BLE SIMULATOR", "RSSI", fallback="-60"))
+simMtu = int(config.get("BLE SIMULATOR", "MTU", fallback="247"))
+simAdvertisingInterval = float(config.get("BLE SIMULATOR", "Advertising interval ms", fallback="100")) / 1000
+
+
+def _lost():
+    return simLoss > 0 and random.random() < simLoss
+
+
+class BLEDevice:
+    def __init__(self, address, name, rssi, advertisement):
+        self.address = address
+        self.name = name
+        self.rssi = rssi
+        self.details = None
+        self.metadata = {"uuids": advertisement.service_uuids, "manufacturer_data": advertisement.manufacturer_data}
+
+    def __repr__(self):
+        return f"BLEDevice({self.address}, {self.name})"
+
+
+class AdvertisementData:
+    def __init__(self, local_name, service_uuids, manufacturer_data, rssi):
+        self.local_name = local_name
+        self.service_uuids = service_uuids
+        self.manufacturer_data = manufacturer_data
+        self.service_data = {}
+        self.tx_power = None
+        self.rssi = rssi
+
+
+class GATTCharacteristic:
+    def __init__(self, uuid, properties, handle):
+        self.uuid = uuid
+        self.properties = properties
+        self.handle = handle
+
+    def __repr__(self):
+        return f"{self.uuid} ({', '.join(self.properties)})"
+
+
+class GATTService:
+    def __init__(self, uuid, characteristics):
+        self.uuid = uuid
+        self.characteristics = characteristics
+
+
+# Iterates over the services like bleak's BleakGATTServiceCollection
+class GATTServiceCollection(list):
+    def get_characteristic(self, specifier):
+        for service in self:
+            for characteristic in service.characteristics:
+                if specifier in (characteristic.handle, characteristic.uuid):
+                    return characteristic
+        return None
+
+
+# A HAPP device, reassembles the written Hqv frames and echoes them back
+class SimulatedPeripheral:
+    def __init__(self, address, iprid=None, rssi=None, flags=0):
+        self.address = address.upper()
+        self.iprid = iprid or str(uuid.uuid5(uuid.NAMESPACE_OID, self.address))
+        self.rssi = simRssi if rssi is None else rssi
+        self.flags = flags  # Byte 22 of the manufacturer data, bit 0 is Need To Connect
+        self.mtu = simMtu
+        self.services = GATTServiceCollection([
+            GATTService(SERVICE_UUID, [
+                GATTCharacteristic(WRITE_UUID, ["write-without-response", "write"], 11),
+                GATTCharacteristic(NOTIFY_UUID, ["notify"], 13),
+            ])
+        ])
+        self.client = None
+        self._buffer = bytearray()
+        self.written = 0
+        self.echoed = 0
+
+    def advertisement(self):
+        manufacturerData = bytearray(24)
+        manufacturerData[4:20] = uuid.UUID(self.iprid).bytes[::-1]
+        manufacturerData[22] = self.flags
+        rssi = self.rssi + random.randint(-3, 3)
+        return AdvertisementData(f"HAPP {self.address[-5:]}", [self.iprid], {COMPANY_CODE: bytes(manufacturerData)},
+                                 rssi)
+
+    def device(self):
+        advertisement = self.advertisement()
+        return BLEDevice(self.address, advertisement.local_name, advertisement.rssi, advertisement)
+
+    def write(self, data):
+        self.written += 1
+        self._buffer += data
+        while len(self._buffer) >= 3:
+            if self._buffer[0] != HQV_LINKED_LAYER_MESSAGE_TYPE:
+                self._buffer.clear()  # Out of sync, wait for the next frame
+                break
+            frameSize = struct.unpack_from("!H", self._buffer, 1)[0] + 3
+            if len(self._buffer) < frameSize:
+                break
+            frame = bytes(self._buffer[:frameSize])
+            del self._buffer[:frameSize]
+            self.echo(frame)
+
+    def echo(self, frame):
+        if self.client is None:
+            return
+        self.echoed += 1
+        chunk = self.mtu - 3
+        for i in range(0, len(frame), chunk):
+            self.client._notify(frame[i:i + chunk])
+
+    def reset(self):
+        self._buffer.clear()
+
+
+simulatedDevices = {}
+
+
+def add_device(address, iprid=None, rssi=None, flags=0):
+    peripheral = SimulatedPeripheral(address, iprid, rssi, flags)
+    simulatedDevices[peripheral.address] = peripheral
+    return peripheral
+
+
+def _create_devices():
+    if simDevices.strip().isdigit():
+        for i in range(int(simDevices)):
+            add_device(f"DE:AD:BE:EF:{i >> 8:02X}:{i & 0xFF:02X}")
+    else:
+        for address in simDevices.split(","):
+            if address.strip():
+                add_device(address.strip())
+
+
+_create_devices()
+
+
+def _address(device_or_address):
+    return getattr(device_or_address, "address", device_or_address).upper()
+
+
+class BleakScanner:
+    def __init__(self, detection_callback=None, **kwargs):
+        self._callback = detection_callback
+        self._task = None
+
+    def register_detection_callback(self, callback):
+        self._callback = callback
+
+    async def start(self):
+        self._task = asyncio.ensure_future(self._advertise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _advertise(self):
+        while True:
+            for peripheral in list(simulatedDevices.values()):
+                if self._callback is None or peripheral.client is not None or _lost():
+                    continue  # A connected HAPP device does not advertise
+                advertisement = peripheral.advertisement()
+                result = self._callback(
+                    BLEDevice(peripheral.address, advertisement.local_name, advertisement.rssi, advertisement),
+                    advertisement)
+                if inspect.isawaitable(result):
+                    await result
+            await asyncio.sleep(simAdvertisingInterval)
+
+    @staticmethod
+    async def discover(timeout=5.0, **kwargs):
+        await asyncio.sleep(min(timeout, simAdvertisingInterval))
+        return [p.device() for p in simulatedDevices.values() if p.client is None]
+
+    @staticmethod
+    async def find_device_by_address(device_identifier, timeout=10.0, **kwargs):
+        peripheral = simulatedDevices.get(device_identifier.upper())
+        if peripheral is None or peripheral.client is not None:
+            await asyncio.sleep(timeout)
+            return None
+        await asyncio.sleep(min(timeout, simAdvertisingInterval))
+        return peripheral.device()
+
+
+class _Backend:
+    pass  # No BlueZ MTU exchange, see BLE_interface.update_mtu
+
+
+class BleakClient:
+    def __init__(self, address_or_ble_device, timeout=10.0, disconnected_callback=None, **kwargs):
+        self.address = _address(address_or_ble_device)
+        self._timeout = timeout
+        self._disconnected_callback = disconnected_callback
+        self._backend = _Backend()
+        self._peripheral = None
+        self._notify_callbacks = {}
+
+    @property
+    def is_connected(self):
+        return self._peripheral is not None
+
+    @property
+    def services(self):
+        if self._peripheral is None:
+            raise BleakError("Service Discovery has not been performed yet")
+        return self._peripheral.services
+
+    @property
+    def mtu_size(self):
+        return self._peripheral.mtu if self._peripheral is not None else 23
+
+    def set_disconnected_callback(self, callback, **kwargs):
+        self._disconnected_callback = callback
+
+    async def connect(self, timeout=None, **kwargs):
+        peripheral = simulatedDevices.get(self.address)
+        await asyncio.sleep(simLatency)
+        if peripheral is None:
+            raise BleakError(f"Device with address {self.address} was not found.")
+        if peripheral.client is not None:
+            raise BleakError(f"Device with address {self.address} is already connected.")
+        peripheral.client = self
+        peripheral.reset()
+        self._peripheral = peripheral
+        return True
+
+    async def disconnect(self):
+        await asyncio.sleep(simLatency)
+        self._drop()
+        return True
+
+    # Disconnect initiated by the peripheral, e.g. by a load test
+    def link_lost(self):
+        self._drop()
+
+    def _drop(self):
+        if self._peripheral is None:
+            return
+        self._peripheral.client = None
+        self._peripheral = None
+        self._notify_callbacks.clear()
+        if self._disconnected_callback is not None:
+            self._disconnected_callback(self)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.disconnect()
+
+    def _characteristic(self, char_specifier):
+        target = getattr(char_specifier, "uuid", char_specifier)
+        for service in self.services:
+            for characteristic in service.characteristics:
+                if characteristic.uuid == target:
+                    return characteristic
+        raise BleakError(f"Characteristic {target} was not found!")
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        characteristic = self._characteristic(char_specifier)
+        self._notify_callbacks[characteristic.uuid] = (characteristic, callback)
+
+    async def stop_notify(self, char_specifier):
+        self._notify_callbacks.pop(self._characteristic(char_specifier).uuid, None)
+
+    async def write_gatt_char(self, char_specifier, data, response=None):
+        if self._peripheral is None:
+            raise BleakError("Not connected")
+        self._characteristic(char_specifier)
+        peripheral = self._peripheral
+        if response:
+            await asyncio.sleep(2 * simLatency)  # Round trip of the write request
+        if not _lost():
+            asyncio.get_running_loop().call_later(simLatency, peripheral.write, bytes(data))
+
+    # Called by the peripheral, the notification reaches the client after the link latency
+    def _notify(self, data):
+        if _lost():
+            return
+        entry = self._notify_callbacks.get(NOTIFY_UUID)
+        if entry is not None:
+            asyncio.get_running_loop().call_later(simLatency, self._deliver, data)
+
+    def _deliver(self, data):
+        entry = self._notify_callbacks.get(NOTIFY_UUID)
+        if entry is not None:
+            characteristic, callback = entry
+            result = callback(characteristic, bytearray(data))
+            if inspect.isawaitable(result):
+                asyncio.ensure_future(result)
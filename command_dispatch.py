@@ -0,0 +1,128 @@
+# Description: TCP command dispatch
+# Author: Syncore Technologies AB
+#
+# Runs the handler registered for a command byte. Short commands (queries and settings) are run at once on the
+# command thread. Long running ones (scans, device tests and gateway start) are run on a bounded worker pool, so a
+# 40 s scan does not hold up the commands behind it.
+#
+# For every long running command config.ini [COMMANDS] sets how many may run at the same time and an optional
+# timeout. A command over its limit is answered with ERROR busy. A command that is still running at its timeout is
+# answered with ERROR timeout, and the replies it sends later are dropped. A Python thread can not be stopped, so
+# the command still holds its place in the limit until it returns.
+# -----------------------------------------------------------------
+import concurrent.futures
+import configparser
+import logging
+import threading
+
+from LogRelay import logRelay
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+commandWorkers = max(1, int(config.get("COMMANDS", "Workers", fallback="4")))
+commandConcurrency = max(1, int(config.get("COMMANDS", "Concurrency", fallback="1")))
+commandTimeout = float(config.get("COMMANDS", "Timeout", fallback="0"))
+
+# Error codes of the ERROR reply, next to 1 (missing parameter), 2 (failed) and 3 (not found or not a valid command)
+ERROR_TIMEOUT = 4
+ERROR_BUSY = 5
+
+
+# Per command setting, e.g. "0x10 timeout = 120"
+def command_setting(cmd, name, default):
+    return config.get("COMMANDS", f"0x{cmd:02X} {name}", fallback=str(default))
+
+
+# Stands in for the session of a long running command, the replies after its timeout are dropped
+class CommandReply:
+    def __init__(self, session, cmd):
+        self.session = session
+        self._cmd = cmd
+        self._lock = threading.Lock()
+        self._finished = False
+        self._expired = False
+
+    def sendall(self, data):
+        with self._lock:
+            if self._expired:
+                logging.debug(f"Reply to timed out cmd: {self._cmd} dropped")
+                return
+        self.session.sendall(data)
+
+    def finish(self):
+        with self._lock:
+            self._finished = True
+
+    # True if the command had not finished, it gets no more replies
+    def expire(self):
+        with self._lock:
+            if self._finished:
+                return False
+            self._expired = True
+            return True
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+class CommandDispatcher:
+    # handlers: {command byte: (handler(msg_cmd, data, connection), long running)}
+    def __init__(self, handlers, error_reply):
+        self._handlers = handlers
+        self._error_reply = error_reply
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=commandWorkers,
+                                                               thread_name_prefix="Command")
+        self._limits = {}
+        self._timeouts = {}
+        for cmd, (handler, longRunning) in handlers.items():
+            if longRunning:
+                self._limits[cmd] = threading.BoundedSemaphore(
+                    max(1, int(command_setting(cmd, "concurrency", commandConcurrency))))
+                self._timeouts[cmd] = float(command_setting(cmd, "timeout", commandTimeout))
+
+    # False for a command without handler
+    def dispatch(self, msg_cmd, data, session):
+        entry = self._handlers.get(msg_cmd)
+        if entry is None:
+            return False
+        handler, longRunning = entry
+        if not longRunning:
+            handler(msg_cmd, data, session)
+            return True
+
+        limit = self._limits[msg_cmd]
+        if not limit.acquire(blocking=False):
+            logging.warning(f"cmd: {msg_cmd} is already running the max number of times, answered busy")
+            logRelay.put(f"command_dispatch.py: cmd: {msg_cmd} is already running the max number of times")
+            session.sendall(self._error_reply(msg_cmd, ERROR_BUSY))
+            return True
+
+        reply = CommandReply(session, msg_cmd)
+        timer = None
+        if self._timeouts[msg_cmd] > 0:
+            timer = threading.Timer(self._timeouts[msg_cmd], self._timed_out, args=(msg_cmd, reply))
+            timer.daemon = True
+            timer.start()
+        self._executor.submit(self._run, handler, msg_cmd, data, reply, limit, timer)
+        return True
+
+    def _run(self, handler, msg_cmd, data, reply, limit, timer):
+        try:
+            handler(msg_cmd, data, reply)
+        except Exception as e:
+            logging.error(f"Unexpected Error: {e}")
+        finally:
+            reply.finish()
+            if timer is not None:
+                timer.cancel()
+            limit.release()
+
+    def _timed_out(self, msg_cmd, reply):
+        if reply.expire():
+            logging.warning(f"cmd: {msg_cmd} timed out")
+            logRelay.put(f"command_dispatch.py: cmd: {msg_cmd} timed out")
+            try:
+                reply.session.sendall(self._error_reply(msg_cmd, ERROR_TIMEOUT))
+            except ConnectionAbortedError:
+                logging.info("TCP Socket closed cant send timeout")
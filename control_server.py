@@ -0,0 +1,209 @@
+# Description: TCP control server
+# Author: Syncore Technologies AB
+#
+# Serves any number of TCP control clients at the same time (e.g. a LabVIEW test station and the GUI through the
+# WebSocket tunnel) on an asyncio loop in a thread of its own. Every connection is a ControlSession with its own
+# command framer. The commands are put on the command queue together with the session, so the reply goes back on
+# the connection the command came from.
+#
+# A session that starts a gateway (0x0E) or connects a device (0x07) owns the device, and the notifications for it
+# (0x09, 0x15, 0x16 and the connect result) go to that session only. If the owner has gone, they go to the latest
+# connected client, as with the single client server.
+#
+# Request IDs: a client that sends 0x04 with a flags byte with bit 0 set gets the accepted flags byte after the UUID
+# in the 0x04 reply. From then on every frame, both ways, starts with a 2 byte request ID (big endian) before the
+# command or ACK/NACK/ERROR byte. The replies to a command carry the ID of the command, so a client can have many
+# commands outstanding. The notifications for a device carry the ID of the 0x0E or 0x07 request that owns it, the
+# ones without an owning request ID 0. Clients that send 0x04 without flags get frames without request IDs.
+# -----------------------------------------------------------------
+import asyncio
+import configparser
+import itertools
+import logging
+import socket
+import threading
+
+import SynProtocol
+from LogRelay import logRelay
+from webserver import setStatus
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+HOST = '127.0.0.1'
+RECEIVE_SIZE = 1024
+
+FLAG_REQUEST_IDS = 0x01  # 0x04 flags byte
+REQUEST_ID_SIZE = 2
+NO_REQUEST_ID = 0
+
+
+class ControlSession:
+    def __init__(self, server, sessionId, writer):
+        self._server = server
+        self.id = sessionId
+        self.addr = writer.get_extra_info("peername")
+        self._writer = writer
+        self.framer = SynProtocol.StreamFramer()
+        self.user = False  # Set by command 0x04 and cleared by 0x05
+        self.requestIds = False  # Negotiated by command 0x04
+        self.closed = False
+
+    # Safe to call from any thread, the data is written by the server loop in call order. data is an encoded frame.
+    def sendall(self, data, requestId=NO_REQUEST_ID):
+        if self.closed:
+            raise ConnectionAbortedError(f"Control client {self.addr} has disconnected")
+        data = bytes(data)
+        if self.requestIds:
+            # The escaped ID goes right after STX
+            data = data[:1] + SynProtocol.encode_data(requestId.to_bytes(REQUEST_ID_SIZE, "big"))[1:-1] + data[1:]
+        self._server.loop.call_soon_threadsafe(self._write, data)
+
+    # The session or ControlRequest to reply to and the command without request ID, ValueError if it is too short
+    def open_request(self, data):
+        if not self.requestIds:
+            return self, data
+        if len(data) <= REQUEST_ID_SIZE:
+            raise ValueError(f"Frame from {self.addr} without request ID and command")
+        return ControlRequest(self, int.from_bytes(data[:REQUEST_ID_SIZE], "big")), data[REQUEST_ID_SIZE:]
+
+    def _write(self, data):
+        if not self._writer.is_closing():
+            self._writer.write(data)
+
+    def __repr__(self):
+        return f"ControlSession({self.id}, {self.addr})"
+
+
+# A command from a session with request IDs, the frames sent through it carry the ID of the command
+class ControlRequest:
+    __slots__ = ("_session", "requestId")
+
+    def __init__(self, session, requestId):
+        object.__setattr__(self, "_session", session)
+        object.__setattr__(self, "requestId", requestId)
+
+    def sendall(self, data):
+        self._session.sendall(data, self.requestId)
+
+    # Other attributes (user, requestIds, closed...) are the session's
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._session, name, value)
+
+    def __repr__(self):
+        return f"ControlRequest({self.requestId}, {self._session})"
+
+
+class ControlServer:
+    def __init__(self, host=HOST, port=None):
+        self._host = host
+        self._port = port
+        self._sessions = {}  # Session id -> ControlSession, in connect order
+        self._owners = {}  # Upper case MAC -> ControlSession
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._thread = None
+        self.loop = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # Commands are put on queue as (ControlSession, command data without STX and ETX)
+    def start(self, queue):
+        if self.is_running():
+            return
+        self._queue = queue
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ControlServer", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        except Exception as e:
+            logging.warning(f"TCP control server stopped: {e}")
+        finally:
+            self._ready.set()
+            setStatus("Dead", "tcp")
+            self.loop.close()
+
+    async def _serve(self):
+        port = self._port if self._port is not None else config.getint('TCP', 'Port')
+        server = await asyncio.start_server(self._handle_client, self._host, port, reuse_address=True)
+        logging.info(f"TCP socket started and binded to {self._host} and port {port}")
+        logRelay.put(f"control_server.py: TCP socket started and binded to {self._host} and port {port}")
+        setStatus("Ready", "tcp")
+        self._ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_client(self, reader, writer):
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPINTVL"):
+                sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPINTVL, 11)
+                sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, 3)
+
+        session = ControlSession(self, next(self._ids), writer)
+        with self._lock:
+            self._sessions[session.id] = session
+        logging.debug("Connected by %s", session.addr)
+        logRelay.put(f"control_server.py: Control client {session.addr} connected")
+
+        try:
+            while True:
+                data = await reader.read(RECEIVE_SIZE)
+                if not data:
+                    logging.debug("Connection reset by peer")
+                    logRelay.put(f"control_server.py: Control client {session.addr} disconnected")
+                    break
+                setStatus("Busy", "tcp")
+                logging.debug(f"New Data Received from {session.addr}: {data}")
+                for cmd_data in session.framer.feed(data):
+                    self._queue.put((session, cmd_data))
+                setStatus("Ready", "tcp")
+        except (ConnectionError, OSError) as e:
+            logging.debug(f"Disconnected from {session.addr}: {e}")
+        finally:
+            session.closed = True
+            with self._lock:
+                self._sessions.pop(session.id, None)
+            writer.close()
+
+    # Notifications for the device go to the session (or ControlRequest) from now on
+    def claim(self, mac, session):
+        if session is None:
+            return
+        session = getattr(session, "session", session)  # The session behind a command_dispatch.CommandReply
+        with self._lock:
+            self._owners[mac.upper()] = session
+
+    def owner(self, mac):
+        with self._lock:
+            session = self._owners.get(mac.upper()) if mac else None
+            if session is None or session.closed:
+                session = next(reversed(self._sessions.values()), None)
+        return session
+
+    # Sends a notification for the device to the session owning it, False when no control client is connected
+    def notify(self, mac, data):
+        session = self.owner(mac)
+        if session is None:
+            logging.info("No TCP control client connected, notification not sent")
+            return False
+        try:
+            session.sendall(data)
+        except ConnectionAbortedError:
+            logging.info("TCP Socket closed cant send server notify")
+            return False
+        return True
+
+
+controlServer = ControlServer()
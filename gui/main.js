@@ -223,6 +223,14 @@ function putRLog(text) {
     infoBox.innerHTML += dateTime + text + '<br>';
 }
 
+// Batch of real time log lines pushed by LogRelay.py
+eel.expose(putRLogBatch);
+function putRLogBatch(lines) {
+    for (const line of lines) {
+        putRLog(line);
+    }
+}
+
 // This upload form is used by Models Updater to send xlsx file from html to python
 document.getElementById('uploadForm').addEventListener('submit', function(event) {
     event.preventDefault();
@@ -0,0 +1,277 @@
+# Description: Conversion benchmark
+# Author: Syncore Technologies AB
+#
+# Micro-benchmarks of the per-packet code: BLE -> UDP reassembly (BleToUdpPayload), UDP -> BLE fragmentation
+# (UdpToBlePayload), the TCP codec (SynProtocol.encode_data/decode_data) and the TCP command framer
+# (SynProtocol.StreamFramer). Payloads range from 20 byte notifications to full 1156 byte Hqv frames, with data
+# that is escape-free, random or escape-heavy for the STX/ETX/ESC codec.
+#
+# Every case reports ops/s, and from one traced op the allocated memory blocks still held after it and the peak of
+# allocated bytes during it. The result is compared with a stored baseline so regressions stand out.
+#
+# tools/benchmarkBaseline.json is the committed baseline, made with --save-baseline --min-time 0.5 on Python 3.11 from
+# the current converters and codec. ops/s depend on the machine, so a CI job first stores a baseline of the target
+# branch on its runner (--save-baseline --baseline FILE) and then compares the change with it (--baseline FILE).
+#
+# --check compares the TCP codec with the byte by byte legacy codec on random data instead: encoding must give the
+# same bytes, decoding the same bytes or the same error, and decoding an encoded message must give the message back.
+#
+# Run from the application folder: python -m tools.benchmarkConversion [--save-baseline | --check]
+# -----------------------------------------------------------------
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Gateway"))
+
+import BleToUdpPayload
+import ConverterUtils
+import SynProtocol
+import UdpToBlePayload
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarkBaseline.json")
+
+PAYLOAD_SIZES = [20, 64, 256, ConverterUtils.LWM2M_MESSAGE_MAX_SIZE]
+NOTIFICATION_SIZES = [20, 244]  # Default ATT MTU and the highest common one (247), minus the ATT header
+SPECIAL_BYTES = bytes([SynProtocol.STX, SynProtocol.ETX, SynProtocol.ESC])
+
+
+def payload(size, kind, rng):
+    if kind == "escape-free":
+        return bytes(rng.choice([b for b in range(256) if b not in SPECIAL_BYTES]) for _ in range(size))
+    if kind == "escape-heavy":  # Every other byte has to be escaped
+        return bytes(rng.choice(SPECIAL_BYTES) if i % 2 else rng.randrange(256) for i in range(size))
+    return bytes(rng.randrange(256) for _ in range(size))
+
+
+def hqv_frame(data, header=3):
+    return bytes(UdpToBlePayload.UdpToBlePayload(23).CreateBleMessage(data, header))
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+# Each case returns a function that performs one op, an op is one message through the converter
+def ble_to_udp_legacy(size, notification, rng):
+    notifications = chunks(hqv_frame(payload(size, "random", rng)), notification)
+    converter = BleToUdpPayload.BleToUdpPayload()
+
+    def op():
+        for data in notifications:
+            converter.Convert(data)
+
+    return op
+
+
+def ble_to_udp_ring(size, notification, rng):
+    notifications = chunks(hqv_frame(payload(size, "random", rng)), notification)
+    converter = BleToUdpPayload.RingBufferReassembler()
+
+    def op():
+        for data in notifications:
+            for message, header in converter.Convert(data):
+                bytes(message)  # Copy as handle_notify does
+
+    return op
+
+
+def udp_to_ble_convert(size, mtu, rng):
+    data = payload(size, "random", rng)
+    converter = UdpToBlePayload.UdpToBlePayload(mtu)
+    return lambda: converter.Convert(data, 3)
+
+
+def udp_to_ble_split(size, mtu, rng):
+    message = bytearray(hqv_frame(payload(size, "random", rng)))
+    converter = UdpToBlePayload.UdpToBlePayload(mtu)
+    return lambda: converter.SplitBleMessage(message)
+
+
+def encode(size, kind, rng, encode_data=SynProtocol.encode_data):
+    data = payload(size, kind, rng)
+    return lambda: encode_data(data)
+
+
+def decode(size, kind, rng, decode_data=SynProtocol.decode_data):
+    data = bytes(SynProtocol.encode_data(payload(size, kind, rng)))[1:-1]  # process_cmd gets data without STX/ETX
+    return lambda: decode_data(data)
+
+
+def encode_legacy(size, kind, rng):
+    return encode(size, kind, rng, SynProtocol.encode_data_legacy)
+
+
+def decode_legacy(size, kind, rng):
+    return decode(size, kind, rng, SynProtocol.decode_data_legacy)
+
+
+def framer(size, kind, rng):
+    # Ten commands per op, delivered in TCP reads of 1024 bytes (control_server)
+    stream = b"".join(bytes(SynProtocol.encode_data(payload(size, kind, rng))) for _ in range(10))
+    reads = chunks(stream, 1024)
+    streamFramer = SynProtocol.StreamFramer()
+
+    def op():
+        for data in reads:
+            streamFramer.feed(data)
+
+    return op
+
+
+def cases():
+    for size in PAYLOAD_SIZES:
+        for notification in NOTIFICATION_SIZES:
+            yield f"ble_to_udp.legacy/{size}B/notify{notification}", ble_to_udp_legacy, (size, notification)
+            yield f"ble_to_udp.ring/{size}B/notify{notification}", ble_to_udp_ring, (size, notification)
+        for mtu in (23, 247):
+            yield f"udp_to_ble.convert/{size}B/mtu{mtu}", udp_to_ble_convert, (size, mtu)
+            yield f"udp_to_ble.split/{size}B/mtu{mtu}", udp_to_ble_split, (size, mtu)
+        for kind in ("escape-free", "random", "escape-heavy"):
+            yield f"syn.encode.legacy/{size}B/{kind}", encode_legacy, (size, kind)
+            yield f"syn.encode/{size}B/{kind}", encode, (size, kind)
+            yield f"syn.decode.legacy/{size}B/{kind}", decode_legacy, (size, kind)
+            yield f"syn.decode/{size}B/{kind}", decode, (size, kind)
+            yield f"syn.framer/10x{size}B/{kind}", framer, (size, kind)
+
+
+def codec_result(function, data):
+    try:
+        return bytes(function(data))
+    except IndexError as e:  # An ESC at the end of the data
+        return type(e)
+
+
+# Random messages, mostly made of the bytes of the escape scheme, through the codec and the legacy codec
+def check_codec(count, rng):
+    alphabet = list(SPECIAL_BYTES) + [SynProtocol.ESC_STX, SynProtocol.ESC_ETX, SynProtocol.ESC_ESC]
+    failures = 0
+    for i in range(count):
+        size = rng.choice([rng.randrange(8), rng.randrange(64), rng.randrange(ConverterUtils.LWM2M_MESSAGE_MAX_SIZE)])
+        data = bytes(rng.choice(alphabet) if rng.random() < 0.5 else rng.randrange(256) for _ in range(size))
+        encoded = SynProtocol.encode_data(data)
+        checks = {
+            "encode": (bytes(encoded), bytes(SynProtocol.encode_data_legacy(data))),
+            "decode": (codec_result(SynProtocol.decode_data, data),
+                       codec_result(SynProtocol.decode_data_legacy, data)),
+            "round trip": (bytes(SynProtocol.decode_data(encoded[1:-1])), data),
+        }
+        for name, (result, expected) in checks.items():
+            if result != expected:
+                failures += 1
+                print(f"{name} differs for {data.hex()}: {result!r} != {expected!r}")
+    print(f"Codec checked with {count} messages, {failures} failures")
+    return failures
+
+
+def measure(op, min_time):
+    op()  # Warm up
+
+    # Ops per second, the op count is doubled until a run takes min_time
+    gc.disable()
+    try:
+        count = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(count):
+                op()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+            count *= 2
+    finally:
+        gc.enable()
+
+    # Allocations of a single op
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        result = op()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        after = tracemalloc.take_snapshot()
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]  # The snapshots themselves
+        blocks = sum(stat.count_diff for stat in after.filter_traces(ignore).compare_to(before.filter_traces(ignore),
+                                                                                         "filename")
+                     if stat.count_diff > 0)
+        del result
+    finally:
+        tracemalloc.stop()
+
+    return {"opsPerSecond": round(count / elapsed, 1), "blocksPerOp": blocks, "peakBytesPerOp": peak}
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            result["change"] = "new"
+            continue
+        change = result["opsPerSecond"] / reference["opsPerSecond"] - 1
+        result["change"] = f"{change:+.1%}"
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Benchmark the gateway and TCP protocol conversions.",
+    )
+    parser.add_argument("-f", "--filter", dest="filter", default="", help="Only run cases containing this text")
+    parser.add_argument("-t", "--min-time", dest="min_time", default=0.2, type=float,
+                        help="Minimum measuring time per case in seconds")
+    parser.add_argument("-b", "--baseline", dest="baseline", default=BASELINE_FILE, help="Baseline file")
+    parser.add_argument("-s", "--save-baseline", dest="save", action="store_true",
+                        help="Store the result as the new baseline")
+    parser.add_argument("--tolerance", dest="tolerance", default=0.2, type=float,
+                        help="Relative drop in ops/s reported as a regression")
+    parser.add_argument("-j", "--json", dest="json", action="store_true", help="Print the result as JSON")
+    parser.add_argument("-c", "--check", dest="check", default=0, type=int, metavar="COUNT",
+                        help="Compare the TCP codec with the legacy codec on COUNT random messages, no benchmark")
+    args = parser.parse_args()
+
+    rng = random.Random(1)  # Same payloads on every run
+    if args.check:
+        return 1 if check_codec(args.check, rng) else 0
+
+    results = {}
+    for name, case, caseArgs in cases():
+        if args.filter in name:
+            results[name] = measure(case(*caseArgs, rng), args.min_time)
+            if not args.json:
+                r = results[name]
+                print(f"{name:49} {r['opsPerSecond']:>12.1f} ops/s {r['blocksPerOp']:>6} blocks/op "
+                      f"{r['peakBytesPerOp']:>8} peak bytes/op", flush=True)
+
+    regressions = []
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if not args.json:
+            print(f"\nCompared with {args.baseline}:")
+            for name, r in results.items():
+                print(f"{name:49} {r['change']:>8}{'  REGRESSION' if name in regressions else ''}")
+    else:
+        print(f"No baseline in {args.baseline}, store one with --save-baseline")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,12 +4,15 @@
 import asyncio
 import configparser
 import json
-from bleak import BleakScanner
+import time
+from ble_backend import BleakScanner
 import eel
 import logging
 from json.decoder import JSONDecodeError
 from webserver import getDeviceAlias, getDeviceKey
 from SessionData import sessionData
+from LogRelay import logRelay
+from tools.happObserver import happObserver
 
 devices = {}
 
@@ -19,6 +22,9 @@ config = configparser.ConfigParser()
 # Read the configuration file
 config.read('config.ini')
 
+# Max seconds findHappDevice looks for a device
+findDeviceTimeout = float(config.get("BLE", "Find device timeout", fallback="40"))
+
 async def scanAndPrint(timeout):
     logging.info(f"Scanning for BLE devices with UUIDs")
     eel.controlLoader(1)
@@ -32,6 +38,7 @@ async def scanAndPrint(timeout):
                 rssi = advertisement_data.rssi
                 # Store MAC address and RSSI, using UUID as key
                 devices[uuid] = (device.address, rssi)
+                happObserver.seen(device, advertisement_data)  # Lets a gateway connect without scanning again
         except:
             pass
 
@@ -57,9 +64,15 @@ def startSearch(timeout=None):
     logging.debug(f"Starting BLE device search with timeout set to: {timeout}")
     aliasLookupExists = True
     keyLookupExists = True
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(scanAndPrint(timeout))
+    if happObserver.is_running():
+        # Answer from the devices the background observer has seen within its TTL instead of scanning
+        logging.info(f"Listing BLE devices with UUIDs seen by the HAPP observer")
+        foundDevices = {entry.iprid: (entry.mac, entry.rssi) for entry in happObserver.devices()}
+    else:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(scanAndPrint(timeout))
+        foundDevices = devices
 
     arrayOfDevices = []
     print("\n")
@@ -67,7 +80,7 @@ def startSearch(timeout=None):
     counter = 0
     eel.controlLoader(0)
 
-    for uuid, (mac, rssi) in devices.items():
+    for uuid, (mac, rssi) in foundDevices.items():
         deviceAlias = ""
         keyShort = ""
         # Use UUID as the primary identifier
@@ -92,7 +105,7 @@ def startSearch(timeout=None):
         newDevice = {"mac": mac, "uuid": iprid, "NTC": 0, "DNC": 0, "rssi": str(rssi), "alias": deviceAlias}
         arrayOfDevices.append(newDevice)
 
-    eel.putRLog(f"find.py: New devices: {str(arrayOfDevices)}")
+    logRelay.put(f"find.py: New devices: {str(arrayOfDevices)}")
     if not aliasLookupExists:
         eel.addToLog(str(f"No alias lookup file found, alias wont be saved!"),
                     "HAPPfinder")
@@ -102,4 +115,62 @@ def startSearch(timeout=None):
     print(f"Found {counter} BLE devices with UUIDs")
     eel.addToLog(str(f"Found {counter} BLE devices with UUIDs"), "HAPPfinder")
     sessionData.lastHAPPScan = arrayOfDevices
-    return arrayOfDevices
\ No newline at end of file
+    return arrayOfDevices
+
+
+# Scans until the device with the MAC or IPRID advertises, or the timeout has passed
+async def scanForDevice(mac, iprid, timeout):
+    found = asyncio.Event()
+
+    def callback(device, advertisement_data):
+        uuids = [uuid.lower() for uuid in advertisement_data.service_uuids or []]
+        if (mac is not None and device.address.upper() == mac.upper()) or \
+                (iprid is not None and iprid.lower() in uuids):
+            happObserver.seen(device, advertisement_data)
+            found.set()
+
+    scanner = BleakScanner(detection_callback=callback)
+    try:
+        await scanner.start()
+        await asyncio.wait_for(found.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    except OSError as e:
+        logging.warning(f"Cannot scan for {mac or iprid}: {e}")
+    finally:
+        await scanner.stop()
+
+
+# Targeted search for one HAPP device by MAC or IPRID. Returns at once when the device is known from a recent scan or
+# the observer, otherwise as soon as it advertises. Returns a happObserver.HappDevice, or None after the timeout.
+def findHappDevice(mac=None, iprid=None, timeout=None):
+    if timeout is None:
+        timeout = findDeviceTimeout
+    start = time.monotonic()
+
+    entry = happObserver.find(mac, iprid)
+    if entry is None:
+        logging.debug(f"Searching for {mac or iprid}, timeout {timeout} s")
+        if happObserver.is_running():
+            entry = happObserver.wait_for(mac, iprid, timeout)
+        else:
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(scanForDevice(mac, iprid, timeout))
+            finally:
+                loop.close()
+            entry = happObserver.find(mac, iprid)
+
+    if entry is None:
+        logging.info(f"{mac or iprid} not found within {timeout} s")
+        return None
+    logging.info(f"Found {entry.mac} ({entry.iprid}) after {time.monotonic() - start:.2f} s")
+
+    # Keep the device in the last scan, it is looked up there by MAC later (get_device_hid)
+    lastScan = sessionData.lastHAPPScan or []
+    if not any(device["mac"] == entry.mac for device in lastScan):
+        alias = getDeviceAlias(entry.iprid)
+        lastScan.append({"mac": entry.mac, "uuid": entry.iprid, "NTC": 0, "DNC": 0, "rssi": str(entry.rssi),
+                         "alias": alias if alias and alias != "unknown" else ""})
+        sessionData.lastHAPPScan = lastScan
+    return entry
@@ -0,0 +1,177 @@
+# Description: HAPP advertisement observer
+# Author: Syncore Technologies AB
+#
+# Scans in the background for as long as SBLETS runs and keeps a table of the HAPP devices it hears, so a device
+# search (command 0x10, the GUI finder and gateway start) is answered from the table instead of a new 40 s scan.
+# Devices that have not advertised within the TTL are removed. Enabled with config.ini [BLE] Background observer.
+# Device searches (findHappDevices) also add what they see, so a gateway can connect to a device from a recent scan
+# without scanning for it again (config.ini [BLE] Scan cache age).
+# -----------------------------------------------------------------
+
+import asyncio
+import configparser
+import logging
+import threading
+import time
+
+from ble_backend import BleakScanner
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+observerEnabled = config.get("BLE", "Background observer", fallback="False") == "True"
+observerTTL = float(config.get("BLE", "Observer TTL", fallback="60"))
+scanCacheAge = float(config.get("BLE", "Scan cache age", fallback="30"))
+
+COMPANY_CODE = 0x0426
+FLAGS_INDEX = 22  # Manufacturer data byte with bit 0 Need To Connect, bit 1 Firmware Down and bit 2 Firmware Run
+RESTART_DELAY = 10  # Seconds before a failed scanner (e.g. Bluetooth turned off) is started again
+
+
+class HappDevice:
+    def __init__(self, device, advertisement):
+        self.update(device, advertisement)
+
+    def update(self, device, advertisement):
+        self.mac = device.address
+        self.iprid = advertisement.service_uuids[0]  # The first service UUID identifies the device
+        self.rssi = advertisement.rssi
+        self.manufacturerData = advertisement.manufacturer_data.get(COMPANY_CODE)
+        if self.manufacturerData is not None and len(self.manufacturerData) > FLAGS_INDEX:
+            self.flags = self.manufacturerData[FLAGS_INDEX]
+        else:
+            self.flags = 0
+        self.device = device  # BLEDevice, can be handed to BleakClient
+        self.advertisement = advertisement
+        self.lastSeen = time.monotonic()
+
+    def age(self):
+        return time.monotonic() - self.lastSeen
+
+
+class HappObserver:
+    def __init__(self, ttl=observerTTL):
+        self.ttl = ttl
+        self._table = {}  # Upper case MAC -> HappDevice
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)  # Notified for every advertisement
+        self._thread = None
+        self._loop = None
+        self._stopEvent = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._thread = threading.Thread(target=self._run, name="HappObserver", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.is_running():
+            return
+        if self._loop is not None and self._stopEvent is not None:
+            self._loop.call_soon_threadsafe(self._stopEvent.set)
+        self._thread.join()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._observe())
+        finally:
+            self._loop.close()
+            self._loop = None
+
+    async def _observe(self):
+        self._stopEvent = asyncio.Event()
+        logging.info(f"HAPP observer started, TTL {self.ttl} s")
+        while not self._stopEvent.is_set():
+            scanner = BleakScanner(detection_callback=self.seen)
+            try:
+                await scanner.start()
+            except Exception as e:
+                logging.warning(f"HAPP observer could not start scanning: {e}")
+                await self._wait(RESTART_DELAY)
+                continue
+            try:
+                # Evict stale devices now and then while scanning
+                while not self._stopEvent.is_set():
+                    await self._wait(max(1.0, self.ttl / 2))
+                    self.evict()
+            finally:
+                try:
+                    await scanner.stop()
+                except Exception as e:
+                    logging.debug(f"HAPP observer stop failed: {e}")
+        logging.info("HAPP observer stopped")
+
+    async def _wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._stopEvent.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def seen(self, device, advertisement):
+        # Only include devices that advertise service UUIDs, same as findHappDevices
+        if not advertisement.service_uuids:
+            return
+        key = device.address.upper()
+        with self._lock:
+            entry = self._table.get(key)
+            if entry is None:
+                self._table[key] = HappDevice(device, advertisement)
+            else:
+                entry.update(device, advertisement)
+            self._changed.notify_all()
+
+    def evict(self):
+        with self._lock:
+            for mac in [mac for mac, entry in self._table.items() if entry.age() > self.ttl]:
+                del self._table[mac]
+
+    # Devices seen within the TTL, or within max_age seconds
+    def devices(self, max_age=None):
+        self.evict()
+        with self._lock:
+            entries = list(self._table.values())
+        if max_age is not None:
+            entries = [entry for entry in entries if entry.age() <= max_age]
+        return entries
+
+    def find(self, mac=None, iprid=None, max_age=None):
+        for entry in self.devices(max_age):
+            if (mac is not None and entry.mac.upper() == mac.upper()) or \
+                    (iprid is not None and entry.iprid.lower() == iprid.lower()):
+                return entry
+        return None
+
+    # Blocks until the device is in the table, at most timeout seconds. Only useful while the observer is running.
+    def wait_for(self, mac=None, iprid=None, timeout=None):
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                entry = self.find(mac, iprid)
+                remaining = deadline - time.monotonic()
+                if entry is not None or remaining <= 0 or not self.is_running():
+                    return entry
+                self._changed.wait(min(remaining, 1.0))
+
+    # BLEDevice of a device advertising within the scan cache age, None on a miss
+    def cached_device(self, mac, max_age=None):
+        max_age = scanCacheAge if max_age is None else max_age
+        if max_age <= 0:
+            return None
+        entry = self.find(mac=mac, max_age=max_age)
+        if entry is None:
+            return None
+        logging.info(f"Using {mac} from a scan {entry.age():.1f} s ago")
+        return entry.device
+
+    def forget(self, mac):
+        with self._lock:
+            self._table.pop(mac.upper(), None)
+
+
+happObserver = HappObserver()
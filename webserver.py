@@ -3,7 +3,7 @@
 # Alexander Ström 2024-07-04
 # This webserver file contains links to multiple components that hosts services on the local webserver used for
 # controlling SBLETS
-# To show a log message on the GUI use eel.putRLog(msg)
+# To show a log message on the GUI use logRelay.put(msg) (LogRelay.py), it is batched to eel.putRLogBatch
 
 ########################################################################################################################
 
@@ -172,6 +172,8 @@ def readData():
     deviceAlias = sessionData.connectedDeviceAlias
 
     runningGateway = "Active" if sessionData.runningGateway is True else "Inactive"
+    gatewayQueues = getGatewayQueues()
+    gatewayLatency = getGatewayLatency()
 
     if sys.platform == "win32":
         autoReconnect = "Not available on Windows"
@@ -186,7 +188,40 @@ def readData():
             "Leshan IP": leshanip, "Leshan port": leshanPort,
             "TCP port": tcpPort, "BLE auto reconnect": autoReconnect, "HID": hid,
             "Alias": deviceAlias, "Leshan endpoint state": endpointActive, "Web app access": webappAccess,
-            "Send status request": sendStatusRequest}
+            "Send status request": sendStatusRequest, "Gateway queues": gatewayQueues,
+            "Gateway latency": gatewayLatency}
+
+
+# Queue counters of the running gateways as one line per gateway
+def getGatewayQueues():
+    from Gateway.gateway_manager import gatewayManager  # Imported here, the gateway itself imports webserver
+
+    lines = []
+    for mac, stats in gatewayManager.stats().items():
+        queues = []
+        for direction in ("uplink", "downlink"):
+            if direction in stats:
+                q = stats[direction]
+                queues.append(f"{direction} {q['size']}/{q['maxsize']} (max {q['highWater']}, dropped {q['dropped']})")
+        lines.append(f"{mac}: {', '.join(queues)}")
+    return "<br>".join(lines) if lines else "-"
+
+
+# Total latency percentiles of the running gateways as one line per gateway (config.ini [GATEWAY] Latency tracing)
+def getGatewayLatency():
+    from Gateway.gateway_manager import gatewayManager  # Imported here, the gateway itself imports webserver
+
+    lines = []
+    for mac, latency in gatewayManager.latency().items():
+        if latency is None:
+            continue
+        directions = []
+        for direction in ("uplink", "downlink"):
+            total = latency[direction]["total"]
+            directions.append(f"{direction} p50 {total['p50']} / p95 {total['p95']} / p99 {total['p99']} ms")
+        lines.append(f"{mac}: {', '.join(directions)}")
+    return "<br>".join(lines) if lines else "-"
+
 
 @eel.expose
 def startSimRev50():